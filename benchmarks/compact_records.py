@@ -0,0 +1,118 @@
+"""
+Бенчмарк компактных записей пользователей (UserRecord)
+
+Сравнивает словари в формате bot_users.json и UserRecord:
+память на N записей (tracemalloc), размер файла и время разбора.
+
+Запуск из корня репозитория:
+    python -m benchmarks.compact_records --records 1000000
+"""
+
+import argparse
+import gc
+import io
+import json
+import random
+import time
+import tracemalloc
+
+import main
+
+
+def make_record(user_id: int, rnd: random.Random) -> dict:
+    """Синтетическая запись одной из форм, которые пишет анкета"""
+    base = {
+        'user_id': user_id,
+        'username': f"user{user_id}" if rnd.random() < 0.8 else "",
+        'full_name': f"Пользователь {user_id}",
+        'first_contact': f"2026-01-{rnd.randint(1, 28):02d} {rnd.randint(0, 23):02d}:"
+                         f"{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d}",
+    }
+    kind = rnd.random()
+    if kind < 0.2:
+        base.update(has_project=None, survey_completed=False, source='skip')
+    elif kind < 0.6:
+        base.update(
+            has_project=True,
+            object_type=rnd.choice(list(main.OBJECT_TYPE_LABELS.values())),
+            area=rnd.choice(list(main.AREA_LABELS.values())),
+            region=rnd.choice(list(main.REGION_LABELS.values()) + ["Казань"]),
+            timeline=rnd.choice(list(main.TIMELINE_LABELS.values())),
+            survey_completed=True, giveaway_participant=True, source='survey',
+        )
+    else:
+        base.update(
+            has_project=False,
+            interests=rnd.sample(list(main.INTEREST_LABELS.values()), rnd.randint(0, 3)),
+            giveaway_participant=False, survey_completed=True, source='survey',
+        )
+    # Как после json.load: у каждой записи свои экземпляры строк
+    return json.loads(json.dumps(base, ensure_ascii=False))
+
+
+def measure(build) -> tuple:
+    """(байт в памяти, секунд) для построения структуры"""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    return current, elapsed
+
+
+def main_bench() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=1_000_000)
+    parser.add_argument("--file-sample", type=int, default=100_000,
+                        help="сколько записей сериализовать для замера файла")
+    args = parser.parse_args()
+
+    n = args.records
+
+    def build_dicts():
+        rnd = random.Random(1)
+        return {str(i): make_record(i, rnd) for i in range(n)}
+
+    def build_records():
+        rnd = random.Random(1)
+        return {str(i): main.UserRecord.from_dict(make_record(i, rnd)) for i in range(n)}
+
+    dict_bytes, dict_time = measure(build_dicts)
+    rec_bytes, rec_time = measure(build_records)
+
+    print(f"Записей: {n}")
+    print(f"  dict        {dict_bytes / n:8.1f} Б/запись  {dict_bytes / 2**20:9.1f} МиБ  ({dict_time:.1f} с)")
+    print(f"  UserRecord  {rec_bytes / n:8.1f} Б/запись  {rec_bytes / 2**20:9.1f} МиБ  ({rec_time:.1f} с)")
+    print(f"  экономия    {1 - rec_bytes / dict_bytes:8.1%}")
+
+    # Размер файла и разбор — на выборке
+    sample_size = min(n, args.file_sample)
+    rnd = random.Random(2)
+    users = {str(i): make_record(i, rnd) for i in range(sample_size)}
+
+    print(f"Файл ({sample_size} записей):")
+    for fmt in ("json", "compact"):
+        main.USERS_FORMAT = fmt
+        buf = io.StringIO()
+        main.dump_users(users, buf)
+        payload = buf.getvalue()
+
+        started = time.perf_counter()
+        raw = json.loads(payload)
+        parse_time = time.perf_counter() - started
+        started = time.perf_counter()
+        decoded = main.decode_users(raw)
+        decode_time = time.perf_counter() - started
+        assert decoded == users
+
+        size = len(payload.encode('utf-8'))
+        print(f"  {fmt:8s} {size / sample_size:7.1f} Б/запись  разбор {parse_time * 1000:7.1f} мс"
+              f"  декодирование {decode_time * 1000:7.1f} мс")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,132 @@
+"""
+Бенчмарк выгрузки лидов в CRM
+
+Локальная заглушка CRM принимает пачки лидов, отбрасывает дубли по ключу
+и с заданной вероятностью отвечает 503; половина отказов случается уже
+после приёма пачки (как потерянный ответ), так что часть лидов приходит
+повторно. Очередь CrmOutbox заполняется N лидами и отправляется до конца;
+для каждого размера пачки замеряется время, число запросов и открытых
+соединений, повторно полученные лиды.
+
+Запуск из корня репозитория:
+    python -m benchmarks.crm_outbox --leads 5000 --batch 1 10 50 --failure-rate 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import main
+
+
+class CrmStandIn(ThreadingHTTPServer):
+    """Заглушка CRM: POST {"leads": [...]} -> 200 или 503"""
+
+    def __init__(self, failure_rate: float = 0.0):
+        super().__init__(('127.0.0.1', 0), _CrmHandler)
+        self.failure_rate = failure_rate
+        self.random = random.Random(1)
+        self.lock = threading.Lock()
+        self.keys = set()
+        self.requests = 0
+        self.duplicates = 0
+        self.connections = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/leads"
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+
+class _CrmHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failed = server.random.random() < server.failure_rate
+            if not failed or server.random.random() < 0.5:
+                for lead in json.loads(body)['leads']:
+                    if lead['key'] in server.keys:
+                        server.duplicates += 1
+                    server.keys.add(lead['key'])
+        status = 503 if failed else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_lead(index: int) -> dict:
+    return {'user_id': 100_000 + index, 'full_name': f"Пользователь {index}",
+            'has_project': True, 'object_type': "Склад / Логистический центр",
+            'area': "более 30 000 м²", 'region': "Москва", 'timeline': "В ближайший месяц",
+            'survey_completed': True, 'source': 'survey'}
+
+
+async def drain(leads: int) -> float:
+    """Секунд от запуска обработчика до доставки всей очереди"""
+    outbox = main.crm_outbox
+    for index in range(leads):
+        await outbox.add('survey', make_lead(index), index)
+    started = time.perf_counter()
+    outbox.start()
+    while outbox.stats['sent'] < leads:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    await outbox.stop()
+    return elapsed
+
+
+def bench(leads: int, batch: int, failure_rate: float) -> dict:
+    server = CrmStandIn(failure_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    main.CRM_URL = server.url
+    main.CRM_BATCH = batch
+    main.CRM_MAX_BACKOFF = 0.05
+    main.crm_outbox = main.CrmOutbox()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            main.crm_outbox.open(os.path.join(directory, "outbox.jsonl"))
+            elapsed = asyncio.run(drain(leads))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert len(server.keys) == leads
+    return {'elapsed': elapsed, 'requests': server.requests,
+            'connections': server.connections, 'duplicates': server.duplicates}
+
+
+def main_bench() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--leads", type=int, default=5_000)
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--failure-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    print(f"Лидов: {args.leads}, отказов CRM: {args.failure_rate:.0%}")
+    print(f"{'пачка':>6} {'время':>9} {'лидов/с':>9} {'запросов':>9} {'соединений':>11} {'дублей':>7}")
+    for batch in args.batch:
+        result = bench(args.leads, batch, args.failure_rate)
+        print(f"{batch:>6} {result['elapsed']:>8.2f}с {args.leads / result['elapsed']:>9.0f} "
+              f"{result['requests']:>9} {result['connections']:>11} {result['duplicates']:>7}")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,229 @@
+"""
+Бенчмарк памяти на пользователя
+
+N пользователей проходят анкету, часть из них — ещё и форму заявки через
+настоящие обработчики с StubBot. Для каждого формата хранения (json, compact)
+считается прирост памяти на пользователя по tracemalloc с разбивкой:
+сессии PTB (user_data, chat_data, состояния и таймауты диалогов), кэш базы пользователей
+и всё остальное (журнал идемпотентности, антифлуд, индексы, воронка). Пиковый RSS
+замеряется отдельным прогоном без tracemalloc. Каждый замер идёт в новом
+процессе, чтобы пик одного режима не смешивался с другим.
+
+Результаты сравниваются с benchmarks/memory_baseline.json; если байт на
+пользователя или пиковый RSS выросли больше допуска, бенчмарк завершается
+с кодом 1. Новый базовый уровень записывается флагом --update-baseline.
+
+Запуск из корня репозитория:
+    python -m benchmarks.memory --users 1000
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import tracemalloc
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import main
+from benchmarks.stub_bot import StubBot, make_callback_update, make_message_update
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "memory_baseline.json")
+
+SURVEY_STEPS = (
+    ["survey_yes", "obj_warehouse", "area_30000plus", "region_moscow", "time_now"],
+    ["survey_yes", "obj_residential", "area_1000", "region_spb", "time_3m"],
+    ["survey_no", "int_cases", "int_bim", "int_done"],
+)
+REQUEST_STEPS = [
+    "Казань", "Склад / Логистический центр", "12000", "Подбор участка", "Эскизный проект",
+    "Да, нужен BIM", "Да, нужна смета", "1-3 месяца", "Комментарий про склад", "Нет",
+    "+79990000000",
+]
+
+
+def _configure(directory: str, storage: str) -> None:
+    """Файлы бота во временном каталоге, лимиты не мешают прогону"""
+    main.USERS_FORMAT = storage
+    main.USERS_FILE = os.path.join(directory, "users.json")
+    main.STATE_FILE = os.path.join(directory, "state.json")
+    main.JOURNAL_FILE = os.path.join(directory, "journal.bin")
+    main.SNAPSHOT_DIR = ""
+    main.REMINDERS_FILE = os.path.join(directory, "reminders.bin")
+    main.FUNNEL_FILE = os.path.join(directory, "funnel.jsonl")
+    main.TEXTS_FILE = os.path.join(directory, "texts.jsonl")
+    main.CONTENT_FILE = ""
+    main.ARCHIVE_DIR = ""
+    main.MANAGER_CHAT_ID = "999"
+    main.COLD_BATCH_DELAY = 0.0
+    main.INTERESTS_RENDER_DELAY = 0.0
+    main.flood_limiter = main.FloodLimiter(main.parse_flood_limits("message=1000/1,command=1000/1,"
+                                                                   "callback=1000/1,file=1000/1"), 10**6)
+    # Под tracemalloc цикл медленнее — сторож не должен снимать стеки (и грузить linecache)
+    main.loop_monitor.threshold = 3600.0
+    main.update_journal.open(main.JOURNAL_FILE)
+    main.search_index.open(main.TEXTS_FILE)
+
+
+async def _simulate(application, first: int, users: int, request_share: float) -> None:
+    """Анкета для каждого пользователя, форма заявки — для доли request_share"""
+    bot = application.bot
+    rnd = random.Random(first)
+    for user_id in range(first, first + users):
+        await application.process_update(make_message_update(bot, user_id, "/start"))
+        for data in rnd.choice(SURVEY_STEPS):
+            await application.process_update(make_callback_update(bot, user_id, data))
+        if rnd.random() < request_share:
+            await application.process_update(make_message_update(bot, user_id, "/request"))
+            for text in REQUEST_STEPS:
+                await application.process_update(make_message_update(bot, user_id, text))
+    # Очередь менеджеру и отложенные задачи успевают отработать
+    await asyncio.sleep(0.2)
+
+
+def _traced() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+async def _run(users: int, request_share: float, warmup: int, trace: bool) -> dict:
+    application = main.build_application(bot=StubBot())
+    await application.initialize()
+    await main.post_init(application)
+    await main.preload_users_cache()
+    await application.start()
+    # Разовые расходы (кэши модулей, первые аллокации структур) не относим к пользователям
+    await _simulate(application, 1, warmup, request_share)
+
+    result = {}
+    if trace:
+        tracemalloc.start()
+        before = _traced()
+    await _simulate(application, 100_000, users, request_share)
+    if trace:
+        # Журнал вызовов StubBot — память бенчмарка, а не бота
+        application.bot.calls.clear()
+        total = _traced()
+        # Отпускаем структуры по очереди — на сколько уменьшилась память, столько они и занимали
+        application._user_data.clear()
+        application._chat_data.clear()
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, main.ConversationHandler):
+                    handler._conversations.clear()
+                    # Задание таймаута держит последний апдейт диалога
+                    for job in handler.timeout_jobs.values():
+                        job.schedule_removal()
+                    handler.timeout_jobs.clear()
+        without_sessions = _traced()
+        main._install_users_cache({})
+        without_store = _traced()
+        result = {
+            'bytes_per_user': (total - before) / users,
+            'sessions_per_user': (total - without_sessions) / users,
+            'store_per_user': (without_sessions - without_store) / users,
+            'other_per_user': (without_store - before) / users,
+            'traced_peak_mib': (tracemalloc.get_traced_memory()[1] - before) / 2**20,
+        }
+        tracemalloc.stop()
+    else:
+        # ru_maxrss в Linux — в КиБ
+        result['peak_rss_mib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    await application.stop()
+    await main.post_stop(application)
+    await application.shutdown()
+    await main.post_shutdown(application)
+    return result
+
+
+def measure(storage: str, users: int, request_share: float, warmup: int, trace: bool) -> dict:
+    """Один замер в отдельном процессе"""
+    warnings.simplefilter("ignore")
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        _configure(directory, storage)
+        return asyncio.run(_run(users, request_share, warmup, trace))
+
+
+def _in_new_process(*args) -> dict:
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(measure, *args).result()
+
+
+def check_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """Строки с превышениями базового уровня больше чем на tolerance"""
+    regressions = []
+    for storage, result in results.items():
+        for metric in ('bytes_per_user', 'peak_rss_mib'):
+            expected = baseline.get(storage, {}).get(metric)
+            if expected and result[metric] > expected * (1 + tolerance):
+                regressions.append(f"{storage} {metric}: {result[metric]:.1f} > {expected:.1f} "
+                                   f"(+{result[metric] / expected - 1:.0%})")
+    return regressions
+
+
+def main_bench() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--request-share", type=float, default=0.3,
+                        help="доля пользователей, которые заполняют форму заявки")
+    parser.add_argument("--warmup", type=int, default=50,
+                        help="пользователей до начала замера")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="допустимый рост относительно базового уровня")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"Пользователей: {args.users}, с заявкой: {args.request_share:.0%}")
+    print(f"{'хранение':>9} {'Б/польз.':>9} {'сессии':>8} {'база':>8} {'прочее':>8} "
+          f"{'на 10k':>9} {'пик RSS':>9}")
+    for storage in ("json", "compact"):
+        result = _in_new_process(storage, args.users, args.request_share, args.warmup, True)
+        result.update(_in_new_process(storage, args.users, args.request_share, args.warmup, False))
+        results[storage] = result
+        print(f"{storage:>9} {result['bytes_per_user']:>9.0f} {result['sessions_per_user']:>8.0f} "
+              f"{result['store_per_user']:>8.0f} {result['other_per_user']:>8.0f} "
+              f"{result['bytes_per_user'] * 10_000 / 2**20:>6.1f}МиБ {result['peak_rss_mib']:>6.1f}МиБ")
+
+    if args.update_baseline:
+        baseline = {'users': args.users, 'request_share': args.request_share}
+        for storage, result in results.items():
+            baseline[storage] = {'bytes_per_user': round(result['bytes_per_user']),
+                                 'peak_rss_mib': round(result['peak_rss_mib'], 1)}
+        with open(BASELINE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+        print(f"Базовый уровень записан в {BASELINE_FILE}")
+        return
+
+    try:
+        with open(BASELINE_FILE, encoding='utf-8') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print("Базового уровня нет — запустите с --update-baseline")
+        return
+    if (baseline.get('users'), baseline.get('request_share')) != (args.users, args.request_share):
+        # Пиковый RSS зависит от N — сравнивать можно только одинаковые прогоны
+        print(f"Базовый уровень снят для {baseline.get('users')} пользователей "
+              f"и доли заявок {baseline.get('request_share')} — сравнение пропущено")
+        return
+    regressions = check_regressions(results, baseline, args.tolerance)
+    if regressions:
+        print("Регрессия памяти:")
+        for line in regressions:
+            print("  " + line)
+        sys.exit(1)
+    print(f"В пределах базового уровня (допуск {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,66 @@
+"""
+Бенчмарк миграции схемы записей
+
+Для каждого размера базы пишет файл пользователей со старыми записями
+(без schema) и прогоняет migrate_users(): время, записей в секунду
+и (отдельным прогоном) пик памяти по tracemalloc. Пик не должен расти
+с числом записей — в памяти только буфер чтения и текущая запись.
+
+Запуск из корня репозитория:
+    python -m benchmarks.migrate --records 10000 100000 1000000
+"""
+
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import main
+from benchmarks.compact_records import make_record
+
+
+def _write_users(records: int) -> None:
+    rnd = random.Random(records)
+    with open(main.USERS_FILE, 'w', encoding='utf-8') as f:
+        main.dump_users({str(i): make_record(i, rnd) for i in range(records)}, f)
+
+
+def bench(records: int, storage: str) -> tuple:
+    """(секунд на миграцию, пик памяти в байтах)"""
+    main.USERS_FORMAT = storage
+    with tempfile.TemporaryDirectory() as directory:
+        main.USERS_FILE = os.path.join(directory, "users.json")
+        _write_users(records)
+        started = time.perf_counter()
+        stats = main.migrate_users()
+        elapsed = time.perf_counter() - started
+        assert stats['records'] == stats['upgraded'] == records
+
+        # Под tracemalloc миграция медленнее — пик памяти меряем отдельным прогоном
+        _write_users(records)
+        tracemalloc.start()
+        main.migrate_users()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def main_bench() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    print(f"{'записей':>10} {'хранение':>9} {'время':>9} {'записей/с':>10} {'пик памяти':>11}")
+    for records in args.records:
+        for storage in ("json", "compact"):
+            elapsed, peak = bench(records, storage)
+            print(f"{records:>10} {storage:>9} {elapsed:>8.2f}с {records / elapsed:>10.0f} "
+                  f"{peak / 2**10:>7.0f} КиБ")
+
+
+if __name__ == "__main__":
+    main_bench()
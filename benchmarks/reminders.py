@@ -0,0 +1,59 @@
+"""
+Бенчмарк планировщика напоминаний
+
+Ставит N напоминаний, переносит и отменяет часть из них и снимает
+наступившие; печатает время операций и память (tracemalloc).
+
+Запуск из корня репозитория:
+    python -m benchmarks.reminders --reminders 100000
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+import main
+
+
+def main_bench() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--reminders", type=int, default=100_000)
+    args = parser.parse_args()
+    n = args.reminders
+
+    gc.collect()
+    tracemalloc.start()
+    scheduler = main.ReminderScheduler()
+    started = time.perf_counter()
+    for user_id in range(n):
+        scheduler.schedule(user_id, main.REMINDER_REQUEST)
+    schedule_time = time.perf_counter() - started
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Пользователь прошёл ещё шаг — напоминание переносится
+    started = time.perf_counter()
+    for user_id in range(0, n, 2):
+        scheduler.schedule(user_id, main.REMINDER_REQUEST)
+    reschedule_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for user_id in range(0, n, 4):
+        scheduler.cancel(user_id)
+    cancel_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    due = scheduler.pop_due(time.time() + main.REMINDER_DELAY + 1, n)
+    pop_time = time.perf_counter() - started
+
+    print(f"Напоминаний: {n}")
+    print(f"  память          {memory / n:8.1f} Б/шт  {memory / 2**20:7.1f} МиБ")
+    print(f"  постановка      {schedule_time / n * 1e6:8.2f} мкс")
+    print(f"  перенос         {reschedule_time / (n // 2) * 1e6:8.2f} мкс")
+    print(f"  отмена          {cancel_time / (n // 4) * 1e6:8.2f} мкс")
+    print(f"  снятие {len(due):>7}  {pop_time / max(1, len(due)) * 1e6:8.2f} мкс (с устаревшими записями)")
+
+
+if __name__ == "__main__":
+    main_bench()
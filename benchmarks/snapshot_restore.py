@@ -0,0 +1,59 @@
+"""
+Бенчмарк восстановления из снимков
+
+Для каждого размера базы пишет полный снимок и несколько дельт
+(по 1% изменённых записей) и замеряет время restore_users().
+
+Запуск из корня репозитория:
+    python -m benchmarks.snapshot_restore --records 1000 10000 100000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import main
+from benchmarks.compact_records import make_record
+
+
+def bench(records: int, deltas: int, compression: str) -> tuple:
+    """(секунд на восстановление, байт снимков на диске)"""
+    rnd = random.Random(records)
+    users = {str(i): make_record(i, rnd) for i in range(records)}
+    main.SNAPSHOT_COMPRESSION = compression
+
+    with tempfile.TemporaryDirectory() as directory:
+        main.take_snapshot(users, set(), directory, full=True)
+        for _ in range(deltas):
+            dirty = {str(rnd.randrange(records)) for _ in range(max(1, records // 100))}
+            for uid in dirty:
+                users[uid] = dict(users[uid], survey_completed=True)
+            main.take_snapshot(users, dirty, directory, full=False)
+
+        started = time.perf_counter()
+        restored = main.restore_users(directory)
+        elapsed = time.perf_counter() - started
+        assert restored == users
+
+        size = sum(os.path.getsize(os.path.join(directory, e['file']))
+                   for e in main._read_manifest(directory))
+    return elapsed, size
+
+
+def main_bench() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--deltas", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'записей':>10} {'сжатие':>7} {'восстановление':>15} {'на диске':>12}")
+    for records in args.records:
+        for compression in ("gzip", "lzma"):
+            elapsed, size = bench(records, args.deltas, compression)
+            print(f"{records:>10} {compression:>7} {elapsed * 1000:>12.1f} мс {size / 2**10:>9.1f} КиБ")
+
+
+if __name__ == "__main__":
+    main_bench()
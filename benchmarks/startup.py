@@ -0,0 +1,87 @@
+"""
+Бенчмарк старта: время до первого ответа
+
+Для базы из N пользователей замеряет время от создания приложения до ответа
+на /start вернувшегося пользователя: холодный старт (разбор bot_users.json)
+и тёплый (множество пользователей из STATE_FILE). Приложение стартует
+с очередью задач, и до первого апдейта срабатывает снимок данных: ни он,
+ни ответ не должны синхронно разбирать файл при тёплом старте.
+
+Запуск из корня репозитория:
+    python -m benchmarks.startup --records 10000 100000 1000000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import warnings
+
+import main
+from benchmarks.compact_records import make_record
+from benchmarks.stub_bot import StubBot, make_message_update
+
+
+def _reset_caches() -> None:
+    main._users_cache = None
+    main._known_users = None
+
+
+async def first_reply(user_id: int) -> float:
+    """Секунд от создания приложения до ответа на /start"""
+    started = time.perf_counter()
+    application = main.build_application(bot=StubBot())
+    await application.initialize()
+    await application.start()
+    await main.snapshot_job(None)
+    await application.process_update(make_message_update(application.bot, user_id, "/start"))
+    elapsed = time.perf_counter() - started
+    assert application.bot.calls[-1] == 'sendMessage'
+    await application.stop()
+    await application.shutdown()
+    return elapsed
+
+
+def bench(records: int, directory: str) -> dict:
+    main.USERS_FILE = os.path.join(directory, "users.json")
+    main.STATE_FILE = os.path.join(directory, "state.json")
+    main.SNAPSHOT_DIR = os.path.join(directory, "snapshots")
+    rnd = random.Random(records)
+    main.save_users({str(i): make_record(i, rnd) for i in range(records)})
+    _reset_caches()
+
+    cold = asyncio.run(first_reply(records // 2))
+    main.save_warm_state()
+    _reset_caches()
+
+    started = time.perf_counter()
+    main.load_warm_state()
+    load_state = time.perf_counter() - started
+    warm = asyncio.run(first_reply(records // 2)) + load_state
+    assert main._users_cache is None, "тёплый старт не должен разбирать файл"
+
+    started = time.perf_counter()
+    asyncio.run(main.preload_users_cache())
+    preload = time.perf_counter() - started
+    return {'cold': cold, 'warm': warm, 'preload': preload}
+
+
+def main_bench() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--format", choices=("json", "compact"), default="json")
+    args = parser.parse_args()
+
+    main.USERS_FORMAT = args.format
+    warnings.simplefilter("ignore")
+    print(f"{'записей':>10} {'холодный':>10} {'тёплый':>10} {'догрузка кэша фоном':>20}")
+    for records in args.records:
+        with tempfile.TemporaryDirectory() as directory:
+            result = bench(records, directory)
+        print(f"{records:>10} {result['cold']:>9.3f}с {result['warm']:>9.3f}с {result['preload']:>19.3f}с")
+
+
+if __name__ == "__main__":
+    main_bench()
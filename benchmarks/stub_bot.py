@@ -0,0 +1,80 @@
+"""
+Заглушка Bot API для бенчмарков
+
+StubBot отвечает на вызовы Bot API без сети, а функции make_*_update
+собирают апдейты, которые проходят через настоящие обработчики main.py.
+"""
+
+import itertools
+import time
+
+from telegram import Update
+from telegram.ext import ExtBot
+
+_message_ids = itertools.count(1)
+_update_ids = itertools.count(1)
+
+
+class StubBot(ExtBot):
+    """Бот, который ничего не отправляет, а только считает вызовы"""
+
+    def __init__(self, token: str = "1:stub", **kwargs):
+        super().__init__(token, **kwargs)
+        self._calls = []
+
+    @property
+    def calls(self) -> list:
+        return self._calls
+
+    async def _do_post(self, endpoint: str, data: dict, **kwargs):
+        self._calls.append(endpoint)
+        if endpoint == 'getMe':
+            return {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}
+        if endpoint == 'getUpdates':
+            return []
+        if endpoint in ('sendMessage', 'editMessageText', 'sendDocument'):
+            return {
+                "message_id": next(_message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(data.get('chat_id', 1)), "type": "private"},
+                "text": str(data.get('text', '')),
+            }
+        return True
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def make_message_update(bot, user_id: int, text: str) -> Update:
+    """Текстовое сообщение или команда от пользователя"""
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith('/'):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": next(_update_ids), "message": message}, bot)
+
+
+def make_callback_update(bot, user_id: int, data: str, message_id: int = 1) -> Update:
+    """Нажатие inline-кнопки"""
+    return Update.de_json({
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_message_ids)),
+            "chat_instance": str(user_id),
+            "data": data,
+            "from": _user(user_id),
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "stub"},
+                "text": "…",
+            },
+        },
+    }, bot)
@@ -16,27 +16,57 @@ Telegram-бот «Навигатор ADC» — публичный бот для
 """
 
 import os
+import sys
+import gzip
 import json
+import lzma
+import time
+import base64
+import struct
+import hashlib
+import hmac
+import bisect
+import itertools
+import queue
+import random
+import asyncio
 import logging
+import functools
+import types
 import threading
+import contextvars
+import contextlib
+import traceback
+import cProfile
+import io
+import pstats
+import re
+import codecs
+import heapq
+import math
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from array import array
+from collections import Counter, OrderedDict, deque
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, filters, ContextTypes
+    Application, ApplicationHandlerStop, CommandHandler, MessageHandler, CallbackQueryHandler,
+    ConversationHandler, TypeHandler, filters, ContextTypes
 )
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 # ============== НАСТРОЙКИ ==============
 MANAGER_CHAT_ID = os.environ.get("MANAGER_CHAT_ID", "")
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID", "")  # Для уведомлений о лидах
+# Пользователи с доступом к служебным командам (через запятую)
+ADMIN_USER_IDS = {int(x) for x in os.environ.get("ADMIN_USER_IDS", "").split(",") if x.strip()}
 
 # Ссылки
 SITE_URL = "https://arxproektstroy.ru"
@@ -45,6 +75,119 @@ CHANNEL_URL = "https://t.me/ADC_Project"
 
 # Файл для хранения данных пользователей
 USERS_FILE = "bot_users.json"
+# Формат файла: json — запись как есть, compact — строки UserRecord с кодами
+USERS_FORMAT = os.environ.get("USERS_FORMAT", "json")
+
+# Миграция схемы записей (python main.py migrate): контрольная точка каждые N записей
+MIGRATION_CHECKPOINT_EVERY = int(os.environ.get("MIGRATION_CHECKPOINT_EVERY", "10000"))
+
+# Состояние для тёплого перезапуска: смещение апдейтов, известные пользователи, счётчики
+STATE_FILE = os.environ.get("STATE_FILE", "bot_state.json")
+
+# Снимки данных пользователей: каталог (пусто — выключены), период дельт (сек),
+# полный снимок после стольких дельт, сколько полных снимков хранить
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", "300"))
+SNAPSHOT_FULL_EVERY = int(os.environ.get("SNAPSHOT_FULL_EVERY", "12"))
+SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOT_KEEP", "3"))
+SNAPSHOT_COMPRESSION = os.environ.get("SNAPSHOT_COMPRESSION", "gzip")  # gzip | lzma
+
+# Логирование
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json | text
+LOG_FILE = os.environ.get("LOG_FILE", "")  # пусто — только консоль
+# Доля сохраняемых частых INFO-записей (помеченных extra={"sampled": True})
+LOG_INFO_SAMPLE_RATE = float(os.environ.get("LOG_INFO_SAMPLE_RATE", "1.0"))
+
+# Трассировка апдейтов (JSONL в формате OTLP/JSON); пусто — выключена
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.1"))
+
+# Журнал обработанных update_id и отправленных заявок (защита от повторной доставки)
+JOURNAL_FILE = os.environ.get("JOURNAL_FILE", "bot_journal.bin")
+JOURNAL_SIZE = int(os.environ.get("JOURNAL_SIZE", "10000"))
+
+# Антифлуд: лимиты «тип=ёмкость/период_сек» (альбом считается одним файлом),
+# режим reply | silent, сколько пользователей держать в таблице лимитов
+FLOOD_LIMITS = os.environ.get("FLOOD_LIMITS", "message=20/30,command=4/10,callback=15/10,file=10/30")
+FLOOD_MODE = os.environ.get("FLOOD_MODE", "reply")
+FLOOD_MAX_USERS = int(os.environ.get("FLOOD_MAX_USERS", "50000"))
+
+# Очередь уведомлений менеджеру: пороги оценки лида, сколько ждать (сек)
+# накопления холодных уведомлений в одно сообщение, период отчёта (сек)
+LEAD_HOT_SCORE = int(os.environ.get("LEAD_HOT_SCORE", "60"))
+LEAD_WARM_SCORE = int(os.environ.get("LEAD_WARM_SCORE", "30"))
+COLD_BATCH_DELAY = float(os.environ.get("COLD_BATCH_DELAY", "60"))
+QUEUE_REPORT_INTERVAL = int(os.environ.get("QUEUE_REPORT_INTERVAL", "600"))
+
+# Сводка малозначимых уведомлений (новые подписчики, вопросы без ответа), сек
+DIGEST_INTERVAL = int(os.environ.get("DIGEST_INTERVAL", "900"))
+
+# Сессии: таймаут диалога и вытеснение неактивных user_data/chat_data (сек)
+CONVERSATION_TIMEOUT = int(os.environ.get("CONVERSATION_TIMEOUT", "1800"))
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "7200"))
+REAPER_INTERVAL = int(os.environ.get("REAPER_INTERVAL", "600"))
+
+# Пауза (сек) перед отрисовкой клавиатуры интересов после последнего нажатия
+INTERESTS_RENDER_DELAY = float(os.environ.get("INTERESTS_RENDER_DELAY", "0.7"))
+
+# Напоминания о брошенной заявке или анкете: файл, через сколько (сек) после
+# последнего шага, период проверки (сек) и сколько отправлять за проверку
+REMINDERS_FILE = os.environ.get("REMINDERS_FILE", "bot_reminders.bin")
+REMINDER_DELAY = int(os.environ.get("REMINDER_DELAY", "21600"))
+REMINDER_TICK = int(os.environ.get("REMINDER_TICK", "30"))
+REMINDER_BATCH = int(os.environ.get("REMINDER_BATCH", "100"))
+
+# Задержка цикла событий: период замера (сек) и порог (сек), после которого
+# стек блокирующего вызова пишется в лог
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_LAG_THRESHOLD = float(os.environ.get("LOOP_LAG_THRESHOLD", "0.1"))
+
+# Пробы /readyz и /livez: сколько (сек) без успешного getUpdates или апдейта,
+# предел очереди уведомлений, предел задержки цикла (сек); /livez падает,
+# если цикл событий не отвечает дольше LIVE_MAX_STALL (сек)
+READY_UPDATES_MAX_AGE = float(os.environ.get("READY_UPDATES_MAX_AGE", "90"))
+READY_MAX_QUEUE = int(os.environ.get("READY_MAX_QUEUE", "500"))
+READY_MAX_LOOP_LAG = float(os.environ.get("READY_MAX_LOOP_LAG", "1.0"))
+LIVE_MAX_STALL = float(os.environ.get("LIVE_MAX_STALL", "60"))
+
+# Воронка анкеты и заявки: файл часовых сводок, период свёртки событий (сек),
+# ёмкость кольца событий, сколько часов держать в памяти
+FUNNEL_FILE = os.environ.get("FUNNEL_FILE", "bot_funnel.jsonl")
+FUNNEL_ROLLUP_INTERVAL = int(os.environ.get("FUNNEL_ROLLUP_INTERVAL", "60"))
+FUNNEL_RING_SIZE = int(os.environ.get("FUNNEL_RING_SIZE", "65536"))
+FUNNEL_KEEP_HOURS = int(os.environ.get("FUNNEL_KEEP_HOURS", "168"))
+
+# Каталог текстов (страницы меню, ответы на ключевые слова): файл JSON
+# (пусто или нет файла — встроенные тексты), период проверки изменений (сек)
+CONTENT_FILE = os.environ.get("CONTENT_FILE", "content.json")
+CONTENT_POLL_INTERVAL = int(os.environ.get("CONTENT_POLL_INTERVAL", "15"))
+
+# Свободные тексты (комментарии, вопросы, свои варианты ответов) для поиска /find
+TEXTS_FILE = os.environ.get("TEXTS_FILE", "bot_texts.jsonl")
+
+# Токен HTTP API /leads на health-сервере (пусто — API выключен)
+LEADS_API_TOKEN = os.environ.get("LEADS_API_TOKEN", "")
+
+# Архив вложений заявок: каталог (пусто — выключен), число параллельных загрузок
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "")
+ARCHIVE_CONCURRENCY = int(os.environ.get("ARCHIVE_CONCURRENCY", "3"))
+
+# Пул менеджеров: чаты через запятую (пусто — всё в MANAGER_CHAT_ID/ADMIN_CHAT_ID),
+# правила «поле:значение=чат|чат;...», балансировка least | round_robin,
+# лимит лидов на менеджера «ёмкость/период_сек» (пусто — без лимита)
+MANAGER_POOL = [x.strip() for x in os.environ.get("MANAGER_POOL", "").split(",") if x.strip()]
+MANAGER_ROUTES = os.environ.get("MANAGER_ROUTES", "")
+MANAGER_BALANCE = os.environ.get("MANAGER_BALANCE", "least")
+MANAGER_RATE = os.environ.get("MANAGER_RATE", "")
+
+# Выгрузка лидов в CRM: адрес приёма пачек (пусто — выключена), токен,
+# файл очереди, размер пачки, предел паузы между повторами (сек)
+CRM_URL = os.environ.get("CRM_URL", "")
+CRM_TOKEN = os.environ.get("CRM_TOKEN", "")
+CRM_OUTBOX_FILE = os.environ.get("CRM_OUTBOX_FILE", "bot_outbox.jsonl")
+CRM_BATCH = int(os.environ.get("CRM_BATCH", "50"))
+CRM_MAX_BACKOFF = float(os.environ.get("CRM_MAX_BACKOFF", "300"))
 
 # Состояния для ConversationHandler
 # Приветственная анкета (SURVEY_*)
@@ -57,45 +200,2131 @@ USERS_FILE = "bot_users.json"
  REQUEST_COMMENT, REQUEST_FILES, REQUEST_CONTACT, TECH_QUESTION) = range(8, 21)
 
 
+# ============== СПРАВОЧНИКИ АНКЕТЫ ==============
+# callback_data кнопки -> подпись, сохраняемая в данных пользователя.
+# Порядок задаёт коды UserRecord — новые значения добавлять только в конец.
+OBJECT_TYPE_LABELS = {
+    "obj_warehouse": "Склад / логистика",
+    "obj_production": "Производство",
+    "obj_office": "Офис / БЦ",
+    "obj_retail": "Торговый центр",
+    "obj_hotel": "Гостиница / апартаменты",
+    "obj_medical": "Медицина / социальное",
+    "obj_residential": "Жильё / МЖД",
+    "obj_other": "Другое"
+}
+
+AREA_LABELS = {
+    "area_1000": "до 1 000 м²",
+    "area_5000": "1 000 – 5 000 м²",
+    "area_10000": "5 000 – 10 000 м²",
+    "area_30000": "10 000 – 30 000 м²",
+    "area_30000plus": "более 30 000 м²",
+    "area_unknown": "Пока не определена"
+}
+
+REGION_LABELS = {
+    "region_moscow": "Москва",
+    "region_mo": "Московская область",
+    "region_spb": "Санкт-Петербург / ЛО"
+}
+
+TIMELINE_LABELS = {
+    "time_now": "Уже ищем подрядчика",
+    "time_3m": "В ближайшие 1-3 месяца",
+    "time_year": "В этом году",
+    "time_later": "Пока изучаю вопрос"
+}
+
+INTEREST_LABELS = {
+    "int_law": "Законодательство",
+    "int_cases": "Кейсы и ошибки",
+    "int_cost": "Стоимость",
+    "int_bim": "BIM",
+    "int_expertise": "Экспертиза",
+    "int_support": "Господдержка"
+}
+
+SOURCE_LABELS = ("survey", "skip")
+
+
+# ============== ЛОГИРОВАНИЕ ==============
+# Контекст текущего апдейта — подставляется в каждую запись лога
+_log_update_id = contextvars.ContextVar("log_update_id", default=None)
+_log_user_id = contextvars.ContextVar("log_user_id", default=None)
+_log_handler = contextvars.ContextVar("log_handler", default=None)
+
+_log_listener = None
+
+
+class LogContextFilter(logging.Filter):
+    """Контекст апдейта в записи и сэмплирование частых INFO"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if (record.levelno == logging.INFO
+                and getattr(record, 'sampled', False)
+                and random.random() >= LOG_INFO_SAMPLE_RATE):
+            return False
+        # contextvars недоступны в потоке слушателя — фиксируем их здесь
+        record.update_id = _log_update_id.get()
+        record.user_id = _log_user_id.get()
+        record.handler = _log_handler.get()
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler без форматирования в потоке событийного цикла"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Стандартный prepare() форматирует сообщение сразу; у нас аргументы —
+        # неизменяемые числа и строки, поэтому форматирование откладываем
+        # до потока QueueListener
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Структурированная запись лога одной JSON-строкой"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'update_id': getattr(record, 'update_id', None),
+            'user_id': getattr(record, 'user_id', None),
+            'handler': getattr(record, 'handler', None),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging() -> None:
+    """Логирование через очередь и фоновый поток"""
+    global _log_listener
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - '
+            '[upd=%(update_id)s user=%(user_id)s %(handler)s] %(message)s'
+        )
+    
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO на каждый запрос к Bot API, включая long polling
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    
+    _log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+
+
+def stop_logging() -> None:
+    """Дописать очередь логов и остановить фоновый поток"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+# ============== ТРАССИРОВКА ==============
+# Текущая трасса и открытый в ней span: (Trace, span_id) или None
+_trace_ctx = contextvars.ContextVar("trace_ctx", default=None)
+_trace_logger = logging.getLogger("adc.trace")
+_trace_listener = None
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Trace:
+    """Спаны одного апдейта, выгружаются одной строкой"""
+    __slots__ = ('trace_id', 'spans')
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    """Атрибуты в формате OTLP/JSON"""
+    result = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            typed = {'boolValue': value}
+        elif isinstance(value, int):
+            typed = {'intValue': str(value)}
+        else:
+            typed = {'stringValue': str(value)}
+        result.append({'key': key, 'value': typed})
+    return result
+
+
+class SpanFormatter(logging.Formatter):
+    """Трасса одной строкой ExportTraceServiceRequest (OTLP/JSON)"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        trace = record.trace
+        return json.dumps({
+            'resourceSpans': [{
+                'resource': {'attributes': _otlp_attributes({'service.name': 'adc-navigator-bot'})},
+                'scopeSpans': [{'scope': {'name': __name__}, 'spans': trace.spans}],
+            }]
+        }, ensure_ascii=False)
+
+
+@contextlib.contextmanager
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes):
+    """Вложенный span; вне сэмплированной трассы ничего не делает"""
+    current = _trace_ctx.get()
+    if current is None:
+        yield
+        return
+    
+    trace, parent_id = current
+    span_id = os.urandom(8).hex()
+    token = _trace_ctx.set((trace, span_id))
+    status = {'code': STATUS_OK}
+    start = time.time_ns()
+    try:
+        yield
+    except BaseException as e:
+        status = {'code': STATUS_ERROR, 'message': repr(e)}
+        raise
+    finally:
+        end = time.time_ns()
+        _trace_ctx.reset(token)
+        entry = {
+            'traceId': trace.trace_id,
+            'spanId': span_id,
+            'name': name,
+            'kind': kind,
+            'startTimeUnixNano': str(start),
+            'endTimeUnixNano': str(end),
+            'attributes': _otlp_attributes(attributes),
+            'status': status,
+        }
+        if parent_id:
+            entry['parentSpanId'] = parent_id
+        trace.spans.append(entry)
+
+
+@contextlib.contextmanager
+def start_trace(name: str, **attributes):
+    """Корневой span апдейта; трасса выгружается при выходе"""
+    if _trace_listener is None or random.random() >= TRACE_SAMPLE_RATE:
+        yield
+        return
+    
+    trace = Trace()
+    token = _trace_ctx.set((trace, None))
+    try:
+        with span(name, **attributes):
+            yield
+    finally:
+        _trace_ctx.reset(token)
+        _trace_logger.info("trace", extra={'trace': trace})
+
+
+def setup_tracing() -> None:
+    """Выгрузка трасс в TRACE_FILE через фоновый поток"""
+    global _trace_listener
+    if not TRACE_FILE:
+        return
+    
+    file_handler = logging.FileHandler(TRACE_FILE, encoding='utf-8')
+    file_handler.setFormatter(SpanFormatter())
+    
+    trace_queue = queue.SimpleQueue()
+    _trace_logger.handlers = [LazyQueueHandler(trace_queue)]
+    _trace_logger.setLevel(logging.INFO)
+    _trace_logger.propagate = False
+    
+    _trace_listener = QueueListener(trace_queue, file_handler)
+    _trace_listener.start()
+
+
+def stop_tracing() -> None:
+    """Дописать очередь трасс и остановить фоновый поток"""
+    global _trace_listener
+    if _trace_listener is not None:
+        _trace_listener.stop()
+        _trace_listener = None
+
+
+class TracingRequest(HTTPXRequest):
+    """HTTP-клиент Bot API со span на каждый вызов"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        # В url есть токен бота — в атрибуты попадает только имя метода
+        if "/file/bot" in url:
+            name = "telegram.download"
+        else:
+            name = "telegram." + url.rsplit("/", 1)[-1]
+        with span(name, kind=SPAN_KIND_CLIENT, **{'http.method': method}):
+            result = await super().do_request(url, method, *args, **kwargs)
+        if name == "telegram.getUpdates" and result[0] == 200:
+            readiness.updates_received()
+        return result
+
+
+class BotApplication(Application):
+    """Application, выставляющий контекст апдейта для логов и трасс"""
+
+    async def process_update(self, update: object) -> None:
+        if not isinstance(update, Update):
+            await super().process_update(update)
+            return
+        
+        user = update.effective_user
+        chat = update.effective_chat
+        now = time.monotonic()
+        # Апдейт дошёл (через getUpdates или вебхук) — связь с Telegram есть
+        readiness.updates_received()
+        if user:
+            _user_last_seen[user.id] = now
+        if chat:
+            _chat_last_seen[chat.id] = now
+        
+        update_token = _log_update_id.set(update.update_id)
+        user_token = _log_user_id.set(user.id if user else None)
+        try:
+            with start_trace("update", **{'update.id': update.update_id,
+                                          'user.id': user.id if user else None}):
+                await super().process_update(update)
+            # Обработчики отработали — теперь повторная доставка будет дублем
+            update_journal.record_update(update.update_id)
+        finally:
+            _log_user_id.reset(user_token)
+            _log_update_id.reset(update_token)
+
+
+def _instrument_callback(callback, in_conversation: bool = False):
+    """Обёртка обработчика: имя обработчика в контексте логов.
+    
+    Для обработчиков внутри ConversationHandler возвращённое состояние
+    передаётся планировщику напоминаний и в воронку.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        token = _log_handler.set(callback.__name__)
+        try:
+            with span("handler." + callback.__name__):
+                state = await callback(update, context)
+            if in_conversation and isinstance(update, Update) and update.effective_user:
+                reminders.track(update.effective_user.id, state)
+                funnel.record(update.effective_user.id, state)
+            return state
+        finally:
+            _log_handler.reset(token)
+    
+    wrapper.instrumented = True
+    return wrapper
+
+
+def _instrument_handler(handler, in_conversation: bool = False) -> None:
+    """Обернуть callback обработчика (и вложенных в ConversationHandler)"""
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for inner in nested:
+            _instrument_handler(inner, in_conversation=True)
+    elif not getattr(handler.callback, 'instrumented', False):
+        handler.callback = _instrument_callback(handler.callback, in_conversation)
+
+
+def instrument_handlers(application: Application) -> None:
+    """Инструментирование всех зарегистрированных обработчиков"""
+    for group_handlers in application.handlers.values():
+        for handler in group_handlers:
+            _instrument_handler(handler)
+
+
+# ============== ЗАДЕРЖКА ЦИКЛА СОБЫТИЙ ==============
+# Пульс — корутина, которая засыпает на LOOP_LAG_INTERVAL и замеряет, насколько
+# позже срока проснулась: это задержка планирования, она копится в гистограмме.
+# Сторож — поток: если пульса нет дольше порога, цикл занят синхронным вызовом,
+# и сторож снимает стек потока цикла, пока вызов ещё идёт.
+class Histogram:
+    """Гистограмма с фиксированными границами корзин (для /metrics)"""
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def prometheus(self, name: str, help_text: str) -> list:
+        """Строки в текстовом формате Prometheus"""
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.total:.6f}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _blocking_handler(frame):
+    """Имя обработчика бота в стеке (по кадру обёртки _instrument_callback)"""
+    while frame is not None:
+        if frame.f_code.co_qualname == "_instrument_callback.<locals>.wrapper":
+            callback = frame.f_locals.get('callback')
+            return getattr(callback, '__name__', None)
+        frame = frame.f_back
+    return None
+
+
+class LoopLagMonitor:
+    """Замер задержки цикла событий и поиск блокирующих вызовов"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.histogram = Histogram(LOOP_LAG_BUCKETS)
+        self.last_lag = 0.0
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop_thread = None
+        self._stop = threading.Event()
+        self._task = None
+        self._watchdog = None
+
+    def start(self) -> None:
+        """Запуск из потока цикла событий"""
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = start_background_task(self._heartbeat(), name="loop_lag")
+        self._watchdog = threading.Thread(target=self._watch, name="loop_watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def current_lag(self) -> float:
+        """Задержка сейчас: последний замер или время без пульса, если цикл занят"""
+        if self._task is None:
+            return 0.0
+        return max(self.last_lag, time.monotonic() - self._beat - self.interval)
+
+    async def _heartbeat(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - scheduled)
+            self._beat = time.monotonic()
+            self.last_lag = lag
+            self.histogram.observe(lag)
+            if lag >= self.threshold:
+                # Стек сторож уже записал; здесь — полная длительность простоя
+                logger.warning("Event loop lag %.0f ms", lag * 1000)
+
+    def _watch(self) -> None:
+        reported = None
+        while not self._stop.wait(self.interval / 2):
+            beat = self._beat
+            if time.monotonic() - beat < self.interval + self.threshold or beat == reported:
+                continue
+            # Пульса нет дольше порога — цикл занят; стек снимаем один раз за простой
+            reported = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            logger.warning(
+                "Event loop blocked for %.0f ms in handler %s:\n%s",
+                (time.monotonic() - beat) * 1000, _blocking_handler(frame) or "—",
+                "".join(traceback.format_stack(frame)).rstrip()
+            )
+
+    def prometheus(self) -> list:
+        return self.histogram.prometheus(
+            "bot_event_loop_lag_seconds", "Delay of event loop wakeups past their schedule"
+        ) + [
+            "# HELP bot_event_loop_stalls_total Event loop stalls longer than the threshold",
+            "# TYPE bot_event_loop_stalls_total counter",
+            f"bot_event_loop_stalls_total {self.stalls}",
+        ]
+
+
+loop_monitor = LoopLagMonitor()
+
+
+# ============== СЕССИИ ==============
+# user_id / chat_id -> time.monotonic() последнего апдейта
+_user_last_seen = {}
+_chat_last_seen = {}
+
+# Последние показания сборщика неактивных сессий
+session_stats = {
+    'users': 0,
+    'bytes_total': 0,
+    'bytes_per_user': 0,
+    'evicted_users': 0,
+    'evicted_chats': 0,
+}
+
+
+def approx_size(obj, seen: set = None) -> int:
+    """Примерный размер объекта в памяти вместе с вложенными"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += approx_size(key, seen) + approx_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += approx_size(item, seen)
+    return size
+
+
+def _idle_keys(last_seen: dict, stored, now: float) -> list:
+    """Ключи, неактивные дольше SESSION_TTL"""
+    idle = []
+    for key in list(stored):
+        seen = last_seen.get(key)
+        if seen is None:
+            # Данные без отметки (например, из persistence) — отсчёт с текущего момента
+            last_seen[key] = now
+        elif now - seen > SESSION_TTL:
+            idle.append(key)
+    return idle
+
+
+async def reap_idle_sessions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Вытеснение неактивных user_data/chat_data и подсчёт занятой памяти"""
+    application = context.application
+    now = time.monotonic()
+    
+    idle_users = _idle_keys(_user_last_seen, application.user_data, now)
+    idle_chats = _idle_keys(_chat_last_seen, application.chat_data, now)
+    
+    if (idle_users or idle_chats) and application.persistence:
+        # Сначала сохраняем, чтобы вытеснение не потеряло данные
+        await application.update_persistence()
+    
+    for user_id in idle_users:
+        application.drop_user_data(user_id)
+        del _user_last_seen[user_id]
+    for chat_id in idle_chats:
+        application.drop_chat_data(chat_id)
+        del _chat_last_seen[chat_id]
+    
+    # Отметки пользователей без данных тоже не должны копиться
+    for last_seen in (_user_last_seen, _chat_last_seen):
+        for key in [k for k, seen in last_seen.items() if now - seen > SESSION_TTL]:
+            del last_seen[key]
+    
+    users = len(application.user_data)
+    bytes_total = (
+        sum(approx_size(data) for data in application.user_data.values())
+        + sum(approx_size(data) for data in application.chat_data.values())
+    )
+    session_stats.update(
+        users=users,
+        bytes_total=bytes_total,
+        bytes_per_user=bytes_total // users if users else 0,
+        evicted_users=session_stats['evicted_users'] + len(idle_users),
+        evicted_chats=session_stats['evicted_chats'] + len(idle_chats),
+    )
+    logger.info(
+        "Sessions: %s users, %s bytes (%s per user), evicted %s users / %s chats",
+        users, bytes_total, session_stats['bytes_per_user'], len(idle_users), len(idle_chats)
+    )
+
+
 # ============== ХРАНЕНИЕ ДАННЫХ ==============
+# Кэш хранилища: uid (строка) -> запись; в режиме compact — UserRecord.
+# Файл читается один раз — при первом обращении или фоном после старта.
+_users_cache = None
+# id известных пользователей; при тёплом старте берётся из STATE_FILE без разбора файла
+_known_users = None
+# Номер версии данных, растёт при каждой записи
+store_version = 0
+
+
+def _read_users_file() -> dict:
+    """Содержимое файла пользователей как есть (dict или compact)"""
+    with span("storage.load_users"):
+        if os.path.exists(USERS_FILE):
+            try:
+                with open(USERS_FILE, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                # Повреждённый файл не должен обнулять базу — поднимаем из снимков
+                logger.error("Error loading users, restoring from snapshots: %s", e)
+                return restore_users() or {}
+        return {}
+
+
 def load_users() -> dict:
     """Загрузка данных пользователей"""
-    if os.path.exists(USERS_FILE):
-        try:
-            with open(USERS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
+    return decode_users(_read_users_file())
 
 
 def save_users(users: dict) -> None:
     """Сохранение данных пользователей"""
     try:
-        with open(USERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
+        with span("storage.save_users", **{'users.count': len(users)}):
+            # Пишем во временный файл и подменяем — обрыв записи не портит базу
+            tmp_path = USERS_FILE + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                dump_users(users, f)
+            os.replace(tmp_path, USERS_FILE)
     except Exception as e:
-        logger.error(f"Error saving users: {e}")
+        readiness.storage_failed(e)
+        logger.error("Error saving users: %s", e)
+    else:
+        readiness.storage_written()
+
+
+def _to_cached(data: dict):
+    """Запись в форме для кэша"""
+    return UserRecord.from_dict(data) if USERS_FORMAT == "compact" else data
+
+
+def _from_cached(value) -> dict:
+    """Запись из кэша в виде словаря"""
+    return value.to_dict() if isinstance(value, UserRecord) else value
+
+
+def _load_cache() -> dict:
+    """Чтение файла пользователей в форму кэша"""
+    raw = _read_users_file()
+    if raw.get('format') == COMPACT_FORMAT and USERS_FORMAT == "compact":
+        return {uid: UserRecord.from_row(row) for uid, row in raw['rows'].items()}
+    return {uid: _to_cached(data) for uid, data in decode_users(raw).items()}
+
+
+def _load_cache_with_index() -> tuple:
+    cache = _load_cache()
+    return cache, LeadIndex.build(cache)
+
+
+def _install_users_cache(cache: dict, index: tuple = None) -> None:
+    global _users_cache, _known_users
+    _users_cache = cache
+    _known_users = {int(uid) for uid in cache if uid.lstrip('-').isdigit()}
+    lead_index.install(index if index is not None else LeadIndex.build(cache))
+
+
+def users_store() -> dict:
+    """Кэш хранилища (загружается при первом обращении)"""
+    if _users_cache is None:
+        _install_users_cache(_load_cache())
+    return _users_cache
+
+
+async def preload_users_cache() -> None:
+    """Фоновая загрузка кэша, чтобы не разбирать файл в обработчике"""
+    if _users_cache is not None:
+        return
+    cache, index = await asyncio.to_thread(_load_cache_with_index)
+    # Пока файл читался, обработчик мог загрузить кэш сам — его не трогаем
+    if _users_cache is None:
+        _install_users_cache(cache, index)
+        logger.info("Users cache loaded: %s records", len(cache))
 
 
 def save_user_data(user_id: int, data: dict) -> None:
     """Сохранение данных одного пользователя"""
-    users = load_users()
-    users[str(user_id)] = data
+    global store_version
+    data = upgrade_record(str(user_id), data)
+    users = users_store()
+    users[str(user_id)] = _to_cached(data)
+    lead_index.update(str(user_id), data)
     save_users(users)
-    logger.info(f"User data saved: {user_id}")
+    _known_users.add(int(user_id))
+    _snapshot_dirty.add(str(user_id))
+    store_version += 1
+    logger.info("User data saved: %s", user_id, extra={"sampled": True})
 
 
 def get_user_data(user_id: int) -> dict:
     """Получение данных пользователя"""
-    users = load_users()
-    return users.get(str(user_id), {})
+    value = users_store().get(str(user_id))
+    # Запись старой схемы поднимается при чтении, в файл попадёт при следующем сохранении
+    return upgrade_record(str(user_id), _from_cached(value)) if value is not None else {}
 
 
 def is_new_user(user_id: int) -> bool:
     """Проверка, новый ли пользователь"""
-    users = load_users()
-    return str(user_id) not in users
+    if _known_users is None:
+        users_store()
+    return user_id not in _known_users
+
+
+# ============== КОМПАКТНЫЕ ЗАПИСИ ==============
+_MISSING = object()
+
+
+def _label_codes(labels) -> tuple:
+    """Таблицы код -> подпись и подпись -> код"""
+    values = tuple(labels.values()) if isinstance(labels, dict) else tuple(labels)
+    return values, {label: code for code, label in enumerate(values)}
+
+
+_OBJECT_TYPES, _OBJECT_TYPE_CODES = _label_codes(OBJECT_TYPE_LABELS)
+_AREAS, _AREA_CODES = _label_codes(AREA_LABELS)
+_REGIONS, _REGION_CODES = _label_codes(REGION_LABELS)
+_TIMELINES, _TIMELINE_CODES = _label_codes(TIMELINE_LABELS)
+_INTERESTS, _INTEREST_CODES = _label_codes(INTEREST_LABELS)
+_SOURCES, _SOURCE_CODES = _label_codes(SOURCE_LABELS)
+
+# Поле -> (код -> подпись, подпись -> код) для перечислимых полей
+_ENUM_FIELDS = {
+    'object_type': (_OBJECT_TYPES, _OBJECT_TYPE_CODES),
+    'area': (_AREAS, _AREA_CODES),
+    'region': (_REGIONS, _REGION_CODES),
+    'timeline': (_TIMELINES, _TIMELINE_CODES),
+    'source': (_SOURCES, _SOURCE_CODES),
+}
+
+# Поля, где число означает закодированное значение
+_CODED_FIELDS = frozenset(_ENUM_FIELDS) | {'interests', 'first_contact'}
+
+# Интересы упаковываются в одно число по 3 бита на пункт (код + 1),
+# так сохраняется порядок выбора
+_INTEREST_BITS = 3
+
+
+def _pack_interests(interests):
+    """Список интересов -> число, если все подписи известны"""
+    if not isinstance(interests, list) or len(set(interests)) != len(interests):
+        return interests
+    packed = 0
+    for interest in reversed(interests):
+        code = _INTEREST_CODES.get(interest) if isinstance(interest, str) else None
+        if code is None:
+            return interests
+        packed = (packed << _INTEREST_BITS) | (code + 1)
+    return packed
+
+
+def _unpack_interests(packed) -> list:
+    """Число -> список интересов"""
+    if type(packed) is not int:
+        return packed
+    interests = []
+    mask = (1 << _INTEREST_BITS) - 1
+    while packed:
+        interests.append(_INTERESTS[(packed & mask) - 1])
+        packed >>= _INTEREST_BITS
+    return interests
+
+
+def _pack_timestamp(value):
+    """«ГГГГ-ММ-ДД ЧЧ:ММ:СС» -> число ГГГГММДДЧЧММСС"""
+    if (isinstance(value, str) and len(value) == 19
+            and value[4] == value[7] == '-' and value[10] == ' '
+            and value[13] == value[16] == ':'):
+        digits = value[0:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19]
+        if digits.isdigit() and digits[0] != '0':
+            return int(digits)
+    return value
+
+
+def _unpack_timestamp(value):
+    """Число ГГГГММДДЧЧММСС -> «ГГГГ-ММ-ДД ЧЧ:ММ:СС»"""
+    if type(value) is not int:
+        return value
+    d = str(value)
+    return f"{d[0:4]}-{d[4:6]}-{d[6:8]} {d[8:10]}:{d[10:12]}:{d[12:14]}"
+
+
+class UserRecord:
+    """Компактная запись пользователя.
+    
+    Перечислимые поля хранятся кодами из *_LABELS, интересы — одним числом,
+    время первого контакта — числом ГГГГММДДЧЧММСС. Отсутствующее поле —
+    незаполненный слот, поэтому to_dict() восстанавливает исходный словарь
+    без потерь. Неизвестные значения хранятся как есть, неизвестные ключи —
+    в extra.
+    """
+    
+    FIELDS = (
+        'user_id', 'username', 'full_name', 'first_contact', 'has_project',
+        'object_type', 'area', 'region', 'timeline', 'interests',
+        'giveaway_participant', 'giveaway_contact', 'survey_completed',
+        'source', 'extra', 'schema',
+    )  # Номер поля — номер бита в строке файла: новые поля только в конец
+    __slots__ = FIELDS
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> 'UserRecord':
+        """Запись из словаря в формате bot_users.json"""
+        record = cls()
+        extra = None
+        for key, value in data.items():
+            if type(value) is int and key in _CODED_FIELDS:
+                # Сырое число в кодируемом поле не отличить от кода
+                extra = extra if extra is not None else {}
+                extra[key] = value
+                continue
+            if key in _ENUM_FIELDS:
+                value = _ENUM_FIELDS[key][1].get(value, value) if isinstance(value, str) else value
+            elif key == 'interests':
+                value = _pack_interests(value)
+            elif key == 'first_contact':
+                value = _pack_timestamp(value)
+            elif key == 'extra' or key not in cls.FIELDS:
+                extra = extra if extra is not None else {}
+                extra[key] = value
+                continue
+            setattr(record, key, value)
+        if extra is not None:
+            record.extra = extra
+        return record
+    
+    def to_dict(self) -> dict:
+        """Словарь в формате bot_users.json"""
+        data = {}
+        for key in self.FIELDS:
+            value = getattr(self, key, _MISSING)
+            if value is _MISSING or key == 'extra':
+                continue
+            if key in _ENUM_FIELDS:
+                value = _ENUM_FIELDS[key][0][value] if type(value) is int else value
+            elif key == 'interests':
+                value = _unpack_interests(value)
+            elif key == 'first_contact':
+                value = _unpack_timestamp(value)
+            data[key] = value
+        extra = getattr(self, 'extra', None)
+        if extra:
+            data.update(extra)
+        return data
+    
+    def to_row(self) -> list:
+        """Строка для файла: маска заполненных полей и их значения"""
+        mask = 0
+        row = [0]
+        for bit, key in enumerate(self.FIELDS):
+            value = getattr(self, key, _MISSING)
+            if value is not _MISSING:
+                mask |= 1 << bit
+                row.append(value)
+        row[0] = mask
+        return row
+    
+    @classmethod
+    def from_row(cls, row: list) -> 'UserRecord':
+        """Запись из строки to_row()"""
+        record = cls()
+        mask = row[0]
+        values = iter(row[1:])
+        for bit, key in enumerate(cls.FIELDS):
+            if mask & (1 << bit):
+                setattr(record, key, next(values))
+        return record
+
+
+COMPACT_FORMAT = "compact-v1"
+
+
+def decode_users(raw: dict) -> dict:
+    """Содержимое файла пользователей -> словари записей"""
+    if raw.get('format') == COMPACT_FORMAT:
+        return {uid: UserRecord.from_row(row).to_dict() for uid, row in raw['rows'].items()}
+    return raw
+
+
+def dump_users(users: dict, f) -> None:
+    """Запись пользователей в файл в формате USERS_FORMAT"""
+    if USERS_FORMAT == "compact":
+        json.dump({
+            'format': COMPACT_FORMAT,
+            'fields': UserRecord.FIELDS,
+            'rows': {
+                uid: (data if isinstance(data, UserRecord) else UserRecord.from_dict(data)).to_row()
+                for uid, data in users.items()
+            },
+        }, f, ensure_ascii=False, separators=(',', ':'))
+    else:
+        json.dump({uid: _from_cached(data) for uid, data in users.items()},
+                  f, ensure_ascii=False, indent=2)
+
+
+# ============== СХЕМА ЗАПИСЕЙ ==============
+# Версия схемы хранится в поле schema; запись без него — версия 1.
+# Старая запись поднимается до текущей версии при чтении (get_user_data)
+# и сохраняется уже новой, поэтому смена схемы не требует остановки бота.
+# python main.py migrate переписывает весь файл за один потоковый проход.
+SCHEMA_VERSION = 2
+
+
+def _migrate_v1(uid: str, data: dict) -> dict:
+    """1 -> 2: общие поля есть в каждой записи, какой бы веткой она ни была записана"""
+    data = dict(data)
+    if data.get('user_id') is None and uid.lstrip('-').isdigit():
+        data['user_id'] = int(uid)
+    data.setdefault('has_project', None)
+    data.setdefault('survey_completed', False)
+    data.setdefault('source', 'survey' if data['survey_completed'] else None)
+    data.setdefault('giveaway_participant', False)
+    if data['has_project'] is False:
+        data.setdefault('interests', [])
+    return data
+
+
+# Версия -> функция, поднимающая запись этой версии на следующую.
+# Готовые миграции не меняются: новая схема — новая функция.
+MIGRATIONS = {
+    1: _migrate_v1,
+}
+
+
+def upgrade_record(uid: str, data: dict) -> dict:
+    """Запись в текущей схеме; исходный словарь не меняется"""
+    version = data.get('schema', 1)
+    if version >= SCHEMA_VERSION:
+        return data
+    while version < SCHEMA_VERSION:
+        data = MIGRATIONS[version](uid, data)
+        version += 1
+    return dict(data, schema=SCHEMA_VERSION)
+
+
+def new_user_record(context, **fields) -> dict:
+    """Новая запись пользователя в текущей схеме: общие поля и поля ветки анкеты"""
+    record = {
+        'user_id': context.user_data.get('user_id'),
+        'username': context.user_data.get('username'),
+        'full_name': context.user_data.get('full_name'),
+        'first_contact': context.user_data.get('first_contact'),
+        'has_project': None,
+        'survey_completed': False,
+        'source': None,
+        'giveaway_participant': False,
+    }
+    record.update(fields)
+    record['schema'] = SCHEMA_VERSION
+    return record
+
+
+class UsersFileReader:
+    """Потоковое чтение файла пользователей (json или compact) по одной записи.
+    
+    В памяти только буфер чтения и текущая запись. offset — смещение
+    в байтах сразу после последней отданной записи: с него чтение
+    продолжается после перерыва (resume).
+    """
+    CHUNK_SIZE = 1 << 16
+    _WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, f, resume: tuple = None):
+        """f — файл, открытый как rb; resume — (offset, compact) из контрольной точки"""
+        self._f = f
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ""
+        self._pos = 0
+        self._base = 0  # байт файла до начала буфера
+        self._eof = False
+        self._resume = resume is not None
+        self.compact = False
+        if resume is not None:
+            self._base, self.compact = resume
+            f.seek(self._base)
+
+    @property
+    def offset(self) -> int:
+        return self._base + len(self._buffer[:self._pos].encode('utf-8'))
+
+    def _fill(self) -> bool:
+        """Дочитать фрагмент файла; False — файл кончился"""
+        if self._eof:
+            return False
+        chunk = self._f.read(self.CHUNK_SIZE)
+        if self._pos:
+            # Разобранное начало буфера больше не нужно
+            self._base += len(self._buffer[:self._pos].encode('utf-8'))
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        self._buffer += self._utf8.decode(chunk, final=not chunk)
+        self._eof = not chunk
+        return bool(chunk)
+
+    def _char(self) -> str:
+        """Следующий значимый символ (курсор остаётся на нём)"""
+        while True:
+            self._pos = self._WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError(f"unexpected end of users file at byte {self.offset}")
+
+    def _expect(self, char: str) -> None:
+        if self._char() != char:
+            raise ValueError(f"expected {char!r} at byte {self.offset}")
+        self._pos += 1
+
+    def _value(self):
+        self._char()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            if end == len(self._buffer) and not isinstance(value, (dict, list, str)) and self._fill():
+                continue  # число могло оборваться на границе фрагмента
+            self._pos = end
+            return value
+
+    def _pairs(self, after_value: bool):
+        """Пары объекта; курсор — после «{» или после значения предыдущей пары"""
+        while True:
+            if self._char() == '}':
+                self._pos += 1
+                return
+            if after_value:
+                self._expect(',')
+            key = self._value()
+            self._expect(':')
+            yield key, self._value()
+            after_value = True
+
+    def _rows(self, after_value: bool):
+        for uid, row in self._pairs(after_value):
+            yield uid, UserRecord.from_row(row).to_dict()
+
+    def __iter__(self):
+        """(uid, запись-словарь) по порядку файла"""
+        if self._resume:
+            yield from self._rows(True) if self.compact else self._pairs(True)
+            return
+        self._expect('{')
+        if self._char() == '}':
+            return
+        key = self._value()
+        self._expect(':')
+        if key != 'format':
+            # json: на верхнем уровне сразу id пользователей
+            yield key, self._value()
+            yield from self._pairs(True)
+            return
+        if self._value() != COMPACT_FORMAT:
+            raise ValueError("unknown users file format")
+        self.compact = True
+        while True:
+            self._expect(',')
+            key = self._value()
+            self._expect(':')
+            if key == 'rows':
+                self._expect('{')
+                yield from self._rows(False)
+                return
+            self._value()  # fields и другие служебные ключи
+
+
+class UsersFileWriter:
+    """Потоковая запись файла пользователей (json или compact)"""
+
+    def __init__(self, f, compact: bool, records: int = 0):
+        """f — файл, открытый как wb; records — сколько записей уже в файле (resume)"""
+        self._f = f
+        self.compact = compact
+        self.records = records
+
+    def header(self) -> None:
+        if self.compact:
+            fields = json.dumps(UserRecord.FIELDS, separators=(',', ':'))
+            self._f.write(f'{{"format":"{COMPACT_FORMAT}","fields":{fields},"rows":{{'.encode('utf-8'))
+        else:
+            self._f.write(b'{')
+
+    def write(self, uid: str, data: dict) -> None:
+        separator = "," if self.records else ""
+        key = json.dumps(uid, ensure_ascii=False)
+        if self.compact:
+            row = json.dumps(UserRecord.from_dict(data).to_row(), ensure_ascii=False, separators=(',', ':'))
+            line = f"{separator}{key}:{row}"
+        else:
+            line = f"{separator}\n  {key}: {json.dumps(data, ensure_ascii=False)}"
+        self._f.write(line.encode('utf-8'))
+        self.records += 1
+
+    def close(self) -> None:
+        self._f.write(b'}}' if self.compact else b'\n}\n')
+
+
+def migrate_users(checkpoint_every: int = None) -> Counter:
+    """Поднять все записи USERS_FILE до SCHEMA_VERSION за один проход.
+    
+    Новый файл пишется рядом (.migrating) в формате USERS_FORMAT и подменяет
+    старый в конце. Каждые checkpoint_every записей сохраняется контрольная
+    точка (.migrate.json): прерванная миграция продолжится с неё, если файл
+    пользователей с тех пор не менялся. Если бот записал файл во время
+    миграции, результат отбрасывается — RuntimeError.
+    """
+    checkpoint_every = checkpoint_every or MIGRATION_CHECKPOINT_EVERY
+    output_path = USERS_FILE + ".migrating"
+    checkpoint_path = USERS_FILE + ".migrate.json"
+    signature = _users_file_signature()
+    if signature is None:
+        raise FileNotFoundError(USERS_FILE)
+    compact = USERS_FORMAT == "compact"
+    
+    try:
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, ValueError):
+        checkpoint = None
+    if checkpoint is not None and (
+            [checkpoint['input'], checkpoint['schema'], checkpoint['compact_output']] != [signature, SCHEMA_VERSION, compact]
+            or not os.path.exists(output_path)):
+        logger.warning("Migration checkpoint does not match the users file, starting over")
+        checkpoint = None
+    
+    stats = Counter(checkpoint['stats'] if checkpoint else {})
+    with open(USERS_FILE, 'rb') as source, open(output_path, 'r+b' if checkpoint else 'wb') as target:
+        if checkpoint:
+            target.truncate(checkpoint['output_size'])
+            target.seek(checkpoint['output_size'])
+            reader = UsersFileReader(source, resume=(checkpoint['input_offset'], checkpoint['compact_input']))
+            writer = UsersFileWriter(target, compact, records=stats['records'])
+            stats['resumed'] += 1
+            logger.info("Migration resumed after %s records", stats['records'])
+        else:
+            reader = UsersFileReader(source)
+            writer = UsersFileWriter(target, compact)
+            writer.header()
+        
+        for uid, data in reader:
+            upgraded = upgrade_record(uid, data)
+            stats['upgraded'] += upgraded is not data
+            writer.write(uid, upgraded)
+            stats['records'] += 1
+            if stats['records'] % checkpoint_every == 0:
+                target.flush()
+                os.fsync(target.fileno())
+                _write_atomic(checkpoint_path, json.dumps({
+                    'input': signature, 'schema': SCHEMA_VERSION,
+                    'compact_input': reader.compact, 'compact_output': compact,
+                    'input_offset': reader.offset, 'output_size': target.tell(),
+                    'stats': stats,
+                }).encode('utf-8'))
+                logger.info("Migration checkpoint: %s records", stats['records'])
+        writer.close()
+        target.flush()
+        os.fsync(target.fileno())
+    
+    if _users_file_signature() != signature:
+        os.remove(output_path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(checkpoint_path)
+        raise RuntimeError("users file was rewritten during migration, run it again")
+    os.replace(output_path, USERS_FILE)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(checkpoint_path)
+    return stats
+
+
+def migrate_command() -> None:
+    """python main.py migrate — поднять записи USERS_FILE до текущей схемы"""
+    try:
+        stats = migrate_users()
+    except FileNotFoundError:
+        logger.error("No users file %s", USERS_FILE)
+        return
+    except (RuntimeError, ValueError) as e:
+        logger.error("Migration failed: %s", e)
+        return
+    logger.info("Users file migrated to schema %s: %s records, %s upgraded",
+                SCHEMA_VERSION, stats['records'], stats['upgraded'])
+
+
+# ============== СНИМКИ ДАННЫХ ==============
+# Полный снимок — все записи; дельта — только записи, изменённые после
+# предыдущего снимка или дельты (None — запись удалена). Контрольные суммы
+# SHA-256 сжатых файлов хранятся в manifest.json.
+SNAPSHOT_MANIFEST = "manifest.json"
+
+# Пользователи, изменённые после последнего снимка
+_snapshot_dirty = set()
+
+_COMPRESSORS = {
+    'gzip': ('.json.gz', gzip.compress, gzip.decompress),
+    'lzma': ('.json.xz', lzma.compress, lzma.decompress),
+}
+
+
+def _read_manifest(directory: str) -> list:
+    """Записи манифеста снимков, от старых к новым"""
+    try:
+        with open(os.path.join(directory, SNAPSHOT_MANIFEST), 'r', encoding='utf-8') as f:
+            return json.load(f)['entries']
+    except FileNotFoundError:
+        return []
+
+
+def _write_atomic(path: str, payload: bytes) -> None:
+    """Запись файла через временный с подменой"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def take_snapshot(users: dict, dirty: set, directory: str = None, full: bool = None) -> dict:
+    """Снимок или дельта в каталоге снимков; возвращает запись манифеста.
+    
+    Без явного full полный снимок делается, если его ещё нет или после
+    последнего накопилось SNAPSHOT_FULL_EVERY дельт. Пустая дельта не пишется.
+    """
+    directory = directory or SNAPSHOT_DIR
+    os.makedirs(directory, exist_ok=True)
+    entries = _read_manifest(directory)
+    fulls = [e for e in entries if e['kind'] == 'full']
+    
+    if full is None:
+        deltas_since = len(entries) - entries.index(fulls[-1]) - 1 if fulls else 0
+        full = not fulls or deltas_since >= SNAPSHOT_FULL_EVERY
+    if not full and not dirty:
+        return None
+    
+    seq = entries[-1]['seq'] + 1 if entries else 1
+    kind = 'full' if full else 'delta'
+    records = users if full else {uid: users.get(uid) for uid in dirty}
+    base = seq if full else fulls[-1]['seq']
+    
+    suffix, compress, _ = _COMPRESSORS[SNAPSHOT_COMPRESSION]
+    payload = compress(json.dumps(
+        {'seq': seq, 'kind': kind, 'base': base, 'users': records},
+        ensure_ascii=False, separators=(',', ':')
+    ).encode('utf-8'))
+    
+    file_name = f"{kind}-{seq:08d}{suffix}"
+    with span("storage.snapshot", **{'snapshot.kind': kind, 'snapshot.records': len(records)}):
+        _write_atomic(os.path.join(directory, file_name), payload)
+    
+    entry = {
+        'seq': seq,
+        'kind': kind,
+        'base': base,
+        'file': file_name,
+        'sha256': hashlib.sha256(payload).hexdigest(),
+        'records': len(records),
+        'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    entries.append(entry)
+    
+    # Храним SNAPSHOT_KEEP последних полных снимков вместе с их дельтами
+    fulls = [e for e in entries if e['kind'] == 'full']
+    if len(fulls) > SNAPSHOT_KEEP:
+        oldest_kept = fulls[-SNAPSHOT_KEEP]['seq']
+        for old in [e for e in entries if e['base'] < oldest_kept]:
+            entries.remove(old)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(directory, old['file']))
+    
+    _write_atomic(
+        os.path.join(directory, SNAPSHOT_MANIFEST),
+        json.dumps({'entries': entries}, ensure_ascii=False, indent=2).encode('utf-8')
+    )
+    return entry
+
+
+def _read_snapshot_file(directory: str, entry: dict) -> dict:
+    """Содержимое файла снимка с проверкой контрольной суммы"""
+    with open(os.path.join(directory, entry['file']), 'rb') as f:
+        payload = f.read()
+    if hashlib.sha256(payload).hexdigest() != entry['sha256']:
+        raise ValueError(f"checksum mismatch in {entry['file']}")
+    decompress = lzma.decompress if entry['file'].endswith('.xz') else gzip.decompress
+    return json.loads(decompress(payload))
+
+
+def restore_users(directory: str = None) -> dict:
+    """Состояние из последнего целого полного снимка и его дельт.
+    
+    Повреждённый полный снимок пропускается в пользу предыдущего, дельты
+    применяются по порядку до первой повреждённой. None — снимков нет.
+    """
+    directory = directory or SNAPSHOT_DIR
+    if not directory:
+        return None
+    try:
+        entries = _read_manifest(directory)
+    except (OSError, ValueError) as e:
+        logger.error("Snapshot manifest unreadable: %s", e)
+        return None
+    
+    for full in reversed([e for e in entries if e['kind'] == 'full']):
+        try:
+            users = _read_snapshot_file(directory, full)['users']
+        except (OSError, ValueError, EOFError, lzma.LZMAError) as e:
+            logger.error("Snapshot %s is damaged, trying previous: %s", full['file'], e)
+            continue
+        
+        applied = 0
+        for delta in entries:
+            if delta['kind'] != 'delta' or delta['base'] != full['seq']:
+                continue
+            try:
+                changes = _read_snapshot_file(directory, delta)['users']
+            except (OSError, ValueError, EOFError, lzma.LZMAError) as e:
+                logger.error("Delta %s is damaged, stopping restore there: %s", delta['file'], e)
+                break
+            for uid, record in changes.items():
+                if record is None:
+                    users.pop(uid, None)
+                else:
+                    users[uid] = record
+            applied += 1
+        
+        logger.info("Restored %s users from %s and %s deltas", len(users), full['file'], applied)
+        return users
+    return None
+
+
+def _take_dirty() -> set:
+    """Забрать набор изменённых пользователей (в потоке событийного цикла)"""
+    global _snapshot_dirty
+    dirty, _snapshot_dirty = _snapshot_dirty, set()
+    return dirty
+
+
+def _write_snapshot(users: dict, dirty: set, full: bool = None) -> None:
+    """Снимок с возвратом изменений в очередь при ошибке"""
+    try:
+        take_snapshot({uid: _from_cached(v) for uid, v in users.items()}, dirty, full=full)
+    except Exception as e:
+        _snapshot_dirty.update(dirty)
+        logger.error("Snapshot failed: %s", e)
+
+
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодический снимок данных пользователей"""
+    if _users_cache is None:
+        # База ещё грузится в фоне: изменений не было, а синхронно разбирать
+        # файл в событийном цикле нельзя — снимок будет на следующем запуске
+        return
+    # Записи в кэше заменяются целиком, поэтому поверхностной копии достаточно
+    users = dict(_users_cache)
+    await asyncio.to_thread(_write_snapshot, users, _take_dirty())
+
+
+def flush_snapshot(full: bool = None) -> None:
+    """Записать накопленные изменения снимком или дельтой"""
+    if SNAPSHOT_DIR and _users_cache is not None:
+        _write_snapshot(_users_cache, _take_dirty(), full)
+
+
+def restore_command() -> None:
+    """python main.py restore — пересобрать USERS_FILE из снимков"""
+    users = restore_users()
+    if users is None:
+        logger.error("No usable snapshots in %s", SNAPSHOT_DIR)
+        return
+    save_users(users)
+    logger.info("Users file rebuilt from snapshots: %s records", len(users))
+
+
+# ============== ЖУРНАЛ ИДЕМПОТЕНТНОСТИ ==============
+class RingSet:
+    """Множество последних size чисел: кольцевой буфер array('q') + set"""
+    __slots__ = ('_ring', '_members', '_pos', '_count')
+
+    def __init__(self, size: int):
+        self._ring = array('q', bytes(8 * size))
+        self._members = set()
+        self._pos = 0
+        self._count = 0
+
+    def __contains__(self, value: int) -> bool:
+        return value in self._members
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, value: int) -> bool:
+        """Добавить значение; False — оно уже было"""
+        if value in self._members:
+            return False
+        if self._count == len(self._ring):
+            # Буфер полон — вытесняем самое старое значение
+            self._members.discard(self._ring[self._pos])
+        else:
+            self._count += 1
+        self._ring[self._pos] = value
+        self._members.add(value)
+        self._pos = (self._pos + 1) % len(self._ring)
+        return True
+
+    def values(self) -> list:
+        """Значения от старых к новым"""
+        ring = self._ring.tolist()
+        if self._count < len(ring):
+            return ring[:self._count]
+        return ring[self._pos:] + ring[:self._pos]
+
+
+class UpdateJournal:
+    """Журнал обработанных update_id и отпечатков отправленных заявок.
+    
+    Записи дописываются в файл по 9 байт (тип + int64) с flush после каждой,
+    поэтому переживают падение процесса. При открытии файл перечитывается
+    и сжимается до содержимого кольцевых буферов.
+    """
+    _RECORD = struct.Struct('<cq')
+    _UPDATE = b'U'
+    _LEAD = b'L'
+
+    def __init__(self, size: int):
+        self.size = size
+        self.updates = RingSet(size)
+        self.leads = RingSet(size)
+        self.last_update_id = 0
+        self._path = None
+        self._file = None
+        self._records_in_file = 0
+
+    def open(self, path: str) -> None:
+        """Загрузить журнал из файла и продолжить запись в него"""
+        self._path = path
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                payload = f.read()
+            # Недописанная последняя запись отбрасывается
+            usable = len(payload) - len(payload) % self._RECORD.size
+            for kind, value in self._RECORD.iter_unpack(payload[:usable]):
+                self._apply(kind, value)
+        self._compact()
+        logger.info("Journal loaded: %s updates, %s leads", len(self.updates), len(self.leads))
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _apply(self, kind: bytes, value: int) -> bool:
+        if kind == self._UPDATE:
+            self.last_update_id = max(self.last_update_id, value)
+            return self.updates.add(value)
+        return self.leads.add(value)
+
+    def _compact(self) -> None:
+        """Переписать файл только текущим содержимым буферов"""
+        self.close()
+        records = [self._RECORD.pack(self._UPDATE, v) for v in self.updates.values()]
+        records += [self._RECORD.pack(self._LEAD, v) for v in self.leads.values()]
+        _write_atomic(self._path, b''.join(records))
+        self._records_in_file = len(records)
+        self._file = open(self._path, 'ab')
+
+    def _append(self, kind: bytes, value: int) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.write(self._RECORD.pack(kind, value))
+            self._file.flush()
+            self._records_in_file += 1
+            if self._records_in_file > 4 * self.size:
+                self._compact()
+        except OSError as e:
+            logger.error("Journal write failed: %s", e)
+
+    def has_update(self, update_id: int) -> bool:
+        return update_id in self.updates
+
+    def record_update(self, update_id: int) -> bool:
+        """Отметить апдейт обработанным; False — он уже был"""
+        if not self._apply(self._UPDATE, update_id):
+            return False
+        self._append(self._UPDATE, update_id)
+        return True
+
+    def has_lead(self, fingerprint: int) -> bool:
+        return fingerprint in self.leads
+
+    def record_lead(self, fingerprint: int) -> None:
+        """Отметить заявку отправленной"""
+        if self._apply(self._LEAD, fingerprint):
+            self._append(self._LEAD, fingerprint)
+
+
+update_journal = UpdateJournal(JOURNAL_SIZE)
+
+
+def lead_fingerprint(kind: str, user_id, fields: dict, update_id: int) -> int:
+    """Отпечаток заявки: повторная доставка того же апдейта даёт то же число.
+    
+    update_id входит в отпечаток, чтобы та же форма, отправленная
+    пользователем заново, считалась новой заявкой, а не дублем.
+    """
+    payload = json.dumps([kind, user_id, fields, update_id], ensure_ascii=False, sort_keys=True, default=str)
+    digest = hashlib.blake2b(payload.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+async def drop_duplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Повторно доставленный апдейт не доходит до обработчиков.
+    
+    Обработанным апдейт отмечается только после всех обработчиков
+    (BotApplication.process_update): прерванный падением придёт снова.
+    """
+    if update_journal.has_update(update.update_id):
+        logger.info("Duplicate update %s dropped", update.update_id)
+        raise ApplicationHandlerStop
+
+
+# ============== АНТИФЛУД ==============
+def is_admin(update: Update) -> bool:
+    """Апдейт от администратора или из служебного чата"""
+    user = update.effective_user
+    chat = update.effective_chat
+    if user and user.id in ADMIN_USER_IDS:
+        return True
+    return bool(chat) and str(chat.id) in {MANAGER_CHAT_ID, ADMIN_CHAT_ID, *manager_pool.chats} - {""}
+
+
+class TokenBucket:
+    """Корзина токенов: capacity штук, восполняется за period секунд"""
+    __slots__ = ('capacity', 'rate', 'tokens', 'stamp')
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now: float = None) -> bool:
+        """Списать токен; False — лимит исчерпан"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self, now: float = None) -> float:
+        """Секунд до появления токена"""
+        self._refill(time.monotonic() if now is None else now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+def parse_flood_limits(spec: str) -> dict:
+    """«message=8/10,callback=15/10» -> {'message': (8.0, 10.0), ...}"""
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        kind, _, value = item.partition("=")
+        capacity, _, period = value.partition("/")
+        limits[kind.strip()] = (float(capacity), float(period))
+    return limits
+
+
+class _FloodEntry:
+    __slots__ = ('buckets', 'warned', 'media_group')
+
+    def __init__(self):
+        self.buckets = {}
+        self.warned = False
+        self.media_group = None  # последний пропущенный альбом
+
+
+class FloodLimiter:
+    """Лимиты по пользователям с вытеснением давно неактивных (LRU)"""
+
+    def __init__(self, limits: dict, max_users: int):
+        self.limits = limits
+        self.max_users = max_users
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _entry(self, user_id: int) -> _FloodEntry:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = self._entries[user_id] = _FloodEntry()
+            if len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(user_id)
+        return entry
+
+    def allow(self, user_id: int, kind: str, media_group: str = None) -> bool:
+        """Можно ли обработать апдейт этого типа.
+        
+        Файлы одного альбома (media_group) приходят отдельными апдейтами,
+        но списывают один токен — альбом до 10 файлов не обрывается лимитом.
+        """
+        limit = self.limits.get(kind)
+        if limit is None:
+            return True
+        entry = self._entry(user_id)
+        if media_group is not None and media_group == entry.media_group:
+            return True
+        bucket = entry.buckets.get(kind)
+        if bucket is None:
+            bucket = entry.buckets[kind] = TokenBucket(*limit)
+        if bucket.take():
+            entry.warned = False
+            if media_group is not None:
+                entry.media_group = media_group
+            return True
+        return False
+
+    def should_warn(self, user_id: int) -> bool:
+        """Предупреждать один раз за серию отброшенных апдейтов"""
+        entry = self._entry(user_id)
+        if entry.warned:
+            return False
+        entry.warned = True
+        return True
+
+
+flood_limiter = FloodLimiter(parse_flood_limits(FLOOD_LIMITS), FLOOD_MAX_USERS)
+
+# Тип апдейта -> сколько отброшено; 'warnings' — отправлено предупреждений
+flood_stats = Counter()
+
+
+def _update_kind(update: Update):
+    """Тип апдейта для лимитов"""
+    if update.callback_query:
+        return 'callback'
+    message = update.message
+    if message is None:
+        return None
+    if message.document or message.photo:
+        return 'file'
+    if message.text and message.text.startswith('/'):
+        return 'command'
+    return 'message'
+
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отбрасывание апдейтов сверх лимита до всех обработчиков"""
+    kind = _update_kind(update)
+    user = update.effective_user
+    if kind is None or user is None or is_admin(update):
+        return
+    media_group = update.message.media_group_id if kind == 'file' else None
+    if flood_limiter.allow(user.id, kind, media_group):
+        return
+    
+    flood_stats[kind] += 1
+    logger.info("Throttled %s from user %s", kind, user.id, extra={"sampled": True})
+    
+    warn = FLOOD_MODE == "reply" and flood_limiter.should_warn(user.id)
+    if warn:
+        flood_stats['warnings'] += 1
+    try:
+        if update.callback_query:
+            # Отвечаем всегда, иначе у кнопки останется «часики»
+            await update.callback_query.answer(
+                "⏳ Слишком часто, подождите немного" if warn else None
+            )
+        elif warn and kind == 'file':
+            # Файл пропал бы посреди формы заявки незаметно — говорим, что его нет
+            await update.message.reply_text(
+                "⏳ Слишком много файлов подряд — часть не принята. "
+                "Подождите немного и отправьте их снова."
+            )
+        elif warn:
+            await update.message.reply_text(
+                "⏳ Слишком много сообщений. Подождите немного и попробуйте снова."
+            )
+    except Exception as e:
+        logger.error("Failed to answer throttled update: %s", e)
+    raise ApplicationHandlerStop
+
+
+# ============== ТЁПЛЫЙ ПЕРЕЗАПУСК ==============
+def _users_file_signature():
+    """(mtime_ns, размер) файла пользователей — признак, что он не менялся"""
+    try:
+        stat = os.stat(USERS_FILE)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def save_warm_state() -> None:
+    """Сохранение смещения апдейтов, известных пользователей и счётчиков"""
+    state = {
+        'saved_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'last_update_id': update_journal.last_update_id,
+        'users_file': _users_file_signature(),
+        'counters': {
+            'flood': dict(flood_stats),
+            'manager_queue': manager_queue.wait_stats,
+            'sessions': {
+                'evicted_users': session_stats['evicted_users'],
+                'evicted_chats': session_stats['evicted_chats'],
+            },
+        },
+        # Неподтверждённые лиды — иначе после рестарта их менеджер считался бы свободным
+        'manager_pool': manager_pool.state(),
+    }
+    try:
+        if _known_users is not None:
+            # Множество пользователей — бинарным массивом: читается за миллисекунды
+            _write_atomic(STATE_FILE + ".members", array('q', _known_users).tobytes())
+            state['members'] = len(_known_users)
+        _write_atomic(STATE_FILE, json.dumps(state, ensure_ascii=False, indent=2).encode('utf-8'))
+        logger.info("Warm state saved: %s members, last update %s",
+                    state.get('members'), state['last_update_id'])
+    except OSError as e:
+        logger.error("Failed to save warm state: %s", e)
+
+
+def load_warm_state() -> dict:
+    """Восстановление состояния, сохранённого при остановке"""
+    global _known_users
+    try:
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.error("Warm state unreadable, starting cold: %s", e)
+        return {}
+    
+    # Множество пользователей годится, только если файл с тех пор не менялся
+    if 'members' in state and state.get('users_file') == _users_file_signature():
+        members = array('q')
+        try:
+            with open(STATE_FILE + ".members", 'rb') as f:
+                members.frombytes(f.read())
+        except (OSError, ValueError) as e:
+            logger.error("Warm members unreadable: %s", e)
+        else:
+            if len(members) == state['members']:
+                _known_users = set(members)
+    
+    counters = state.get('counters', {})
+    flood_stats.update(counters.get('flood', {}))
+    for name, stats in counters.get('manager_queue', {}).items():
+        if name in manager_queue.wait_stats:
+            manager_queue.wait_stats[name].update(stats)
+    manager_pool.restore(state.get('manager_pool', {}))
+    session_stats.update(counters.get('sessions', {}))
+    
+    logger.info("Warm state loaded: %s members (%s), last update %s",
+                len(_known_users) if _known_users is not None else 0,
+                "warm" if _known_users is not None else "stale, will rebuild",
+                state.get('last_update_id'))
+    return state
+
+
+async def resume_update_offset(application: Application, state: dict) -> None:
+    """Подтвердить Telegram уже обработанные апдейты, чтобы они не пришли снова"""
+    last_update_id = max(update_journal.last_update_id, state.get('last_update_id') or 0)
+    if not last_update_id:
+        return
+    try:
+        # getUpdates со смещением подтверждает всё, что меньше него
+        await application.bot.get_updates(offset=last_update_id + 1, limit=1, timeout=0)
+        logger.info("Resumed polling after update %s", last_update_id)
+    except Exception as e:
+        logger.error("Failed to resume update offset: %s", e)
+
+
+# ============== ИНДЕКС ЛИДОВ ==============
+# Записи пользователей, упорядоченные по (first_contact, uid), для постраничного
+# чтения без обхода всего хранилища. Индекс строится вместе с кэшем и
+# обновляется при сохранении записи; читают его и поток health-сервера.
+LEADS_PAGE_SIZE = 50
+LEADS_MAX_PAGE_SIZE = 500
+
+
+def _cached_field(value, key: str):
+    """Поле записи кэша без распаковки всей записи"""
+    if not isinstance(value, UserRecord):
+        return value.get(key)
+    extra = getattr(value, 'extra', None)
+    if extra and key in extra:
+        return extra[key]
+    field = getattr(value, key, None)
+    if key in _ENUM_FIELDS and type(field) is int:
+        return _ENUM_FIELDS[key][0][field]
+    if key == 'first_contact':
+        return _unpack_timestamp(field)
+    return field
+
+
+def encode_cursor(key: tuple) -> str:
+    """Ключ последней выданной записи -> непрозрачный курсор"""
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Курсор -> ключ; ValueError, если курсор испорчен"""
+    try:
+        first_contact, uid = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError(f"bad cursor: {cursor!r}") from None
+    if not isinstance(first_contact, str) or not isinstance(uid, str):
+        raise ValueError(f"bad cursor: {cursor!r}")
+    return first_contact, uid
+
+
+class LeadFilter:
+    """Условия выборки лидов; пустые поля не проверяются"""
+    __slots__ = ('since', 'until', 'region', 'has_project')
+
+    def __init__(self, since: str = None, until: str = None, region: str = None, has_project=_MISSING):
+        self.since = since  # ГГГГ-ММ-ДД включительно
+        self.until = until  # ГГГГ-ММ-ДД включительно
+        self.region = region.casefold() if region else None
+        self.has_project = has_project
+
+    def matches(self, attrs: tuple) -> bool:
+        region, has_project = attrs
+        if self.region is not None and (region or "").casefold() != self.region:
+            return False
+        return self.has_project is _MISSING or has_project is self.has_project
+
+
+class LeadIndex:
+    """Отсортированный индекс лидов для постраничной выдачи"""
+    
+    # Сколько ключей копировать под блокировкой за раз
+    SCAN_CHUNK = 512
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []   # [(first_contact, uid)], по возрастанию
+        self._attrs = {}  # uid -> (first_contact, region, has_project)
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @staticmethod
+    def _entry(value) -> tuple:
+        return (
+            _cached_field(value, 'first_contact') or "",
+            _cached_field(value, 'region'),
+            _cached_field(value, 'has_project'),
+        )
+
+    @classmethod
+    def build(cls, cache: dict) -> tuple:
+        """(ключи, атрибуты) для всего кэша"""
+        attrs = {uid: cls._entry(value) for uid, value in cache.items()}
+        keys = sorted((entry[0], uid) for uid, entry in attrs.items())
+        return keys, attrs
+
+    def install(self, index: tuple) -> None:
+        with self._lock:
+            self._keys, self._attrs = index
+            self.ready = True
+
+    def update(self, uid: str, data: dict) -> None:
+        """Учесть сохранённую запись"""
+        if not self.ready:
+            return
+        entry = self._entry(data)
+        with self._lock:
+            old = self._attrs.get(uid)
+            if old is not None and old[0] != entry[0]:
+                position = bisect.bisect_left(self._keys, (old[0], uid))
+                del self._keys[position]
+            if old is None or old[0] != entry[0]:
+                bisect.insort(self._keys, (entry[0], uid))
+            self._attrs[uid] = entry
+
+    def page(self, lead_filter: LeadFilter, after: tuple = None, limit: int = LEADS_PAGE_SIZE,
+             descending: bool = False) -> tuple:
+        """([(first_contact, uid), ...], курсор следующей страницы или None).
+        
+        after — ключ, после которого (в порядке обхода) начинается страница.
+        """
+        since = lead_filter.since
+        until = f"{lead_filter.until}\uffff" if lead_filter.until else None
+        if after is None:
+            # Без курсора начинаем с границы диапазона дат
+            if descending:
+                after = (until, "") if until else None
+            elif since:
+                after = (since, "")
+        
+        found = []
+        while len(found) < limit:
+            with self._lock:
+                if descending:
+                    end = len(self._keys) if after is None else bisect.bisect_left(self._keys, after)
+                    chunk = self._keys[max(0, end - self.SCAN_CHUNK):end][::-1]
+                else:
+                    start = 0 if after is None else bisect.bisect_right(self._keys, after)
+                    chunk = self._keys[start:start + self.SCAN_CHUNK]
+                attrs = [self._attrs.get(uid) for _, uid in chunk]
+            if not chunk:
+                return found, None
+            for key, entry in zip(chunk, attrs):
+                if descending and since and key[0] < since:
+                    return found, None
+                if not descending and until and key[0] > until:
+                    return found, None
+                if entry is not None and lead_filter.matches(entry[1:]):
+                    found.append(key)
+                    if len(found) == limit:
+                        return found, encode_cursor(key)
+            after = chunk[-1]
+        return found, None
+
+
+lead_index = LeadIndex()
+
+
+# ============== ПОЛНОТЕКСТОВЫЙ ПОИСК ==============
+# Тексты пользователей дописываются в TEXTS_FILE и попадают в инвертированный
+# индекс: основа слова -> {номер текста: сколько раз встретилась}. Запись,
+# индексация и поиск выполняются в одном отдельном потоке по очереди,
+# поэтому индекс не требует блокировок и не задерживает цикл событий.
+TEXT_COMMENT = "comment"
+TEXT_OBJECT_TYPE = "object_type"
+TEXT_REGION = "region"
+TEXT_TECH_QUESTION = "tech_question"
+TEXT_KIND_TITLES = {
+    TEXT_COMMENT: "комментарий к заявке",
+    TEXT_OBJECT_TYPE: "свой тип объекта",
+    TEXT_REGION: "регион",
+    TEXT_TECH_QUESTION: "технический вопрос",
+}
+
+_RU_VOWELS = frozenset("аеиоуыэюя")
+
+
+def _ru_endings(*groups: str) -> tuple:
+    """Окончания по убыванию длины — ищется самое длинное"""
+    return tuple(sorted({e for group in groups for e in group.split()}, key=len, reverse=True))
+
+
+_RU_GERUND_1 = _ru_endings("в вши вшись")  # после а/я
+_RU_GERUND_2 = _ru_endings("ив ивши ившись ыв ывши ывшись")
+_RU_REFLEXIVE = _ru_endings("ся сь")
+_RU_ADJECTIVE = _ru_endings("ее ие ые ое ими ыми ей ий ый ой ем им ым ом его ого ему ому их ых ую юю ая яя ою ею")
+_RU_PARTICIPLE_1 = _ru_endings("ем нн вш ющ щ")  # после а/я
+_RU_PARTICIPLE_2 = _ru_endings("ивш ывш ующ")
+_RU_VERB_1 = _ru_endings("ла на ете йте ли й л ем н ло но ет ют ны ть ешь нно")  # после а/я
+_RU_VERB_2 = _ru_endings("ила ыла ена ейте уйте ите или ыли ей уй ил ыл им ым ен ило ыло ено ят ует уют "
+                         "ит ыт ены ить ыть ишь ую ю")
+_RU_NOUN = _ru_endings("а ев ов ие ье е иями ями ами еи ии и ией ей ой ий й иям ям ием ем ам ом о у ах иях "
+                       "ях ы ь ию ью ю ия ья я")
+_RU_SUPERLATIVE = _ru_endings("ейш ейше")
+_RU_DERIVATIONAL = _ru_endings("ост ость")
+
+
+def _ru_strip(word: str, start: int, endings: tuple, after_a: bool = False):
+    """Слово без самого длинного окончания из endings в области word[start:] или None"""
+    for ending in endings:
+        if word.endswith(ending) and len(word) - len(ending) >= start:
+            cut = len(word) - len(ending)
+            if after_a and (cut - 1 < start or word[cut - 1] not in "ая"):
+                continue
+            return word[:cut]
+    return None
+
+
+def _ru_region(word: str, start: int) -> int:
+    """Начало области после первой пары «гласная, согласная» начиная со start"""
+    for i in range(start + 1, len(word)):
+        if word[i] not in _RU_VOWELS and word[i - 1] in _RU_VOWELS:
+            return i + 1
+    return len(word)
+
+
+def stem_ru(word: str) -> str:
+    """Основа русского слова (алгоритм Snowball для русского языка)"""
+    rv = next((i + 1 for i, ch in enumerate(word) if ch in _RU_VOWELS), len(word))
+    r2 = _ru_region(word, _ru_region(word, 0))
+    
+    # Шаг 1: деепричастие, иначе возвратность и прилагательное/глагол/существительное
+    stripped = _ru_strip(word, rv, _RU_GERUND_1, after_a=True) or _ru_strip(word, rv, _RU_GERUND_2)
+    if stripped is not None:
+        word = stripped
+    else:
+        word = _ru_strip(word, rv, _RU_REFLEXIVE) or word
+        adjective = _ru_strip(word, rv, _RU_ADJECTIVE)
+        if adjective is not None:
+            word = (_ru_strip(adjective, rv, _RU_PARTICIPLE_1, after_a=True)
+                    or _ru_strip(adjective, rv, _RU_PARTICIPLE_2) or adjective)
+        else:
+            word = (_ru_strip(word, rv, _RU_VERB_1, after_a=True) or _ru_strip(word, rv, _RU_VERB_2)
+                    or _ru_strip(word, rv, _RU_NOUN) or word)
+    # Шаг 2: конечное «и»
+    if word.endswith("и") and len(word) - 1 >= rv:
+        word = word[:-1]
+    # Шаг 3: словообразовательные окончания в R2
+    word = _ru_strip(word, r2, _RU_DERIVATIONAL) or word
+    # Шаг 4: «нн» -> «н», превосходная степень, мягкий знак
+    if word.endswith("нн") and len(word) - 2 >= rv:
+        return word[:-1]
+    superlative = _ru_strip(word, rv, _RU_SUPERLATIVE)
+    if superlative is not None:
+        word = superlative[:-1] if superlative.endswith("нн") else superlative
+    elif word.endswith("ь") and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+
+_WORD_RE = re.compile(r"[0-9a-zа-я]+")
+_STOP_WORDS = frozenset(
+    "и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было "
+    "вот от меня еще нет о из ему теперь когда даже ну ли если уже или ни быть был него до вас нибудь "
+    "опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была "
+    "сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой совсем ним "
+    "здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при наконец два об "
+    "другой хоть после над больше тот через эти нас про всего них какая много разве три эту моя впрочем "
+    "хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю между".split()
+)
+
+
+def search_terms(text: str) -> list:
+    """Текст -> основы слов для индекса"""
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    return [stem_ru(word) for word in words if word not in _STOP_WORDS]
+
+
+class SearchIndex:
+    """Инвертированный индекс свободных текстов с ранжированием BM25"""
+    
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search")
+        self._postings = {}  # основа -> {номер текста: частота}
+        self._docs = []      # номер текста -> запись из TEXTS_FILE
+        self._lengths = []   # номер текста -> число основ
+        self._total_length = 0
+        self._file = None
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def open(self, path: str) -> None:
+        """Загрузить тексты фоном; запросы до конца загрузки ждут её в очереди"""
+        self._executor.submit(self._open, path)
+
+    def close(self) -> None:
+        """Дождаться записи поставленных текстов и закрыть файл"""
+        self._executor.submit(self._close).result()
+
+    def add(self, user_id: int, kind: str, text: str) -> None:
+        """Сохранить и проиндексировать текст (не ждёт записи)"""
+        if text and text.strip():
+            doc = {'user_id': user_id, 'kind': kind, 'text': text,
+                   'at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+            self._executor.submit(self._add, doc, True)
+
+    async def search(self, query: str, limit: int = 10) -> list:
+        """[(оценка, запись), ...] по убыванию оценки"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._search, query, limit)
+
+    def _open(self, path: str) -> None:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._add(json.loads(line), False)
+                    except (ValueError, KeyError):
+                        continue  # недописанная строка при обрыве
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error("Failed to load texts: %s", e)
+        try:
+            self._file = open(path, 'a', encoding='utf-8')
+        except OSError as e:
+            logger.error("Texts will not be saved: %s", e)
+        logger.info("Search index loaded: %s texts, %s terms", len(self._docs), len(self._postings))
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _add(self, doc: dict, persist: bool) -> None:
+        if persist and self._file is not None:
+            try:
+                self._file.write(json.dumps(doc, ensure_ascii=False) + "\n")
+                self._file.flush()
+            except OSError as e:
+                logger.error("Failed to save text: %s", e)
+        terms = search_terms(doc['text'])
+        doc_id = len(self._docs)
+        self._docs.append(doc)
+        self._lengths.append(len(terms))
+        self._total_length += len(terms)
+        for term in terms:
+            postings = self._postings.setdefault(term, {})
+            postings[doc_id] = postings.get(doc_id, 0) + 1
+
+    def _search(self, query: str, limit: int) -> list:
+        terms = set(search_terms(query))
+        if not terms or not self._docs:
+            return []
+        count = len(self._docs)
+        average = self._total_length / count or 1
+        scores = {}
+        for term in terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                norm = self.K1 * (1 - self.B + self.B * self._lengths[doc_id] / average)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.K1 + 1) / (frequency + norm)
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(score, self._docs[doc_id]) for doc_id, score in best]
+
+
+search_index = SearchIndex()
 
 
 # ============== ИНФОРМАЦИЯ О КОМПАНИИ ==============
@@ -191,12 +2420,12 @@ https://arxproektstroy.ru/proekty
 • 140+ крупных объектов
 • 800+ млн руб. контрактов
 • 87% экспертиз с первого раза
-• Гарантия 3 года на все работы""".format(portfolio_url=PORTFOLIO_URL)
+• Гарантия 3 года на все работы"""
 
 
 GIVEAWAY_INFO = """🎁 РОЗЫГРЫШ
 
-Разыгрываем бесплатный эскизный проект стоимостью от 150 000 ₽.
+Разыгрываем бесплатный эскизный проект стоимостью {giveaway_prize}.
 
 Что получит победитель:
 → Концептуальные планировки
@@ -204,12 +2433,77 @@ GIVEAWAY_INFO = """🎁 РОЗЫГРЫШ
 → Предварительные ТЭП
 → 3D-визуализация
 
-Итоги: 28 февраля 2026 года
+Итоги: {giveaway_date}
 
 Подробности в канале @ADC_Project"""
 
 
+# Ответы на ключевые слова в свободных сообщениях: первый подходящий
+DEFAULT_ANSWERS = (
+    {'keywords': ["розыгрыш"], 'page': "giveaway"},
+    {'keywords': ["привет", "здравствуй", "добрый"], 'text': (
+        "Здравствуйте! 👋\n\n"
+        "Я — навигатор канала ADC Group.\n"
+        "Нажмите /start для просмотра меню."
+    )},
+    {'keywords': ["цена", "стоимость", "сколько стоит", "прайс"], 'text': (
+        "💰 Стоимость зависит от типа и площади объекта.\n\n"
+        "Для расчёта оставьте заявку — наш специалист "
+        "подготовит коммерческое предложение.\n\n"
+        "📝 /request — оставить заявку"
+    )},
+    {'keywords': ["срок", "сколько времени", "как долго"], 'text': (
+        "⏰ Сроки проектирования зависят от площади и сложности объекта.\n\n"
+        "Ориентировочно:\n"
+        "• до 5 000 м² — от 60 дней\n"
+        "• 5 000–20 000 м² — от 90 дней\n"
+        "• более 20 000 м² — от 120 дней\n\n"
+        "📝 Для точного расчёта: /request"
+    )},
+    {'keywords': ["контакт", "телефон", "позвонить", "связаться"], 'text': (
+        "📞 Контакты ADC Group:\n\n"
+        "Мобильный: +7 939 111 30 42\n"
+        "Городской: 8 (495) 118-34-88\n"
+        "Email: info@arxproektstroy.ru\n"
+        "Сайт: arxproektstroy.ru\n\n"
+        "📝 Или оставьте заявку: /request"
+    )},
+    {'keywords': ["bim", "бим"], 'text': (
+        "💻 BIM-проектирование\n\n"
+        "ADC Group работает с BIM-технологиями с 2018 года.\n\n"
+        "Преимущества:\n"
+        "• 3D-модель объекта\n"
+        "• Автоматическая проверка коллизий\n"
+        "• Точные спецификации\n"
+        "• Удобство согласований\n\n"
+        "📝 Для расчёта: /request"
+    )},
+    {'keywords': ["экспертиза", "экспертизу"], 'text': (
+        "🏛 Прохождение экспертизы\n\n"
+        "Сопровождаем проекты в государственной и негосударственной экспертизе.\n\n"
+        "• 87% экспертиз с первого раза\n"
+        "• Устраняем замечания за свой счёт\n"
+        "• Опыт работы со всеми регионами\n\n"
+        "📝 Подробнее: /request"
+    )},
+)
+
+DEFAULT_FALLBACK = (
+    "Я могу помочь с информацией о компании и услугах.\n\n"
+    "Нажмите /start для просмотра меню\n"
+    "или /request чтобы оставить заявку."
+)
+
+# Подстановки {имя} в текстах каталога
+DEFAULT_CONTENT_VARS = {
+    'giveaway_prize': "от 150 000 ₽",
+    'giveaway_date': "28 февраля 2026 года",
+}
+
+
 # ============== КЛАВИАТУРЫ ==============
+# Клавиатуры неизменяемы, поэтому строятся один раз и переиспользуются
+@functools.cache
 def get_main_keyboard():
     """Главное меню"""
     keyboard = [
@@ -225,12 +2519,14 @@ def get_main_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
+@functools.cache
 def get_back_keyboard():
     """Кнопка возврата в меню"""
     keyboard = [[InlineKeyboardButton("◀️ Главное меню", callback_data="menu")]]
     return InlineKeyboardMarkup(keyboard)
 
 
+@functools.cache
 def get_request_keyboard():
     """Кнопки после просмотра информации"""
     keyboard = [
@@ -240,6 +2536,7 @@ def get_request_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
+@functools.cache
 def get_survey_start_keyboard():
     """Клавиатура для начала анкеты — есть ли проект"""
     keyboard = [
@@ -250,6 +2547,7 @@ def get_survey_start_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
+@functools.cache
 def get_object_type_keyboard():
     """Клавиатура выбора типа объекта"""
     keyboard = [
@@ -265,75 +2563,1674 @@ def get_object_type_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
-def get_area_keyboard():
-    """Клавиатура выбора площади"""
-    keyboard = [
-        [InlineKeyboardButton("до 1 000 м²", callback_data="area_1000")],
-        [InlineKeyboardButton("1 000 – 5 000 м²", callback_data="area_5000")],
-        [InlineKeyboardButton("5 000 – 10 000 м²", callback_data="area_10000")],
-        [InlineKeyboardButton("10 000 – 30 000 м²", callback_data="area_30000")],
-        [InlineKeyboardButton("более 30 000 м²", callback_data="area_30000plus")],
-        [InlineKeyboardButton("Пока не определена", callback_data="area_unknown")],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+@functools.cache
+def get_area_keyboard():
+    """Клавиатура выбора площади"""
+    keyboard = [
+        [InlineKeyboardButton("до 1 000 м²", callback_data="area_1000")],
+        [InlineKeyboardButton("1 000 – 5 000 м²", callback_data="area_5000")],
+        [InlineKeyboardButton("5 000 – 10 000 м²", callback_data="area_10000")],
+        [InlineKeyboardButton("10 000 – 30 000 м²", callback_data="area_30000")],
+        [InlineKeyboardButton("более 30 000 м²", callback_data="area_30000plus")],
+        [InlineKeyboardButton("Пока не определена", callback_data="area_unknown")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+@functools.cache
+def get_region_keyboard():
+    """Клавиатура выбора региона"""
+    keyboard = [
+        [InlineKeyboardButton("Москва", callback_data="region_moscow")],
+        [InlineKeyboardButton("Московская область", callback_data="region_mo")],
+        [InlineKeyboardButton("Санкт-Петербург / ЛО", callback_data="region_spb")],
+        [InlineKeyboardButton("Другой регион", callback_data="region_other")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+@functools.cache
+def get_timeline_keyboard():
+    """Клавиатура выбора сроков"""
+    keyboard = [
+        [InlineKeyboardButton("Уже ищем подрядчика", callback_data="time_now")],
+        [InlineKeyboardButton("В ближайшие 1-3 месяца", callback_data="time_3m")],
+        [InlineKeyboardButton("В этом году", callback_data="time_year")],
+        [InlineKeyboardButton("Пока изучаю вопрос", callback_data="time_later")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+@functools.cache
+def get_interests_keyboard():
+    """Клавиатура выбора интересов по каналу"""
+    keyboard = [
+        [InlineKeyboardButton("Изменения в законодательстве", callback_data="int_law")],
+        [InlineKeyboardButton("Разборы кейсов и ошибок", callback_data="int_cases")],
+        [InlineKeyboardButton("Стоимость проектирования", callback_data="int_cost")],
+        [InlineKeyboardButton("BIM и цифровизация", callback_data="int_bim")],
+        [InlineKeyboardButton("Экспертиза и согласования", callback_data="int_expertise")],
+        [InlineKeyboardButton("Господдержка и субсидии", callback_data="int_support")],
+        [InlineKeyboardButton("✅ Готово", callback_data="int_done")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+@functools.cache
+def get_giveaway_keyboard():
+    """Клавиатура участия в розыгрыше"""
+    keyboard = [
+        [InlineKeyboardButton("Да, участвую", callback_data="giveaway_yes")],
+        [InlineKeyboardButton("Нет, спасибо", callback_data="giveaway_no")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_ack_keyboard(acks: list):
+    """Кнопки «Беру в работу» для лидов в уведомлении: [(id лида, подпись), ...]"""
+    keyboard = [
+        [InlineKeyboardButton(f"✅ Беру: {label[:40]}", callback_data=f"ack:{lead_id}")]
+        for lead_id, label in acks
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+# ============== ОТЛОЖЕННАЯ ОТРИСОВКА ИНТЕРЕСОВ ==============
+# Ключ сообщения -> задача, которая отрисует последнее состояние выбора.
+# Быстрые нажатия отменяют предыдущую задачу, поэтому до Telegram доходит
+# только одна правка на серию нажатий.
+_interests_renders = {}
+
+
+def get_interests_text(selected: list) -> str:
+    """Текст сообщения с выбранными интересами"""
+    selected_text = ", ".join(selected) if selected else "ничего не выбрано"
+    return (
+        f"Какие темы вам интересны?\n\n"
+        f"Выбрано: {selected_text}\n\n"
+        "Выберите и нажмите «Готово»:"
+    )
+
+
+def _interests_render_key(query):
+    """Ключ сообщения, к которому привязана клавиатура"""
+    if query.message:
+        return (query.message.chat_id, query.message.message_id)
+    return query.inline_message_id
+
+
+async def _render_interests_later(query, context: ContextTypes.DEFAULT_TYPE, key) -> None:
+    """Отрисовка клавиатуры интересов после паузы"""
+    try:
+        await asyncio.sleep(INTERESTS_RENDER_DELAY)
+        # Берём актуальный выбор на момент отрисовки, а не на момент нажатия
+        await query.edit_message_text(
+            get_interests_text(context.user_data.get('interests', [])),
+            reply_markup=get_interests_keyboard()
+        )
+    except BadRequest as e:
+        # Выбор вернулся к уже показанному состоянию — править нечего
+        if "not modified" not in str(e).lower():
+            logger.error("Failed to render interests: %s", e)
+    finally:
+        if _interests_renders.get(key) is asyncio.current_task():
+            del _interests_renders[key]
+
+
+def schedule_interests_render(query, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Запланировать отрисовку, отменив устаревшую"""
+    key = _interests_render_key(query)
+    cancel_interests_render(query)
+    _interests_renders[key] = context.application.create_task(
+        _render_interests_later(query, context, key),
+        name=f"interests_render:{key}"
+    )
+
+
+def cancel_interests_render(query) -> None:
+    """Отмена ожидающей отрисовки интересов"""
+    task = _interests_renders.pop(_interests_render_key(query), None)
+    if task is not None and not task.done():
+        task.cancel()
+
+
+# ============== ПРИОРИТЕТ ЛИДОВ ==============
+PRIORITY_HOT, PRIORITY_WARM, PRIORITY_COLD = range(3)
+PRIORITY_NAMES = {PRIORITY_HOT: "hot", PRIORITY_WARM: "warm", PRIORITY_COLD: "cold"}
+PRIORITY_TITLES = {PRIORITY_HOT: "🔥 Горячий лид", PRIORITY_WARM: "🌤 Тёплый лид", PRIORITY_COLD: "❄️ Холодный лид"}
+
+# Баллы за ответы анкеты (кнопки) и формы заявки (клавиатура)
+_TIMELINE_SCORES = {
+    "Уже ищем подрядчика": 40,
+    "В ближайшие 1-3 месяца": 25,
+    "В этом году": 10,
+    "Срочно (до 1 месяца)": 40,
+    "1-3 месяца": 25,
+    "3-6 месяцев": 10,
+}
+_AREA_SCORES = {
+    "более 30 000 м²": 30,
+    "10 000 – 30 000 м²": 20,
+    "5 000 – 10 000 м²": 10,
+    "1 000 – 5 000 м²": 5,
+    "до 1 000 м²": 0,
+}
+
+# Первое число текста (разряды через пробел, дробная часть отбрасывается)
+# и, если это диапазон, его верхняя граница: «1500 м2», «12 000», «1000-5000»
+_AREA_NUMBER_RE = re.compile(r"(\d+(?:[ \u00a0]\d{3})*)(?:[.,]\d+)?(?:\s*(?:-|–|—|до)\s*(\d+(?:[ \u00a0]\d{3})*))?")
+
+
+def _area_score(area) -> int:
+    """Баллы за площадь: подпись кнопки или число, введённое текстом"""
+    if not area:
+        return 0
+    if area in _AREA_SCORES:
+        return _AREA_SCORES[area]
+    match = _AREA_NUMBER_RE.search(str(area))
+    if not match:
+        return 0
+    value = int(re.sub(r"\s", "", match.group(2) or match.group(1)))
+    if value > 30000:
+        return 30
+    if value >= 10000:
+        return 20
+    if value >= 5000:
+        return 10
+    return 5 if value >= 1000 else 0
+
+
+def score_lead(data: dict, request: bool = False) -> int:
+    """Оценка лида по данным анкеты или формы заявки"""
+    score = 0
+    if request:
+        # Пользователь сам заполнил форму заявки и оставил контакт
+        score += 30
+        if data.get('files'):
+            score += 5
+    elif data.get('has_project'):
+        score += 20
+    elif data.get('giveaway_participant'):
+        score += 5
+    score += _TIMELINE_SCORES.get(data.get('timeline'), 0)
+    score += _area_score(data.get('area'))
+    return score
+
+
+def lead_priority(score: int) -> int:
+    """Класс приоритета по оценке"""
+    if score >= LEAD_HOT_SCORE:
+        return PRIORITY_HOT
+    if score >= LEAD_WARM_SCORE:
+        return PRIORITY_WARM
+    return PRIORITY_COLD
+
+
+# ============== ОЧЕРЕДЬ УВЕДОМЛЕНИЙ МЕНЕДЖЕРУ ==============
+class Notification:
+    """Уведомление в очереди менеджеру"""
+    __slots__ = ('priority', 'chat_id', 'text', 'files', 'on_sent', 'on_failed', 'ack', 'enqueued', 'attempts')
+
+    def __init__(self, priority: int, chat_id, text: str, files=(), on_sent=None, on_failed=None, ack=None):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.text = text
+        self.files = files  # [(file_id, caption), ...]
+        self.on_sent = on_sent
+        self.on_failed = on_failed  # уведомление не будет доставлено
+        self.ack = ack  # (id лида, подпись) — кнопка «Беру в работу»
+        self.enqueued = time.monotonic()
+        self.attempts = 0  # неудачных отправок из очереди
+
+
+# Предел длины сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+
+def pack_message(parts: list, separator: str = "\n\n———\n\n", limit: int = MESSAGE_LIMIT) -> list:
+    """Склеить части в сообщения не длиннее limit: [(текст, [номера частей]), ...]"""
+    messages = []
+    current = ""
+    indices = []
+    for index, part in enumerate(parts):
+        part = part[:limit]
+        candidate = current + separator + part if current else part
+        if len(candidate) > limit:
+            messages.append((current, indices))
+            candidate, indices = part, []
+        current = candidate
+        indices.append(index)
+    if current:
+        messages.append((current, indices))
+    return messages
+
+
+def split_message(parts: list, separator: str = "\n\n———\n\n", limit: int = MESSAGE_LIMIT) -> list:
+    """Склеить части в сообщения не длиннее limit"""
+    return [text for text, _ in pack_message(parts, separator, limit)]
+
+
+class ManagerQueue:
+    """Очередь уведомлений с приоритетами.
+    
+    Горячие и тёплые уведомления уходят сразу в порядке приоритета, холодные
+    копятся до COLD_BATCH_DELAY секунд и отправляются одним сообщением.
+    Уведомление, которое не ушло из-за сбоя сети, возвращается в очередь
+    с растущей паузой — лид не теряется, пока Telegram недоступен.
+    Для каждого класса считается время ожидания в очереди.
+    """
+    # Попыток вызова Bot API при сетевых сбоях и паузы между повторами (сек)
+    SEND_ATTEMPTS = 3
+    RETRY_BASE_DELAY = 5.0
+    RETRY_MAX_DELAY = 300.0
+
+    def __init__(self):
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._cold = []
+        self._cold_deadline = None
+        self._delayed = []  # куча (когда повторить, seq, уведомление)
+        self._worker = None
+        self.wait_stats = {
+            name: {'sent': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+
+    def __len__(self) -> int:
+        return self._queue.qsize() + len(self._cold) + len(self._delayed)
+
+    def put(self, notification: Notification) -> None:
+        self._queue.put_nowait((notification.priority, next(self._seq), notification))
+
+    def start(self, bot) -> None:
+        self._worker = asyncio.create_task(self._run(bot), name="manager_queue")
+
+    async def stop(self, bot) -> None:
+        """Остановить обработчик и отправить всё, что осталось"""
+        if self._worker is not None:
+            self._worker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._worker
+            self._worker = None
+        # Ожидающие повтора — последняя попытка, не дожидаясь паузы
+        delayed, self._delayed = self._delayed, []
+        for _, _, notification in delayed:
+            self.put(notification)
+        while not self._queue.empty():
+            _, _, notification = self._queue.get_nowait()
+            if notification.priority == PRIORITY_COLD:
+                self._cold.append(notification)
+            else:
+                await self._send(bot, [notification])
+        await self._flush_cold(bot)
+        if self._delayed:
+            logger.error("Manager queue stopped with %s notifications undelivered", len(self._delayed))
+            delayed, self._delayed = self._delayed, []
+            self._give_up([notification for _, _, notification in delayed])
+
+    async def _run(self, bot) -> None:
+        while True:
+            deadlines = []
+            if self._cold:
+                deadlines.append(self._cold_deadline)
+            if self._delayed:
+                deadlines.append(self._delayed[0][0])
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            try:
+                _, _, notification = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                now = time.monotonic()
+                due = []
+                while self._delayed and self._delayed[0][0] <= now:
+                    due.append(heapq.heappop(self._delayed)[2])
+                # Повтор уходит сразу: холодные уже отстояли свою паузу
+                await self._send_by_chat(bot, due)
+                if self._cold and self._cold_deadline <= now:
+                    await self._flush_cold(bot)
+                continue
+            
+            if notification.priority != PRIORITY_COLD:
+                await self._send(bot, [notification])
+                continue
+            if not self._cold:
+                self._cold_deadline = time.monotonic() + COLD_BATCH_DELAY
+            self._cold.append(notification)
+
+    async def _flush_cold(self, bot) -> None:
+        batch, self._cold = self._cold, []
+        await self._send_by_chat(bot, batch)
+
+    async def _send_by_chat(self, bot, batch: list) -> None:
+        """Отправить уведомления, по одному сообщению на чат"""
+        by_chat = {}
+        for notification in batch:
+            by_chat.setdefault(notification.chat_id, []).append(notification)
+        for notifications in by_chat.values():
+            await self._send(bot, notifications)
+
+    async def _send(self, bot, notifications: list) -> None:
+        """Отправка уведомлений одного чата (несколько — одним сообщением)"""
+        chat_id = notifications[0].chat_id
+        pages = pack_message([n.text for n in notifications])
+        delivered = []
+        for number, (text, indices) in enumerate(pages):
+            acks = [notifications[i].ack for i in indices if notifications[i].ack]
+            try:
+                await self._send_with_retry(
+                    bot.send_message, chat_id=chat_id, text=text,
+                    reply_markup=get_ack_keyboard(acks) if acks else None
+                )
+            except Exception as e:
+                # Уже отправленные страницы не повторяем
+                self._failed([notifications[i] for _, rest in pages[number:] for i in rest], e)
+                break
+            delivered += [notifications[i] for i in indices]
+        
+        for notification in delivered:
+            for file_id, caption in notification.files:
+                try:
+                    await self._send_with_retry(
+                        bot.send_document, chat_id=chat_id, document=file_id, caption=caption
+                    )
+                except Exception as e:
+                    logger.error("Failed to forward file: %s", e)
+        
+        now = time.monotonic()
+        for notification in delivered:
+            wait = now - notification.enqueued
+            stats = self.wait_stats[PRIORITY_NAMES[notification.priority]]
+            stats['sent'] += 1
+            stats['wait_total'] += wait
+            stats['wait_max'] = max(stats['wait_max'], wait)
+            if notification.on_sent:
+                notification.on_sent()
+
+    def _failed(self, notifications: list, error: Exception) -> None:
+        """Неотправленные уведомления: сбой сети — в очередь с паузой, иначе — отказ"""
+        if not self._is_transient(error):
+            logger.error("Failed to notify manager: %s", error)
+            self._give_up(notifications)
+            return
+        for notification in notifications:
+            notification.attempts += 1
+            delay = min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** (notification.attempts - 1))
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), notification))
+        logger.warning("Manager notification failed, retrying in %.0fs: %s", delay, error)
+
+    @staticmethod
+    def _give_up(notifications: list) -> None:
+        for notification in notifications:
+            if notification.on_failed:
+                notification.on_failed()
+
+    @staticmethod
+    def _is_transient(error: Exception) -> bool:
+        """Сбой, после которого отправку стоит повторить (BadRequest — ошибка запроса)"""
+        return isinstance(error, (RetryAfter, NetworkError)) and not isinstance(error, BadRequest)
+
+    @classmethod
+    async def _send_with_retry(cls, method, **kwargs):
+        for attempt in range(1, cls.SEND_ATTEMPTS + 1):
+            try:
+                return await method(**kwargs)
+            except RetryAfter as e:
+                # Лимит Telegram на чат — ждём, сколько просят, и пробуем ещё раз
+                if attempt == cls.SEND_ATTEMPTS:
+                    raise
+                await asyncio.sleep(e.retry_after)
+            except NetworkError as e:
+                # Таймаут или обрыв соединения — короткая пауза с удвоением
+                if isinstance(e, BadRequest) or attempt == cls.SEND_ATTEMPTS:
+                    raise
+                await asyncio.sleep(2 ** (attempt - 1))
+
+    def report(self) -> dict:
+        """Среднее и максимальное ожидание по классам приоритета"""
+        return {
+            name: {
+                'sent': stats['sent'],
+                'wait_avg': stats['wait_total'] / stats['sent'] if stats['sent'] else 0.0,
+                'wait_max': stats['wait_max'],
+            }
+            for name, stats in self.wait_stats.items()
+        }
+
+
+manager_queue = ManagerQueue()
+
+
+async def report_queue_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодический отчёт о времени ожидания в очереди менеджеру"""
+    for name, stats in manager_queue.report().items():
+        logger.info(
+            "Manager queue %s: sent %s, wait avg %.2fs, max %.2fs",
+            name, stats['sent'], stats['wait_avg'], stats['wait_max']
+        )
+    logger.info("Manager queue depth: %s", len(manager_queue))
+
+
+# ============== ПУЛ МЕНЕДЖЕРОВ ==============
+# Лид уходит одному менеджеру из пула. Сначала правила (первое совпавшее
+# по полю лида сужает выбор до своих чатов), затем лимит: менеджеры с
+# исчерпанной корзиной пропускаются, пока есть другие. Среди оставшихся —
+# наименьшее число неподтверждённых лидов (least) или по кругу
+# (round_robin); при равенстве — тот, кому лид доставался давнее всех.
+# Лид считается неподтверждённым, пока менеджер не нажал «Беру в работу».
+def parse_manager_routes(spec: str) -> list:
+    """«region:Москва=-100|-200;object_type:Склад=-300» -> [(поле, значение, [чаты]), ...]"""
+    routes = []
+    for item in spec.split(";"):
+        condition, _, chats = item.rpartition("=")
+        field, _, value = condition.partition(":")
+        chats = [chat.strip() for chat in chats.split("|") if chat.strip()]
+        if field.strip() and chats:
+            routes.append((field.strip(), value.strip().casefold(), chats))
+    return routes
+
+
+class ManagerPool:
+    """Распределение лидов между чатами менеджеров"""
+
+    def __init__(self, chats: list, routes: list = (), balance: str = "least", rate: tuple = None):
+        self.chats = list(dict.fromkeys(chats + [c for _, _, route in routes for c in route]))
+        self.routes = routes
+        self.balance = balance
+        self._rate = rate
+        self._buckets = {}
+        self._seq = itertools.count(1)
+        self._last_assigned = dict.fromkeys(self.chats, 0)
+        self.leads = {}  # id лида -> (чат, время назначения)
+        self.stats = {chat: {'assigned': 0, 'acked': 0, 'ack_total': 0.0} for chat in self.chats}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.chats)
+
+    def outstanding(self, chat: str) -> int:
+        return self.stats[chat]['assigned'] - self.stats[chat]['acked']
+
+    def _bucket(self, chat: str):
+        if self._rate is None:
+            return None
+        bucket = self._buckets.get(chat)
+        if bucket is None:
+            bucket = self._buckets[chat] = TokenBucket(*self._rate)
+        return bucket
+
+    def candidates(self, data: dict) -> list:
+        """Чаты, которым можно отдать лид по правилам"""
+        for field, value, chats in self.routes:
+            if str(data.get(field) or "").casefold() == value:
+                return chats
+        return self.chats
+
+    def choose(self, data: dict) -> str:
+        candidates = self.candidates(data)
+        if self._rate is not None:
+            allowed = [chat for chat in candidates if self._bucket(chat).delay() == 0]
+            # Лимит у всех — лид всё равно нужно отдать: тому, у кого токен появится раньше
+            candidates = allowed or [min(candidates, key=lambda chat: self._bucket(chat).delay())]
+        if self.balance == "round_robin":
+            return min(candidates, key=lambda chat: self._last_assigned[chat])
+        return min(candidates, key=lambda chat: (self.outstanding(chat), self._last_assigned[chat]))
+
+    def assign(self, lead_id: str, data: dict) -> str:
+        """Чат менеджера для лида; повторная доставка того же лида — тот же чат"""
+        if lead_id in self.leads:
+            return self.leads[lead_id][0]
+        chat = self.choose(data)
+        if self._rate is not None:
+            self._bucket(chat).take()
+        self._last_assigned[chat] = next(self._seq)
+        self.leads[lead_id] = (chat, time.time())
+        self.stats[chat]['assigned'] += 1
+        return chat
+
+    def release(self, lead_id: str) -> None:
+        """Снять назначение лида, уведомление о котором не доставлено"""
+        assigned = self.leads.pop(lead_id, None)
+        if assigned is not None:
+            self.stats[assigned[0]]['assigned'] -= 1
+
+    def ack(self, lead_id: str, chat: str):
+        """Подтвердить лид из его чата; секунд до подтверждения или None"""
+        assigned = self.leads.get(lead_id)
+        if assigned is None or assigned[0] != chat:
+            return None
+        del self.leads[lead_id]
+        waited = max(0.0, time.time() - assigned[1])
+        self.stats[chat]['acked'] += 1
+        self.stats[chat]['ack_total'] += waited
+        return waited
+
+    def state(self) -> dict:
+        """Неподтверждённые лиды и счётчики для тёплого перезапуска"""
+        return {'leads': {lead_id: list(value) for lead_id, value in self.leads.items()},
+                'stats': self.stats}
+
+    def restore(self, state: dict) -> None:
+        for chat, stats in state.get('stats', {}).items():
+            if chat in self.stats:
+                self.stats[chat].update(stats)
+        for lead_id, (chat, assigned_at) in state.get('leads', {}).items():
+            if chat in self.stats:
+                self.leads[lead_id] = (chat, assigned_at)
+        # Неподтверждённые — ровно восстановленные лиды (чаты могли убрать из пула)
+        for chat, stats in self.stats.items():
+            stats['acked'] = stats['assigned'] - sum(1 for c, _ in self.leads.values() if c == chat)
+
+
+def _parse_manager_rate(spec: str):
+    if not spec:
+        return None
+    capacity, _, period = spec.partition("/")
+    return float(capacity), float(period)
+
+
+manager_pool = ManagerPool(MANAGER_POOL, parse_manager_routes(MANAGER_ROUTES),
+                           MANAGER_BALANCE, _parse_manager_rate(MANAGER_RATE))
+
+
+def format_lead_id(fingerprint: int) -> str:
+    """Id лида для кнопок и CRM — отпечаток журнала в hex"""
+    return f"{fingerprint & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+# ============== СВОДКА ДЛЯ МЕНЕДЖЕРА ==============
+DIGEST_SUBSCRIBER = "subscriber"
+DIGEST_QUESTION = "question"
+
+
+class DigestEntry:
+    """Событие, ожидающее сводки"""
+    __slots__ = ('kind', 'text', 'on_sent')
+
+    def __init__(self, kind: str, text: str, on_sent=None):
+        self.kind = kind
+        self.text = text
+        self.on_sent = on_sent
+
+
+# chat_id -> события с момента прошлой сводки
+_digest_entries = {}
+_digest_started = datetime.now()
+
+
+def add_to_digest(chat_id, entry: DigestEntry) -> None:
+    """Отложить событие до ближайшей сводки"""
+    _digest_entries.setdefault(chat_id, []).append(entry)
+
+
+def digest_pages(entries: list, started: datetime, finished: datetime) -> list:
+    """Страницы сводки не длиннее MESSAGE_LIMIT: [(текст, [события страницы]), ...]"""
+    subscribers = sum(1 for e in entries if e.kind == DIGEST_SUBSCRIBER)
+    questions = sum(1 for e in entries if e.kind == DIGEST_QUESTION)
+    header = (
+        f"📰 СВОДКА {started.strftime('%d.%m %H:%M')}–{finished.strftime('%H:%M')}\n"
+        f"👤 Новых подписчиков: {subscribers} · ❓ Вопросов без ответа: {questions}\n"
+    )
+    # Запас под заголовок и номер страницы
+    body_limit = MESSAGE_LIMIT - len(header) - 32
+    bodies = pack_message([e.text for e in entries], separator="\n\n", limit=body_limit)
+    total = len(bodies)
+    return [
+        (f"{header}(стр. {number}/{total})\n\n{body}", [entries[i] for i in indices])
+        for number, (body, indices) in enumerate(bodies, start=1)
+    ]
+
+
+async def flush_digest(bot) -> None:
+    """Отправить накопленную сводку во все чаты"""
+    global _digest_entries, _digest_started
+    pending, _digest_entries = _digest_entries, {}
+    started, _digest_started = _digest_started, datetime.now()
+    
+    for chat_id, entries in pending.items():
+        pages = digest_pages(entries, started, _digest_started)
+        for number, (page, page_entries) in enumerate(pages):
+            try:
+                await ManagerQueue._send_with_retry(bot.send_message, chat_id=chat_id, text=page)
+            except Exception as e:
+                logger.error("Failed to send digest: %s", e)
+                # Не теряем события неотправленных страниц — они попадут в следующую сводку
+                _digest_entries.setdefault(chat_id, [])[:0] = [
+                    entry for _, rest in pages[number:] for entry in rest
+                ]
+                break
+            for entry in page_entries:
+                if entry.on_sent:
+                    entry.on_sent()
+        else:
+            logger.info("Digest sent to %s: %s events", chat_id, len(entries))
+
+
+async def digest_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая отправка сводки"""
+    await flush_digest(context.bot)
+
+
+# ============== АРХИВ ВЛОЖЕНИЙ ==============
+# Файлы заявок скачиваются фоном в ARCHIVE_DIR/objects/<sha256[:2]>/<sha256>.
+# Одинаковые файлы от разных пользователей хранятся одной копией: у одного
+# и того же файла в Telegram один file_unique_id, а index.jsonl связывает его
+# с SHA-256 содержимого — повторно такой файл даже не скачивается.
+# links.jsonl связывает вложения с пользователями: файл может прислать и тот,
+# кто не проходил анкету и записи в базе не имеет. С самой заявкой файлы
+# связывает запись лида в CRM: в ней список file_unique_id вложений.
+ARCHIVE_INDEX = "index.jsonl"
+ARCHIVE_LINKS = "links.jsonl"
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+# Bot API отдаёт через getFile файлы не больше 20 МБ
+ARCHIVE_MAX_FILE_SIZE = 20 * 2**20
+
+
+class Attachment:
+    """Вложение, ожидающее архивации"""
+    __slots__ = ('user_id', 'file_id', 'file_unique_id', 'file_name', 'file_size', 'received')
+
+    def __init__(self, user_id: int, file_id: str, file_unique_id: str, file_name: str = None,
+                 file_size: int = None):
+        self.user_id = user_id
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.received = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    @property
+    def name(self) -> str:
+        return self.file_name or f"{self.file_unique_id}.jpg"
+
+    def link(self) -> dict:
+        """Ссылка на вложение в записи лида: по file_unique_id архив находит SHA-256"""
+        return {'file_unique_id': self.file_unique_id, 'name': self.name}
+
+
+class AttachmentArchiver:
+    """Фоновая архивация вложений с ограниченным числом загрузок.
+    
+    Файл скачивается потоком во временный файл с подсчётом SHA-256 на ходу
+    и переносится на место по хешу, поэтому в памяти держится только
+    текущий фрагмент. Архивированное вложение привязывается к пользователю
+    в links.jsonl архива — база пользователей при этом не переписывается.
+    """
+
+    def __init__(self, concurrency: int):
+        self._concurrency = concurrency
+        self._queue = asyncio.Queue()
+        self._workers = []
+        self._client = None
+        self._directory = None
+        self._index = {}  # file_unique_id -> {'sha256': ..., 'size': ...}
+        self._links = {}  # user_id -> [вложение, ...]
+        self._downloads = {}  # file_unique_id -> идущая загрузка
+        self.stats = Counter()
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def enabled(self) -> bool:
+        return self._directory is not None
+
+    def open(self, directory: str) -> None:
+        """Подготовить каталог и прочитать индекс"""
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        self._directory = directory
+        self._index = {entry['file_unique_id']: entry for entry in self._read_lines(ARCHIVE_INDEX)}
+        self._links = {}
+        for entry in self._read_lines(ARCHIVE_LINKS):
+            self._links.setdefault(entry.pop('user_id'), []).append(entry)
+        logger.info("Attachment archive opened: %s files, %s users", len(self._index), len(self._links))
+
+    def _read_lines(self, name: str):
+        """Записи JSONL-файла архива"""
+        try:
+            with open(os.path.join(self._directory, name), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue  # недописанная строка при обрыве
+        except FileNotFoundError:
+            return
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self._directory, "objects", sha256[:2], sha256)
+
+    def attachments(self, user_id: int) -> list:
+        """Архивированные вложения пользователя"""
+        return list(self._links.get(user_id, ()))
+
+    def put(self, attachment: Attachment) -> None:
+        if self.enabled:
+            self._queue.put_nowait(attachment)
+
+    def start(self, bot) -> None:
+        if not self.enabled:
+            return
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0))
+        self._workers = [
+            asyncio.create_task(self._run(bot), name=f"archiver_{n}")
+            for n in range(self._concurrency)
+        ]
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """Дождаться начатых загрузок (не дольше timeout) и остановиться"""
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Attachment archive stopped with %s files pending", len(self))
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        await self._client.aclose()
+
+    async def _run(self, bot) -> None:
+        while True:
+            attachment = await self._queue.get()
+            try:
+                entry = await self.archive(bot, attachment)
+                if entry is not None:
+                    await self._link(attachment.user_id, entry)
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error("Failed to archive file %s: %s", attachment.file_unique_id, e)
+            finally:
+                self._queue.task_done()
+
+    async def _link(self, user_id: int, entry: dict) -> None:
+        """Привязать архивированное вложение к пользователю"""
+        links = self._links.setdefault(user_id, [])
+        if any(a['file_unique_id'] == entry['file_unique_id'] for a in links):
+            return
+        links.append(entry)
+        await asyncio.to_thread(self._append_line, ARCHIVE_LINKS, dict(entry, user_id=user_id))
+
+    async def archive(self, bot, attachment: Attachment):
+        """Сохранить вложение в архив; запись для карточки пользователя или None"""
+        unique_id = attachment.file_unique_id
+        known = self._index.get(unique_id)
+        if known is not None and os.path.exists(self.object_path(known['sha256'])):
+            self.stats['deduplicated'] += 1
+        elif unique_id in self._downloads:
+            # Тот же файл уже качается для другой заявки — ждём его
+            self.stats['deduplicated'] += 1
+            known = await asyncio.shield(self._downloads[unique_id])
+        elif attachment.file_size and attachment.file_size > ARCHIVE_MAX_FILE_SIZE:
+            self.stats['too_big'] += 1
+            logger.warning("File %s is too big to archive (%s bytes)", unique_id, attachment.file_size)
+            return None
+        else:
+            download = asyncio.ensure_future(self._fetch(bot, attachment))
+            self._downloads[unique_id] = download
+            try:
+                known = await asyncio.shield(download)
+            finally:
+                self._downloads.pop(unique_id, None)
+        
+        return {
+            'sha256': known['sha256'],
+            'size': known['size'],
+            'name': attachment.name,
+            'file_unique_id': unique_id,
+            'received': attachment.received,
+        }
+
+    async def _fetch(self, bot, attachment: Attachment) -> dict:
+        """Скачать файл и записать его в индекс"""
+        telegram_file = await ManagerQueue._send_with_retry(bot.get_file, file_id=attachment.file_id)
+        with span("archive.download", **{'file.unique_id': attachment.file_unique_id}):
+            sha256, size = await self._download(telegram_file.file_path)
+        entry = {'file_unique_id': attachment.file_unique_id, 'sha256': sha256, 'size': size}
+        self._index[attachment.file_unique_id] = entry
+        await asyncio.to_thread(self._append_line, ARCHIVE_INDEX, entry)
+        self.stats['downloaded'] += 1
+        self.stats['bytes'] += size
+        return entry
+
+    async def _download(self, url: str) -> tuple:
+        """Потоковая загрузка в архив: (sha256, размер)"""
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self._directory, f".download-{os.getpid()}-{id(digest):x}")
+        f = await asyncio.to_thread(open, tmp_path, 'wb')
+        try:
+            async with self._client.stream("GET", url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(ARCHIVE_CHUNK_SIZE):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+            await asyncio.to_thread(f.close)
+            sha256 = digest.hexdigest()
+            await asyncio.to_thread(self._store_object, tmp_path, sha256)
+        except BaseException:
+            f.close()
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        return sha256, size
+
+    def _store_object(self, tmp_path: str, sha256: str) -> None:
+        path = self.object_path(sha256)
+        if os.path.exists(path):
+            # Такое содержимое уже есть (другой file_unique_id) — копия не нужна
+            os.remove(tmp_path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    def _append_line(self, name: str, entry: dict) -> None:
+        with open(os.path.join(self._directory, name), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+attachment_archiver = AttachmentArchiver(ARCHIVE_CONCURRENCY)
+
+
+# ============== ВЫГРУЗКА В CRM ==============
+# Лид сначала дописывается в файл очереди (с fsync), и только потом
+# сохраняется в базу и уходит менеджеру — записанный лид не теряется
+# при падении. Фоновый обработчик читает очередь с сохранённого смещения
+# и отправляет пачками; смещение двигается только после ответа 2xx.
+# Доставка «хотя бы один раз»: после сбоя пачка может уйти повторно,
+# поэтому у каждого лида есть ключ key, по которому CRM отбрасывает дубли.
+# Доставленная очередь обрезается, когда файл дорос до этого размера
+CRM_OUTBOX_COMPACT_SIZE = 1 * 2**20
+
+
+class CrmOutbox:
+    """Очередь лидов для CRM в JSONL-файле со смещением доставленного"""
+
+    def __init__(self):
+        self._path = None
+        self._offset = 0
+        self._client = None
+        self._worker = None
+        self._wakeup = asyncio.Event()
+        # Дозапись и обрезка файла идут в потоках — не одновременно
+        self._file_lock = asyncio.Lock()
+        self.error = None  # последняя ошибка файла очереди или обработчика
+        self.stats = Counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self._path is not None
+
+    def health(self) -> dict:
+        """Для /readyz: обработчик работает и файл очереди пишется.
+        
+        Недоступность CRM готовность не снимает — лиды копятся в файле.
+        """
+        if not self.enabled:
+            return {'ok': True}
+        running = self._worker is not None and not self._worker.done()
+        return {'ok': running and self.error is None, 'running': running, 'error': self.error}
+
+    @property
+    def offset_path(self) -> str:
+        return self._path + ".offset"
+
+    def open(self, path: str) -> None:
+        """Открыть очередь: смещение доставленного и обрезка недописанной строки"""
+        self._path = path
+        try:
+            with open(self.offset_path, 'r', encoding='utf-8') as f:
+                self._offset = int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            self._offset = 0
+        try:
+            with open(path, 'rb+') as f:
+                data = f.read()
+                # Хвост без перевода строки — обрыв записи; следующая запись склеилась бы с ним
+                end = data.rfind(b"\n") + 1
+                if end < len(data):
+                    f.truncate(end)
+                    logger.warning("CRM outbox: dropped %s bytes of a torn record", len(data) - end)
+                size = end
+        except FileNotFoundError:
+            size = 0
+        if self._offset > size:
+            # Упали между обрезкой файла и записью смещения — всё доставлено
+            self._offset = 0
+        logger.info("CRM outbox opened: %s bytes pending", size - self._offset)
+
+    async def add(self, kind: str, lead: dict, update_id: int) -> None:
+        """Записать лид в очередь (с fsync, в потоке); ключ дублей — отпечаток лида и апдейта"""
+        if not self.enabled:
+            return
+        fingerprint = lead_fingerprint(kind, lead.get('user_id'), lead, update_id)
+        record = {
+            'key': f"{kind}-{format_lead_id(fingerprint)}",
+            'kind': kind,
+            'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'lead': lead,
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        try:
+            async with self._file_lock:
+                await asyncio.to_thread(self._append, line)
+        except OSError as e:
+            self.stats['write_failed'] += 1
+            self.error = str(e)
+            logger.error("CRM outbox write failed for user %s: %s", lead.get('user_id'), e)
+            return
+        self.error = None
+        self.stats['queued'] += 1
+        self._wakeup.set()
+
+    def _append(self, line: str) -> None:
+        with open(self._path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def start(self) -> None:
+        if not self.enabled:
+            return
+        headers = {'Authorization': f"Bearer {CRM_TOKEN}"} if CRM_TOKEN else {}
+        # Одно-два постоянных соединения: пачки идут по очереди, без повторного TLS-рукопожатия
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(max_connections=2, max_keepalive_connections=2, keepalive_expiry=120.0),
+            headers=headers,
+        )
+        self._worker = asyncio.create_task(self._run(), name="crm_outbox")
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Последняя попытка отправить очередь (не дольше timeout) и остановка"""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._worker
+        self._worker = None
+        with contextlib.suppress(Exception):
+            await asyncio.wait_for(self.flush(), timeout)
+        await self._client.aclose()
+        self._client = None
+
+    def _read_batch(self, offset: int) -> tuple:
+        """До CRM_BATCH записей начиная со смещения: (записи, смещение после них)"""
+        records = []
+        try:
+            f = open(self._path, 'rb')
+        except FileNotFoundError:
+            return records, offset
+        with f:
+            f.seek(offset)
+            while len(records) < CRM_BATCH:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break  # конец файла
+                offset += len(line)
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.error("CRM outbox: unreadable record at offset %s skipped", offset - len(line))
+        return records, offset
+
+    def _commit(self, offset: int) -> None:
+        """Запомнить смещение доставленного; очередь целиком доставлена — обрезать файл.
+        
+        Вызывается под _file_lock, как и дозапись в add(), поэтому между
+        проверкой размера и обрезкой новая запись не появится.
+        """
+        if offset >= CRM_OUTBOX_COMPACT_SIZE and offset == os.path.getsize(self._path):
+            os.truncate(self._path, 0)
+            offset = 0
+        _write_atomic(self.offset_path, str(offset).encode('ascii'))
+        self._offset = offset
+
+    async def _post(self, records: list) -> httpx.Response:
+        with span("crm.push", **{'crm.batch': len(records)}):
+            return await self._client.post(CRM_URL, json={'leads': records})
+
+    async def flush(self) -> int:
+        """Отправить всё, что накопилось; число отправленных лидов.
+        
+        Исключение — временная ошибка (сеть, 5xx, 429): смещение не
+        сдвигается, пачка будет отправлена ещё раз.
+        """
+        sent = 0
+        while True:
+            records, offset = await asyncio.to_thread(self._read_batch, self._offset)
+            if offset == self._offset:
+                return sent
+            if records:
+                response = await self._post(records)
+                if response.status_code in (408, 429) or response.status_code >= 500:
+                    raise CrmTemporaryError(response.status_code, response.headers.get('Retry-After'))
+                if response.is_success:
+                    self.stats['sent'] += len(records)
+                    sent += len(records)
+                else:
+                    # Пачку не примут и при повторе — откладываем, чтобы она не держала очередь
+                    self.stats['rejected'] += len(records)
+                    await asyncio.to_thread(self._reject, records, response)
+            self.stats['batches'] += 1
+            async with self._file_lock:
+                await asyncio.to_thread(self._commit, offset)
+
+    def _reject(self, records: list, response: httpx.Response) -> None:
+        logger.error("CRM rejected %s leads: %s %s", len(records), response.status_code, response.text[:500])
+        with open(self._path + ".rejected", 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    async def _run(self) -> None:
+        attempt = 0
+        while True:
+            self._wakeup.clear()
+            try:
+                sent = await self.flush()
+            except Exception as e:
+                # Экспоненциальная пауза со случайным разбросом, чтобы инстансы не били в CRM разом
+                attempt += 1
+                delay = min(CRM_MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.0)
+                if isinstance(e, CrmTemporaryError) and e.retry_after:
+                    delay = max(delay, e.retry_after)
+                self.stats['retries'] += 1
+                if isinstance(e, (httpx.HTTPError, CrmTemporaryError)):
+                    logger.warning("CRM push failed (%s), retry %s in %.1fs", e, attempt, delay)
+                else:
+                    # Файл очереди не читается или не пишется — это видно в /readyz
+                    self.error = str(e) or type(e).__name__
+                    logger.error("CRM outbox failed (%r), retry %s in %.1fs", e, attempt, delay)
+                await asyncio.sleep(delay)
+                continue
+            if sent:
+                logger.info("CRM: %s leads delivered", sent)
+            self.error = None
+            attempt = 0
+            await self._wakeup.wait()
+
+
+class CrmTemporaryError(Exception):
+    """Ответ CRM, после которого пачку стоит отправить ещё раз"""
+
+    def __init__(self, status: int, retry_after: str = None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        try:
+            self.retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            self.retry_after = None
+
+
+crm_outbox = CrmOutbox()
+
+
+# ============== НАПОМИНАНИЯ ==============
+# Одна куча (срок, номер, пользователь, вид) на все напоминания и одна задача
+# JobQueue, которая раз в REMINDER_TICK секунд снимает наступившие. У
+# пользователя не больше одного напоминания: новое заменяет старое, а отмена —
+# удаление из словаря «пользователь -> номер» за O(1). Записи кучи с чужим
+# номером устарели и пропускаются при извлечении.
+REMINDER_REQUEST = "request"
+REMINDER_SURVEY = "survey"
+REMINDER_SURVEY_SKIPPED = "survey_skipped"
+REMINDER_KINDS = (REMINDER_REQUEST, REMINDER_SURVEY, REMINDER_SURVEY_SKIPPED)
+# Виды «начатого и не законченного» — снимаются, когда диалог завершён
+_REMINDER_IN_PROGRESS = frozenset((REMINDER_REQUEST, REMINDER_SURVEY))
+
+_SURVEY_STATES = frozenset(range(SURVEY_HAS_PROJECT, SURVEY_GIVEAWAY_CONTACT + 1))
+_REQUEST_STATES = frozenset(range(REQUEST_REGION, REQUEST_CONTACT + 1))
+
+REMINDER_TEXTS = {
+    REMINDER_REQUEST: (
+        "📝 Вы не закончили заявку.\n\n"
+        "Заполнение займёт пару минут — специалист ADC Group свяжется с вами "
+        "и ответит на вопросы по проекту."
+    ),
+    REMINDER_SURVEY: (
+        "👋 Вы не ответили на пару вопросов анкеты.\n\n"
+        "Это займёт минуту и даёт право участвовать в розыгрыше эскизного проекта. "
+        "Продолжить: /start"
+    ),
+    REMINDER_SURVEY_SKIPPED: (
+        "🎁 Напоминаем о розыгрыше бесплатного эскизного проекта ({giveaway_prize}).\n\n"
+        "Расскажите о своём объекте — оставьте заявку, и мы учтём вас в розыгрыше."
+    ),
+}
+
+# Запись файла напоминаний: user_id, срок (unix time), код вида
+_REMINDER_RECORD = struct.Struct("<qdB")
+
+
+class ReminderScheduler:
+    """Отложенные напоминания пользователям"""
+
+    def __init__(self):
+        self._heap = []    # [(срок, номер, user_id, вид)]
+        self._active = {}  # user_id -> (номер, вид) действующей записи
+        self._seq = itertools.count()
+        self._dirty = False
+        self._saved_at = 0.0
+        self.stats = Counter()
+
+    def __len__(self) -> int:
+        return len(self._active)
+
+    def schedule(self, user_id: int, kind: str, delay: float = None) -> None:
+        """Напомнить через delay секунд (заменяет прежнее напоминание)"""
+        seq = next(self._seq)
+        due = time.time() + (REMINDER_DELAY if delay is None else delay)
+        heapq.heappush(self._heap, (due, seq, user_id, kind))
+        self._active[user_id] = (seq, kind)
+        self._dirty = True
+        # Устаревших записей стало больше, чем действующих, — пересобираем кучу
+        if len(self._heap) > 2 * len(self._active) + 1024:
+            self._heap = [entry for entry in self._heap if self._is_current(entry)]
+            heapq.heapify(self._heap)
+
+    def _is_current(self, entry: tuple) -> bool:
+        current = self._active.get(entry[2])
+        return current is not None and current[0] == entry[1]
+
+    def cancel(self, user_id: int) -> None:
+        if self._active.pop(user_id, None) is not None:
+            self._dirty = True
+
+    def kind(self, user_id: int):
+        """Вид действующего напоминания пользователя или None"""
+        current = self._active.get(user_id)
+        return current[1] if current is not None else None
+
+    def track(self, user_id: int, state) -> None:
+        """Учесть переход диалога: шаг анкеты или заявки откладывает напоминание"""
+        if state in _REQUEST_STATES:
+            self.schedule(user_id, REMINDER_REQUEST)
+        elif state in _SURVEY_STATES:
+            self.schedule(user_id, REMINDER_SURVEY)
+        elif state == ConversationHandler.END and self.kind(user_id) in _REMINDER_IN_PROGRESS:
+            self.cancel(user_id)
+
+    def pop_due(self, now: float, limit: int) -> list:
+        """До limit наступивших напоминаний [(user_id, вид)]"""
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            entry = heapq.heappop(self._heap)
+            if self._is_current(entry):
+                _, _, user_id, kind = entry
+                del self._active[user_id]
+                due.append((user_id, kind))
+                self._dirty = True
+        return due
+
+    def entries(self) -> list:
+        """Действующие напоминания [(user_id, срок, вид)]"""
+        return [(user_id, due, kind) for due, seq, user_id, kind in self._heap
+                if self._is_current((due, seq, user_id, kind))]
+
+    def save(self, path: str = None) -> None:
+        payload = b"".join(
+            _REMINDER_RECORD.pack(user_id, due, REMINDER_KINDS.index(kind))
+            for user_id, due, kind in self.entries()
+        )
+        try:
+            _write_atomic(path or REMINDERS_FILE, payload)
+        except OSError as e:
+            logger.error("Failed to save reminders: %s", e)
+            return
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def save_if_dirty(self, min_interval: float = 60.0) -> None:
+        if self._dirty and time.monotonic() - self._saved_at >= min_interval:
+            self.save()
+
+    def load(self, path: str = None) -> None:
+        try:
+            with open(path or REMINDERS_FILE, 'rb') as f:
+                payload = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.error("Failed to load reminders: %s", e)
+            return
+        payload = payload[:len(payload) - len(payload) % _REMINDER_RECORD.size]
+        self._heap = []
+        self._active = {}
+        for user_id, due, code in _REMINDER_RECORD.iter_unpack(payload):
+            if code < len(REMINDER_KINDS):
+                seq = next(self._seq)
+                kind = REMINDER_KINDS[code]
+                self._heap.append((due, seq, user_id, kind))
+                self._active[user_id] = (seq, kind)
+        heapq.heapify(self._heap)
+        self._dirty = False
+        logger.info("Reminders loaded: %s pending", len(self._active))
+
+
+reminders = ReminderScheduler()
+
+
+async def send_due_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отправка наступивших напоминаний (одна задача на всех пользователей)"""
+    for user_id, kind in reminders.pop_due(time.time(), REMINDER_BATCH):
+        keyboard = get_main_keyboard() if kind == REMINDER_SURVEY_SKIPPED else (
+            get_request_keyboard() if kind == REMINDER_REQUEST else None)
+        try:
+            await ManagerQueue._send_with_retry(
+                context.bot.send_message, chat_id=user_id, text=content.fill(REMINDER_TEXTS[kind]),
+                reply_markup=keyboard
+            )
+            reminders.stats[kind] += 1
+        except Forbidden:
+            # Пользователь заблокировал бота — больше не пишем
+            reminders.stats['blocked'] += 1
+        except Exception as e:
+            reminders.stats['failed'] += 1
+            logger.error("Failed to send reminder to %s: %s", user_id, e)
+    reminders.save_if_dirty()
+
+
+# ============== ВОРОНКА ==============
+# Переходы диалогов пишутся в кольцо из трёх массивов (время, пользователь,
+# состояние). Раз в FUNNEL_ROLLUP_INTERVAL секунд новые события сворачиваются
+# в почасовые счётчики по состояниям: сколько вошло, сколько завершили диалог
+# на этом шаге, сколько бросили (молчат дольше CONVERSATION_TIMEOUT) и
+# гистограмма времени на шаге. Закрытые часы дописываются в FUNNEL_FILE.
+FUNNEL_DWELL_BUCKETS = (5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+# Строка состояния: вошли, завершили, бросили, затем гистограмма
+_FUNNEL_ENTERED, _FUNNEL_ENDED, _FUNNEL_ABANDONED, _FUNNEL_DWELL = 0, 1, 2, 3
+_FUNNEL_ROW_SIZE = _FUNNEL_DWELL + len(FUNNEL_DWELL_BUCKETS) + 1
+
+FUNNEL_FLOWS = (
+    ("📋 Анкета", (
+        (SURVEY_HAS_PROJECT, "Есть ли объект"),
+        (SURVEY_OBJECT_TYPE, "Тип объекта"),
+        (SURVEY_AREA, "Площадь"),
+        (SURVEY_REGION, "Регион"),
+        (SURVEY_REGION_TEXT, "Регион текстом"),
+        (SURVEY_TIMELINE, "Сроки"),
+        (SURVEY_INTERESTS, "Интересы"),
+        (SURVEY_GIVEAWAY_CONTACT, "Контакт для розыгрыша"),
+    )),
+    ("📝 Заявка", (
+        (REQUEST_REGION, "1. Регион"),
+        (REQUEST_OBJECT_TYPE, "2. Тип объекта"),
+        (REQUEST_OBJECT_TYPE_CUSTOM, "2. Свой тип объекта"),
+        (REQUEST_AREA, "3. Площадь"),
+        (REQUEST_STAGE, "4. Стадия"),
+        (REQUEST_SERVICE, "5. Услуга"),
+        (REQUEST_BIM, "6. BIM"),
+        (REQUEST_SURVEY, "7. Смета"),
+        (REQUEST_TIMELINE, "8. Сроки"),
+        (REQUEST_COMMENT, "9. Комментарий"),
+        (REQUEST_FILES, "Файлы"),
+        (REQUEST_CONTACT, "Контакт"),
+    )),
+    ("❓ Технический вопрос", (
+        (TECH_QUESTION, "Вопрос"),
+    )),
+)
+
+
+def _funnel_hour(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H")
+
+
+class FunnelRollup:
+    """Счётчики воронки за один час: состояние -> строка счётчиков"""
+    __slots__ = ('hour', 'states')
+
+    def __init__(self, hour: str, states: dict = None):
+        self.hour = hour
+        self.states = states if states is not None else {}
+
+    def row(self, state: int) -> list:
+        row = self.states.get(state)
+        if row is None:
+            row = self.states[state] = [0] * _FUNNEL_ROW_SIZE
+        return row
+
+    def add_dwell(self, state: int, seconds: float) -> None:
+        self.row(state)[_FUNNEL_DWELL + bisect.bisect_left(FUNNEL_DWELL_BUCKETS, seconds)] += 1
+
+    def merge(self, other: 'FunnelRollup') -> None:
+        for state, counts in other.states.items():
+            row = self.row(state)
+            for i, value in enumerate(counts):
+                row[i] += value
+
+    def to_json(self) -> str:
+        return json.dumps({'hour': self.hour, 'states': {str(k): v for k, v in self.states.items()}},
+                          separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, line: str) -> 'FunnelRollup':
+        data = json.loads(line)
+        return cls(data['hour'], {int(k): v for k, v in data['states'].items()})
+
+
+def dwell_median(row: list):
+    """Медиана времени на шаге по гистограмме (верхняя граница корзины, сек)"""
+    histogram = row[_FUNNEL_DWELL:]
+    total = sum(histogram)
+    if not total:
+        return None
+    seen = 0
+    for bucket, count in enumerate(histogram):
+        seen += count
+        if seen * 2 >= total:
+            return FUNNEL_DWELL_BUCKETS[bucket] if bucket < len(FUNNEL_DWELL_BUCKETS) else math.inf
+    return math.inf
+
+
+class FunnelTracker:
+    """Кольцо событий переходов и почасовые сводки"""
+
+    def __init__(self, ring_size: int = FUNNEL_RING_SIZE):
+        self._times = array('d', bytes(8 * ring_size))
+        self._users = array('q', bytes(8 * ring_size))
+        self._states = array('b', bytes(ring_size))
+        self._written = 0   # всего записано событий
+        self._consumed = 0  # из них свёрнуто
+        self._positions = {}  # user_id -> (состояние, время входа)
+        self._current = None
+        self.hours = deque(maxlen=FUNNEL_KEEP_HOURS)
+        self.dropped = 0
+
+    def record(self, user_id: int, state) -> None:
+        """Переход диалога пользователя (None — остался в том же состоянии)"""
+        if state is None:
+            return
+        i = self._written % len(self._states)
+        self._times[i] = time.time()
+        self._users[i] = user_id
+        self._states[i] = state
+        self._written += 1
+
+    def _bucket(self, timestamp: float) -> FunnelRollup:
+        hour = _funnel_hour(timestamp)
+        if self._current is None:
+            self._current = FunnelRollup(hour)
+        elif self._current.hour != hour:
+            self.close_hour()
+            self._current = FunnelRollup(hour)
+        return self._current
+
+    def rollup(self, now: float = None) -> None:
+        """Свернуть новые события в счётчики текущего часа"""
+        now = time.time() if now is None else now
+        size = len(self._states)
+        if self._written - self._consumed > size:
+            # Кольцо обогнало свёртку — самые старые события потеряны
+            self.dropped += self._written - self._consumed - size
+            self._consumed = self._written - size
+        for n in range(self._consumed, self._written):
+            i = n % size
+            self._apply(self._users[i], self._states[i], self._times[i])
+        self._consumed = self._written
+        
+        # Кто молчит дольше таймаута диалога — бросил на своём шаге
+        deadline = now - CONVERSATION_TIMEOUT
+        stale = [user_id for user_id, (_, entered) in self._positions.items() if entered < deadline]
+        bucket = self._bucket(now)
+        for user_id in stale:
+            state, _ = self._positions.pop(user_id)
+            bucket.row(state)[_FUNNEL_ABANDONED] += 1
+            bucket.add_dwell(state, CONVERSATION_TIMEOUT)
+
+    def _apply(self, user_id: int, state: int, timestamp: float) -> None:
+        bucket = self._bucket(timestamp)
+        previous = self._positions.get(user_id)
+        if previous is not None:
+            if previous[0] == state:
+                return  # повтор шага (ещё файл, ещё интерес) — не переход
+            bucket.add_dwell(previous[0], timestamp - previous[1])
+            if state == ConversationHandler.END:
+                bucket.row(previous[0])[_FUNNEL_ENDED] += 1
+        if state == ConversationHandler.END:
+            self._positions.pop(user_id, None)
+            return
+        bucket.row(state)[_FUNNEL_ENTERED] += 1
+        self._positions[user_id] = (state, timestamp)
+
+    def close_hour(self) -> None:
+        """Дописать текущий час в FUNNEL_FILE (строки — приращения, складываются)"""
+        if self._current is None or not self._current.states:
+            return
+        self.hours.append(self._current)
+        try:
+            with open(FUNNEL_FILE, 'a', encoding='utf-8') as f:
+                f.write(self._current.to_json() + "\n")
+        except OSError as e:
+            logger.error("Failed to save funnel rollup: %s", e)
+        self._current = None
+
+    def load(self) -> None:
+        """Почасовые сводки за последние FUNNEL_KEEP_HOURS часов"""
+        hours = OrderedDict()
+        try:
+            with open(FUNNEL_FILE, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rollup = FunnelRollup.from_json(line)
+                    except (ValueError, KeyError):
+                        continue
+                    if rollup.hour in hours:
+                        hours[rollup.hour].merge(rollup)
+                    else:
+                        hours[rollup.hour] = rollup
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.error("Failed to load funnel: %s", e)
+            return
+        self.hours.clear()
+        self.hours.extend(list(hours.values())[-FUNNEL_KEEP_HOURS:])
+
+    def summary(self, hours: int) -> FunnelRollup:
+        """Сумма сводок за последние hours часов, включая текущий"""
+        since = _funnel_hour(time.time() - hours * 3600)
+        total = FunnelRollup("")
+        for rollup in list(self.hours) + ([self._current] if self._current else []):
+            if rollup.hour > since:
+                total.merge(rollup)
+        return total
+
+
+funnel = FunnelTracker()
+
+
+async def funnel_rollup_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая свёртка событий воронки"""
+    funnel.rollup()
+
+
+# ============== КАТАЛОГ ТЕКСТОВ ==============
+# Тексты страниц и ответов собираются в неизменяемый ContentCatalog: подстановки
+# выполнены, клавиатуры подобраны. Обработчики только читают текущий каталог,
+# а перезагрузка собирает новый и подменяет его одним присваиванием.
+# Файл CONTENT_FILE переопределяет любые из разделов (vars и pages — по ключам,
+# answers — списком целиком):
+#   {"vars": {"giveaway_date": "..."}, "pages": {"giveaway": "..."},
+#    "answers": [{"keywords": ["..."], "text": "..."} | {"keywords": [...], "page": "..."}],
+#    "fallback": "..."}
+DEFAULT_PAGES = {
+    'company': COMPANY_INFO,
+    'services': SERVICES_INFO,
+    'objects': OBJECT_TYPES,
+    'portfolio': PORTFOLIO_INFO,
+    'giveaway': GIVEAWAY_INFO,
+}
+# Страница -> клавиатура под ней
+_PAGE_KEYBOARDS = {
+    'company': get_request_keyboard,
+    'services': get_request_keyboard,
+    'objects': get_request_keyboard,
+    'portfolio': get_request_keyboard,
+    'giveaway': get_back_keyboard,
+}
+
+
+class ContentCatalog:
+    """Неизменяемый каталог текстов бота"""
+    __slots__ = ('pages', 'answers', 'fallback', 'vars', 'source')
+
+    def __init__(self, pages, answers: tuple, fallback: str, variables, source: str):
+        object.__setattr__(self, 'pages', pages)
+        object.__setattr__(self, 'answers', answers)
+        object.__setattr__(self, 'fallback', fallback)
+        object.__setattr__(self, 'vars', variables)
+        object.__setattr__(self, 'source', source)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ContentCatalog is immutable")
+
+    @classmethod
+    def build(cls, data: dict, source: str = "built-in") -> 'ContentCatalog':
+        """Каталог из содержимого файла поверх встроенных текстов; ValueError при ошибке"""
+        if not isinstance(data, dict):
+            raise ValueError("content must be a JSON object")
+        variables = dict(DEFAULT_CONTENT_VARS, portfolio_url=PORTFOLIO_URL, site_url=SITE_URL,
+                         channel_url=CHANNEL_URL)
+        variables.update(_content_section(data, 'vars', dict))
+        
+        def render(text, where: str) -> str:
+            if not isinstance(text, str) or not text.strip():
+                raise ValueError(f"{where}: expected non-empty text")
+            for name, value in variables.items():
+                text = text.replace("{" + name + "}", str(value))
+            if len(text) > MESSAGE_LIMIT:
+                raise ValueError(f"{where}: longer than {MESSAGE_LIMIT} characters")
+            return text
+        
+        page_texts = dict(DEFAULT_PAGES)
+        for name, text in _content_section(data, 'pages', dict).items():
+            if name not in DEFAULT_PAGES:
+                raise ValueError(f"pages: unknown page {name!r}")
+            page_texts[name] = text
+        pages = types.MappingProxyType({
+            name: (render(text, f"pages.{name}"), _PAGE_KEYBOARDS[name]())
+            for name, text in page_texts.items()
+        })
+        
+        answers = []
+        for n, answer in enumerate(_content_section(data, 'answers', list) or DEFAULT_ANSWERS):
+            where = f"answers[{n}]"
+            keywords = answer.get('keywords') if isinstance(answer, dict) else None
+            if not keywords or not all(isinstance(k, str) and k for k in keywords):
+                raise ValueError(f"{where}: keywords must be a list of strings")
+            if 'page' in answer:
+                if answer['page'] not in pages:
+                    raise ValueError(f"{where}: unknown page {answer['page']!r}")
+                reply = pages[answer['page']]
+            else:
+                reply = (render(answer.get('text'), where), None)
+            answers.append((tuple(k.lower() for k in keywords), reply))
+        
+        fallback = render(data.get('fallback', DEFAULT_FALLBACK), "fallback")
+        return cls(pages, tuple(answers), fallback, types.MappingProxyType(variables), source)
+
+    def page(self, name: str) -> tuple:
+        """(текст, клавиатура) страницы меню"""
+        return self.pages[name]
+
+    def answer(self, text: str):
+        """(текст, клавиатура) ответа на сообщение или None"""
+        text = text.lower()
+        for keywords, reply in self.answers:
+            if any(keyword in text for keyword in keywords):
+                return reply
+        return None
+
+    def fill(self, template: str) -> str:
+        """Подставить переменные каталога в текст"""
+        for name, value in self.vars.items():
+            template = template.replace("{" + name + "}", str(value))
+        return template
+
+
+def _content_section(data: dict, key: str, kind: type):
+    value = data.get(key, kind())
+    if not isinstance(value, kind):
+        raise ValueError(f"{key}: expected {kind.__name__}")
+    return value
+
+
+def _content_signature():
+    """(mtime_ns, размер) файла каталога или None, если файла нет"""
+    if not CONTENT_FILE:
+        return None
+    try:
+        stat = os.stat(CONTENT_FILE)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_content() -> tuple:
+    """(каталог, подпись файла); OSError/ValueError, если файл не годится"""
+    signature = _content_signature()
+    if signature is None:
+        return ContentCatalog.build({}), None
+    with open(CONTENT_FILE, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return ContentCatalog.build(data, source=CONTENT_FILE), signature
 
 
-def get_region_keyboard():
-    """Клавиатура выбора региона"""
-    keyboard = [
-        [InlineKeyboardButton("Москва", callback_data="region_moscow")],
-        [InlineKeyboardButton("Московская область", callback_data="region_mo")],
-        [InlineKeyboardButton("Санкт-Петербург / ЛО", callback_data="region_spb")],
-        [InlineKeyboardButton("Другой регион", callback_data="region_other")],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+# Текущий каталог; заменяется целиком
+content = ContentCatalog.build({})
+_content_signature_loaded = None
 
 
-def get_timeline_keyboard():
-    """Клавиатура выбора сроков"""
-    keyboard = [
-        [InlineKeyboardButton("Уже ищем подрядчика", callback_data="time_now")],
-        [InlineKeyboardButton("В ближайшие 1-3 месяца", callback_data="time_3m")],
-        [InlineKeyboardButton("В этом году", callback_data="time_year")],
-        [InlineKeyboardButton("Пока изучаю вопрос", callback_data="time_later")],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+def install_content(catalog: ContentCatalog, signature) -> None:
+    global content, _content_signature_loaded
+    content = catalog
+    _content_signature_loaded = signature
+    logger.info("Content catalog loaded from %s: %s pages, %s answers",
+                catalog.source, len(catalog.pages), len(catalog.answers))
 
 
-def get_interests_keyboard():
-    """Клавиатура выбора интересов по каналу"""
-    keyboard = [
-        [InlineKeyboardButton("Изменения в законодательстве", callback_data="int_law")],
-        [InlineKeyboardButton("Разборы кейсов и ошибок", callback_data="int_cases")],
-        [InlineKeyboardButton("Стоимость проектирования", callback_data="int_cost")],
-        [InlineKeyboardButton("BIM и цифровизация", callback_data="int_bim")],
-        [InlineKeyboardButton("Экспертиза и согласования", callback_data="int_expertise")],
-        [InlineKeyboardButton("Господдержка и субсидии", callback_data="int_support")],
-        [InlineKeyboardButton("✅ Готово", callback_data="int_done")],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+async def reload_content(force: bool = False) -> bool:
+    """Перечитать файл каталога, если он изменился; True — каталог заменён"""
+    signature = await asyncio.to_thread(_content_signature)
+    if not force and signature == _content_signature_loaded:
+        return False
+    catalog, signature = await asyncio.to_thread(load_content)
+    install_content(catalog, signature)
+    return True
 
 
-def get_giveaway_keyboard():
-    """Клавиатура участия в розыгрыше"""
-    keyboard = [
-        [InlineKeyboardButton("Да, участвую", callback_data="giveaway_yes")],
-        [InlineKeyboardButton("Нет, спасибо", callback_data="giveaway_no")],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+async def content_watch_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Проверка, не изменился ли файл каталога"""
+    try:
+        await reload_content()
+    except (OSError, ValueError) as e:
+        # Битый файл не должен ломать бота — работаем на прежнем каталоге
+        logger.error("Content file rejected, keeping previous catalog: %s", e)
+        global _content_signature_loaded
+        _content_signature_loaded = await asyncio.to_thread(_content_signature)
 
 
 # ============== УВЕДОМЛЕНИЕ АДМИНУ ==============
-async def notify_admin_lead(context: ContextTypes.DEFAULT_TYPE, user_data: dict) -> None:
-    """Отправка уведомления администратору о новом лиде"""
+async def notify_admin_lead(context: ContextTypes.DEFAULT_TYPE, user_data: dict, update_id: int) -> None:
+    """Отправка уведомления администратору о новом лиде из апдейта update_id"""
     admin_id = ADMIN_CHAT_ID or MANAGER_CHAT_ID
-    if not admin_id:
+    if not admin_id and not manager_pool.enabled:
+        return
+    
+    fingerprint = lead_fingerprint('survey', user_data.get('user_id'), user_data, update_id)
+    if update_journal.has_lead(fingerprint):
+        logger.info("Duplicate lead from user %s skipped", user_data.get('user_id'))
         return
     
+    score = score_lead(user_data)
+    priority = lead_priority(score)
+    
     try:
         if user_data.get('has_project'):
             message = (
-                "📋 НОВАЯ ЗАЯВКА ИЗ БОТА!\n\n"
+                "📋 НОВАЯ ЗАЯВКА ИЗ БОТА!\n"
+                f"{PRIORITY_TITLES[priority]} ({score})\n\n"
                 f"👤 {user_data.get('full_name', 'Пользователь')} "
                 f"(@{user_data.get('username', 'нет')})\n"
                 f"🆔 ID: {user_data.get('user_id')}\n\n"
@@ -344,23 +4241,39 @@ async def notify_admin_lead(context: ContextTypes.DEFAULT_TYPE, user_data: dict)
                 f"📅 {datetime.now().strftime('%d.%m.%Y %H:%M')}"
             )
         else:
+            # Подписчик без проекта — в периодическую сводку, а не отдельным сообщением
+            if not admin_id:
+                return
             interests = user_data.get('interests', [])
-            message = (
-                "👤 НОВЫЙ ПОДПИСЧИК\n\n"
+            add_to_digest(admin_id, DigestEntry(
+                DIGEST_SUBSCRIBER,
                 f"👤 {user_data.get('full_name', 'Пользователь')} "
-                f"(@{user_data.get('username', 'нет')})\n"
-                f"🆔 ID: {user_data.get('user_id')}\n\n"
-                f"📋 Проект: нет\n"
+                f"(@{user_data.get('username', 'нет')}, ID {user_data.get('user_id')})\n"
                 f"📌 Интересы: {', '.join(interests) if interests else '—'}\n"
-                f"🎁 Розыгрыш: {'да' if user_data.get('giveaway_participant') else 'нет'}\n\n"
-                f"📅 {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            )
+                f"🎁 Розыгрыш: {'да' if user_data.get('giveaway_participant') else 'нет'}"
+                f" · {datetime.now().strftime('%H:%M')}",
+                on_sent=functools.partial(update_journal.record_lead, fingerprint)
+            ))
+            return
         
-        await context.bot.send_message(chat_id=admin_id, text=message)
-        logger.info(f"Admin notified about user {user_data.get('user_id')}")
+        # Лид с проектом — менеджеру из пула, с кнопкой подтверждения
+        chat_id, ack = admin_id, None
+        if manager_pool.enabled:
+            survey_id = format_lead_id(fingerprint)
+            chat_id = manager_pool.assign(survey_id, user_data)
+            ack = (survey_id, user_data.get('full_name') or f"ID {user_data.get('user_id')}")
+        manager_queue.put(Notification(
+            priority, chat_id, message,
+            on_sent=functools.partial(update_journal.record_lead, fingerprint),
+            on_failed=functools.partial(manager_pool.release, ack[0]) if ack else None, ack=ack
+        ))
+        logger.info(
+            "Admin notification queued for user %s to %s (%s, score %s)",
+            user_data.get('user_id'), chat_id, PRIORITY_NAMES[priority], score, extra={"sampled": True}
+        )
         
     except Exception as e:
-        logger.error(f"Failed to notify admin: {e}")
+        logger.error("Failed to notify admin: %s", e)
 
 
 # ============== КОМАНДА /START ==============
@@ -438,10 +4351,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def giveaway_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда /giveaway — информация о розыгрыше"""
-    await update.message.reply_text(
-        GIVEAWAY_INFO,
-        reply_markup=get_back_keyboard()
-    )
+    text, keyboard = content.page("giveaway")
+    await update.message.reply_text(text, reply_markup=keyboard)
 
 
 # ============== ПРИВЕТСТВЕННАЯ АНКЕТА ==============
@@ -475,21 +4386,14 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     elif data == "survey_skip":
         # Сохраняем минимальные данные
-        user_data = {
-            'user_id': context.user_data.get('user_id'),
-            'username': context.user_data.get('username'),
-            'full_name': context.user_data.get('full_name'),
-            'first_contact': context.user_data.get('first_contact'),
-            'has_project': None,
-            'survey_completed': False,
-            'source': 'skip'
-        }
+        user_data = new_user_record(context, source='skip')
         save_user_data(context.user_data.get('user_id'), user_data)
+        reminders.schedule(update.effective_user.id, REMINDER_SURVEY_SKIPPED)
         
         await query.edit_message_text(
             "Хорошо! Если появятся вопросы — пишите.\n\n"
             "🎁 Кстати, у нас сейчас розыгрыш бесплатного эскизного проекта "
-            "(от 150 000 ₽). Итоги 28 февраля.\n\n"
+            f"({content.vars['giveaway_prize']}). Итоги {content.vars['giveaway_date']}.\n\n"
             "Выберите раздел:",
             reply_markup=get_main_keyboard()
         )
@@ -497,17 +4401,7 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # === Тип объекта ===
     elif data.startswith("obj_"):
-        obj_types = {
-            "obj_warehouse": "Склад / логистика",
-            "obj_production": "Производство",
-            "obj_office": "Офис / БЦ",
-            "obj_retail": "Торговый центр",
-            "obj_hotel": "Гостиница / апартаменты",
-            "obj_medical": "Медицина / социальное",
-            "obj_residential": "Жильё / МЖД",
-            "obj_other": "Другое"
-        }
-        context.user_data['object_type'] = obj_types.get(data, "Не указано")
+        context.user_data['object_type'] = OBJECT_TYPE_LABELS.get(data, "Не указано")
         
         await query.edit_message_text(
             f"✅ Тип объекта: {context.user_data['object_type']}\n\n"
@@ -518,15 +4412,7 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # === Площадь ===
     elif data.startswith("area_"):
-        areas = {
-            "area_1000": "до 1 000 м²",
-            "area_5000": "1 000 – 5 000 м²",
-            "area_10000": "5 000 – 10 000 м²",
-            "area_30000": "10 000 – 30 000 м²",
-            "area_30000plus": "более 30 000 м²",
-            "area_unknown": "Пока не определена"
-        }
-        context.user_data['area'] = areas.get(data, "Не указано")
+        context.user_data['area'] = AREA_LABELS.get(data, "Не указано")
         
         await query.edit_message_text(
             f"✅ Площадь: {context.user_data['area']}\n\n"
@@ -543,12 +4429,7 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return SURVEY_REGION_TEXT
         
-        regions = {
-            "region_moscow": "Москва",
-            "region_mo": "Московская область",
-            "region_spb": "Санкт-Петербург / ЛО"
-        }
-        context.user_data['region'] = regions.get(data, "Не указано")
+        context.user_data['region'] = REGION_LABELS.get(data, "Не указано")
         
         await query.edit_message_text(
             f"✅ Регион: {context.user_data['region']}\n\n"
@@ -559,33 +4440,25 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # === Сроки ===
     elif data.startswith("time_"):
-        timelines = {
-            "time_now": "Уже ищем подрядчика",
-            "time_3m": "В ближайшие 1-3 месяца",
-            "time_year": "В этом году",
-            "time_later": "Пока изучаю вопрос"
-        }
-        context.user_data['timeline'] = timelines.get(data, "Не указано")
+        context.user_data['timeline'] = TIMELINE_LABELS.get(data, "Не указано")
         
         # Сохраняем данные
-        user_data = {
-            'user_id': context.user_data.get('user_id'),
-            'username': context.user_data.get('username'),
-            'full_name': context.user_data.get('full_name'),
-            'first_contact': context.user_data.get('first_contact'),
-            'has_project': True,
-            'object_type': context.user_data.get('object_type'),
-            'area': context.user_data.get('area'),
-            'region': context.user_data.get('region'),
-            'timeline': context.user_data.get('timeline'),
-            'survey_completed': True,
-            'giveaway_participant': True,  # Автоматически участвует
-            'source': 'survey'
-        }
+        user_data = new_user_record(
+            context,
+            has_project=True,
+            object_type=context.user_data.get('object_type'),
+            area=context.user_data.get('area'),
+            region=context.user_data.get('region'),
+            timeline=context.user_data.get('timeline'),
+            survey_completed=True,
+            giveaway_participant=True,  # Автоматически участвует
+            source='survey',
+        )
+        await crm_outbox.add('survey', user_data, update.update_id)
         save_user_data(context.user_data.get('user_id'), user_data)
         
         # Уведомляем админа
-        await notify_admin_lead(context, user_data)
+        await notify_admin_lead(context, user_data, update.update_id)
         
         await query.edit_message_text(
             "✅ Спасибо! Данные сохранены.\n\n"
@@ -596,7 +4469,7 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "Если нужна консультация или расчёт стоимости — "
             "нажмите «Оставить заявку» или позвоните: +7 939 111-30-42\n\n"
             "🎁 Кстати, у нас сейчас розыгрыш бесплатного эскизного проекта "
-            "(от 150 000 ₽). Вы уже участвуете! Итоги 28 февраля.",
+            f"({content.vars['giveaway_prize']}). Вы уже участвуете! Итоги {content.vars['giveaway_date']}.",
             reply_markup=get_main_keyboard()
         )
         return ConversationHandler.END
@@ -604,26 +4477,18 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # === Интересы по каналу ===
     elif data.startswith("int_"):
         if data == "int_done":
-            # Завершаем выбор интересов
+            # Завершаем выбор интересов — отложенная отрисовка больше не нужна
+            cancel_interests_render(query)
             await query.edit_message_text(
                 "Спасибо! Учтём ваши предпочтения.\n\n"
                 "🎁 В канале сейчас проходит розыгрыш бесплатного эскизного "
-                "проекта стоимостью от 150 000 ₽.\n\n"
+                f"проекта стоимостью {content.vars['giveaway_prize']}.\n\n"
                 "Хотите участвовать?",
                 reply_markup=get_giveaway_keyboard()
             )
             return SURVEY_INTERESTS
         
-        interests_map = {
-            "int_law": "Законодательство",
-            "int_cases": "Кейсы и ошибки",
-            "int_cost": "Стоимость",
-            "int_bim": "BIM",
-            "int_expertise": "Экспертиза",
-            "int_support": "Господдержка"
-        }
-        
-        interest = interests_map.get(data)
+        interest = INTEREST_LABELS.get(data)
         if interest:
             if 'interests' not in context.user_data:
                 context.user_data['interests'] = []
@@ -633,15 +4498,8 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             else:
                 context.user_data['interests'].append(interest)
         
-        selected = context.user_data.get('interests', [])
-        selected_text = ", ".join(selected) if selected else "ничего не выбрано"
-        
-        await query.edit_message_text(
-            f"Какие темы вам интересны?\n\n"
-            f"Выбрано: {selected_text}\n\n"
-            "Выберите и нажмите «Готово»:",
-            reply_markup=get_interests_keyboard()
-        )
+        # Сообщение перерисуем один раз, когда пользователь перестанет нажимать
+        schedule_interests_render(query, context)
         return SURVEY_INTERESTS
     
     # === Розыгрыш ===
@@ -656,21 +4514,18 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     elif data == "giveaway_no":
         # Сохраняем данные без участия в розыгрыше
-        user_data = {
-            'user_id': context.user_data.get('user_id'),
-            'username': context.user_data.get('username'),
-            'full_name': context.user_data.get('full_name'),
-            'first_contact': context.user_data.get('first_contact'),
-            'has_project': False,
-            'interests': context.user_data.get('interests', []),
-            'giveaway_participant': False,
-            'survey_completed': True,
-            'source': 'survey'
-        }
+        user_data = new_user_record(
+            context,
+            has_project=False,
+            interests=context.user_data.get('interests', []),
+            survey_completed=True,
+            source='survey',
+        )
+        await crm_outbox.add('survey', user_data, update.update_id)
         save_user_data(context.user_data.get('user_id'), user_data)
         
         # Уведомляем админа
-        await notify_admin_lead(context, user_data)
+        await notify_admin_lead(context, user_data, update.update_id)
         
         await query.edit_message_text(
             "Хорошо! Если появится проект — пишите, поможем с расчётом.\n\n"
@@ -681,10 +4536,8 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # === Информация о розыгрыше ===
     elif data == "giveaway_info":
-        await query.edit_message_text(
-            GIVEAWAY_INFO,
-            reply_markup=get_back_keyboard()
-        )
+        text, keyboard = content.page("giveaway")
+        await query.edit_message_text(text, reply_markup=keyboard)
         return ConversationHandler.END
     
     return ConversationHandler.END
@@ -693,6 +4546,7 @@ async def survey_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def survey_region_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Получение региона текстом"""
     context.user_data['region'] = update.message.text
+    search_index.add(update.effective_user.id, TEXT_REGION, update.message.text)
     
     keyboard = get_timeline_keyboard()
     
@@ -710,27 +4564,25 @@ async def survey_giveaway_contact(update: Update, context: ContextTypes.DEFAULT_
     context.user_data['contact'] = contact
     
     # Сохраняем данные
-    user_data = {
-        'user_id': context.user_data.get('user_id'),
-        'username': context.user_data.get('username'),
-        'full_name': context.user_data.get('full_name'),
-        'first_contact': context.user_data.get('first_contact'),
-        'has_project': False,
-        'interests': context.user_data.get('interests', []),
-        'giveaway_participant': True,
-        'giveaway_contact': contact,
-        'survey_completed': True,
-        'source': 'survey'
-    }
+    user_data = new_user_record(
+        context,
+        has_project=False,
+        interests=context.user_data.get('interests', []),
+        giveaway_participant=True,
+        giveaway_contact=contact,
+        survey_completed=True,
+        source='survey',
+    )
+    await crm_outbox.add('survey', user_data, update.update_id)
     save_user_data(context.user_data.get('user_id'), user_data)
     
     # Уведомляем админа
-    await notify_admin_lead(context, user_data)
+    await notify_admin_lead(context, user_data, update.update_id)
     
     await update.message.reply_text(
         "🎉 Вы зарегистрированы в розыгрыше!\n\n"
         f"Контакт: {contact}\n\n"
-        "Итоги объявим 28 февраля 2026 в канале @ADC_Project\n\n"
+        f"Итоги объявим {content.vars['giveaway_date']} в канале @ADC_Project\n\n"
         "Удачи! 🍀",
         reply_markup=get_main_keyboard()
     )
@@ -756,34 +4608,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
     
     elif data == "company":
-        await query.edit_message_text(
-            COMPANY_INFO,
-            reply_markup=get_request_keyboard()
-        )
+        text, keyboard = content.page("company")
+        await query.edit_message_text(text, reply_markup=keyboard)
     
     elif data == "services":
-        await query.edit_message_text(
-            SERVICES_INFO,
-            reply_markup=get_request_keyboard()
-        )
+        text, keyboard = content.page("services")
+        await query.edit_message_text(text, reply_markup=keyboard)
     
     elif data == "objects":
-        await query.edit_message_text(
-            OBJECT_TYPES,
-            reply_markup=get_request_keyboard()
-        )
+        text, keyboard = content.page("objects")
+        await query.edit_message_text(text, reply_markup=keyboard)
     
     elif data == "portfolio":
-        await query.edit_message_text(
-            PORTFOLIO_INFO,
-            reply_markup=get_request_keyboard()
-        )
+        text, keyboard = content.page("portfolio")
+        await query.edit_message_text(text, reply_markup=keyboard)
     
     elif data == "giveaway_info":
-        await query.edit_message_text(
-            GIVEAWAY_INFO,
-            reply_markup=get_back_keyboard()
-        )
+        text, keyboard = content.page("giveaway")
+        await query.edit_message_text(text, reply_markup=keyboard)
     
     elif data == "request":
         await query.edit_message_text(
@@ -877,6 +4719,7 @@ async def get_object_type(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def get_object_type_custom(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Получение пользовательского типа объекта"""
     context.user_data['object_type'] = update.message.text + " (указано пользователем)"
+    search_index.add(update.effective_user.id, TEXT_OBJECT_TYPE, update.message.text)
     
     await update.message.reply_text(
         "Шаг 3 из 9\n"
@@ -1020,6 +4863,7 @@ async def get_timeline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 async def get_comment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Получение комментария"""
     context.user_data['comment'] = update.message.text
+    search_index.add(update.effective_user.id, TEXT_COMMENT, update.message.text)
     
     await update.message.reply_text(
         "📎 Хотите приложить файлы?\n\n"
@@ -1032,9 +4876,16 @@ async def get_comment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 async def get_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Получение файлов"""
     if update.message.document:
+        document = update.message.document
         if 'files' not in context.user_data:
             context.user_data['files'] = []
-        context.user_data['files'].append(update.message.document.file_id)
+        context.user_data['files'].append(document.file_id)
+        attachment = Attachment(
+            update.effective_user.id, document.file_id, document.file_unique_id,
+            document.file_name, document.file_size
+        )
+        context.user_data.setdefault('attachments', []).append(attachment.link())
+        attachment_archiver.put(attachment)
         
         await update.message.reply_text(
             f"✅ Файл получен ({len(context.user_data['files'])})\n\n"
@@ -1045,7 +4896,13 @@ async def get_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     elif update.message.photo:
         if 'files' not in context.user_data:
             context.user_data['files'] = []
-        context.user_data['files'].append(update.message.photo[-1].file_id)
+        photo = update.message.photo[-1]
+        context.user_data['files'].append(photo.file_id)
+        attachment = Attachment(
+            update.effective_user.id, photo.file_id, photo.file_unique_id, file_size=photo.file_size
+        )
+        context.user_data.setdefault('attachments', []).append(attachment.link())
+        attachment_archiver.put(attachment)
         
         await update.message.reply_text(
             f"✅ Фото получено ({len(context.user_data['files'])})\n\n"
@@ -1068,8 +4925,12 @@ async def get_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     context.user_data['contact'] = update.message.text
     user = update.effective_user
     
+    score = score_lead(context.user_data, request=True)
+    priority = lead_priority(score)
+    
     # Формируем заявку
     request_text = f"""📝 НОВАЯ ЗАЯВКА
+{PRIORITY_TITLES[priority]} ({score})
 
 👤 {user.full_name or 'Пользователь'}
 🆔 ID: {user.id}
@@ -1090,28 +4951,37 @@ async def get_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 📅 {datetime.now().strftime('%d.%m.%Y %H:%M')}"""
     
-    # Отправляем менеджеру
-    if MANAGER_CHAT_ID:
-        try:
-            await context.bot.send_message(
-                chat_id=MANAGER_CHAT_ID,
-                text=request_text
-            )
-            
-            # Отправляем файлы
-            for file_id in context.user_data.get('files', []):
-                try:
-                    await context.bot.send_document(
-                        chat_id=MANAGER_CHAT_ID,
-                        document=file_id,
-                        caption=f"Файл от {user.full_name} (ID: {user.id})"
-                    )
-                except:
-                    pass
-            
-            logger.info(f"Request sent from user: {user.id}")
-        except Exception as e:
-            logger.error(f"Failed to send request: {e}")
+    request_fields = {
+        key: context.user_data.get(key)
+        for key in ('region', 'object_type', 'area', 'stage', 'service', 'bim',
+                    'survey', 'timeline', 'comment', 'contact', 'files')
+    }
+    fingerprint = lead_fingerprint('request', user.id, request_fields, update.update_id)
+    
+    await crm_outbox.add('request', dict(
+        request_fields, user_id=user.id, username=user.username, full_name=user.full_name,
+        files=len(request_fields['files'] or []), attachments=context.user_data.get('attachments', []),
+        score=score, priority=PRIORITY_NAMES[priority]
+    ), update.update_id)
+    
+    # Отправляем менеджеру (повторно доставленную заявку — нет)
+    if (MANAGER_CHAT_ID or manager_pool.enabled) and update_journal.has_lead(fingerprint):
+        logger.info("Duplicate request from user %s skipped", user.id)
+    elif MANAGER_CHAT_ID or manager_pool.enabled:
+        chat_id, ack = MANAGER_CHAT_ID, None
+        if manager_pool.enabled:
+            request_id = format_lead_id(fingerprint)
+            chat_id = manager_pool.assign(request_id, context.user_data)
+            ack = (request_id, user.full_name or f"ID {user.id}")
+        caption = f"Файл от {user.full_name} (ID: {user.id})"
+        manager_queue.put(Notification(
+            priority, chat_id, request_text,
+            files=[(file_id, caption) for file_id in context.user_data.get('files', [])],
+            on_sent=functools.partial(update_journal.record_lead, fingerprint),
+            on_failed=functools.partial(manager_pool.release, ack[0]) if ack else None, ack=ack
+        ))
+        logger.info("Request queued from user %s to %s (%s, score %s)",
+                    user.id, chat_id, PRIORITY_NAMES[priority], score)
     
     await update.message.reply_text(
         "✅ Заявка отправлена!\n\n"
@@ -1144,6 +5014,7 @@ async def get_tech_question(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Получение технического вопроса"""
     question = update.message.text
     user = update.effective_user
+    search_index.add(user.id, TEXT_TECH_QUESTION, question)
     
     if MANAGER_CHAT_ID:
         try:
@@ -1156,9 +5027,9 @@ async def get_tech_question(update: Update, context: ContextTypes.DEFAULT_TYPE)
                      f"💬 Вопрос:\n{question}\n\n"
                      f"@{user.username if user.username else 'нет username'}"
             )
-            logger.info(f"Tech question sent from user: {user.id}")
+            logger.info("Tech question sent from user: %s", user.id)
         except Exception as e:
-            logger.error(f"Failed to send tech question: {e}")
+            logger.error("Failed to send tech question: %s", e)
     
     await update.message.reply_text(
         "✅ Вопрос отправлен!\n\n"
@@ -1178,126 +5049,667 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     text = update.message.text.lower()
     user = update.effective_user
     
-    # Проверяем ключевое слово "розыгрыш"
-    if "розыгрыш" in text:
-        await update.message.reply_text(
-            GIVEAWAY_INFO,
-            reply_markup=get_back_keyboard()
-        )
+    # Ответ на ключевые слова из каталога
+    answer = content.answer(text)
+    if answer is not None:
+        reply, keyboard = answer
+        await update.message.reply_text(reply, reply_markup=keyboard)
         return
     
-    # Простые ответы на ключевые слова
-    if any(word in text for word in ["привет", "здравствуй", "добрый"]):
-        await update.message.reply_text(
-            "Здравствуйте! 👋\n\n"
-            "Я — навигатор канала ADC Group.\n"
-            "Нажмите /start для просмотра меню."
-        )
+    await update.message.reply_text(content.fallback)
     
-    elif any(word in text for word in ["цена", "стоимость", "сколько стоит", "прайс"]):
-        await update.message.reply_text(
-            "💰 Стоимость зависит от типа и площади объекта.\n\n"
-            "Для расчёта оставьте заявку — наш специалист "
-            "подготовит коммерческое предложение.\n\n"
-            "📝 /request — оставить заявку"
-        )
+    # Неотвеченный вопрос — в сводку для менеджера
+    if MANAGER_CHAT_ID and len(text) > 3:
+        add_to_digest(MANAGER_CHAT_ID, DigestEntry(
+            DIGEST_QUESTION,
+            f"❓ {user.full_name or 'Пользователь'} (@{user.username or user.id})"
+            f" · {datetime.now().strftime('%H:%M')}\n"
+            f"💬 {update.message.text}"
+        ))
+
+
+# ============== ПРОСМОТР ЛИДОВ (АДМИН) ==============
+# Страницы берутся из lead_index по курсору из callback_data, от новых к старым:
+# «▶️» — старше последнего показанного, «◀️» — новее первого.
+LEADS_BROWSER_PAGE = 5
+_HAS_PROJECT_FILTERS = {"all": _MISSING, "yes": True, "no": False}
+_HAS_PROJECT_TITLES = {"all": "Все", "yes": "С проектом", "no": "Без проекта"}
+
+
+def _browser_filter(context: ContextTypes.DEFAULT_TYPE) -> tuple:
+    """(код фильтра проекта, LeadFilter) из сессии администратора"""
+    state = context.user_data.setdefault('leads_browser', {'project': "all", 'region': None})
+    return state['project'], LeadFilter(region=state['region'], has_project=_HAS_PROJECT_FILTERS[state['project']])
+
+
+def format_lead_card(data: dict) -> str:
+    """Краткая карточка лида для списка"""
+    username = f"@{data['username']}" if data.get('username') else "без username"
+    if data.get('has_project') is True:
+        project = f"🏗 {data.get('object_type', '—')}, {data.get('area', '—')}, ⏰ {data.get('timeline', '—')}"
+    elif data.get('has_project') is False:
+        project = f"📚 Интересы: {', '.join(data.get('interests') or []) or '—'}"
+    else:
+        project = "— анкета пропущена"
+    return (
+        f"👤 {data.get('full_name') or 'Пользователь'} ({username}, ID {data.get('user_id')})\n"
+        f"📅 {data.get('first_contact') or '—'} · 📍 {data.get('region') or '—'}\n"
+        f"{project}"
+    )
+
+
+def _leads_browser_keyboard(project: str, newer: str = None, older: str = None) -> InlineKeyboardMarkup:
+    navigation = []
+    if newer:
+        navigation.append(InlineKeyboardButton("◀️ Новее", callback_data=f"leads:n:{newer}"))
+    if older:
+        navigation.append(InlineKeyboardButton("Старше ▶️", callback_data=f"leads:o:{older}"))
+    filters_row = [
+        InlineKeyboardButton(("• " if code == project else "") + title, callback_data=f"leads:f:{code}")
+        for code, title in _HAS_PROJECT_TITLES.items()
+    ]
+    return InlineKeyboardMarkup([navigation, filters_row] if navigation else [filters_row])
+
+
+def render_leads_page(context: ContextTypes.DEFAULT_TYPE, direction: str = "o", cursor: str = None):
+    """(текст, клавиатура) страницы или None, если в этом направлении пусто"""
+    users_store()  # индекс строится вместе с кэшем
+    project, lead_filter = _browser_filter(context)
+    after = decode_cursor(cursor) if cursor else None
+    if direction == "n":
+        keys, _ = lead_index.page(lead_filter, after, LEADS_BROWSER_PAGE)
+        keys.reverse()
+    else:
+        keys, _ = lead_index.page(lead_filter, after, LEADS_BROWSER_PAGE, descending=True)
+    if not keys and cursor:
+        return None
     
-    elif any(word in text for word in ["срок", "сколько времени", "как долго"]):
-        await update.message.reply_text(
-            "⏰ Сроки проектирования зависят от площади и сложности объекта.\n\n"
-            "Ориентировочно:\n"
-            "• до 5 000 м² — от 60 дней\n"
-            "• 5 000–20 000 м² — от 90 дней\n"
-            "• более 20 000 м² — от 120 дней\n\n"
-            "📝 Для точного расчёта: /request"
-        )
+    # Есть ли что-то за краями страницы — проверка одной записью
+    newer = older = None
+    if keys and lead_index.page(lead_filter, keys[0], 1)[0]:
+        newer = encode_cursor(keys[0])
+    if keys and lead_index.page(lead_filter, keys[-1], 1, descending=True)[0]:
+        older = encode_cursor(keys[-1])
     
-    elif any(word in text for word in ["контакт", "телефон", "позвонить", "связаться"]):
-        await update.message.reply_text(
-            "📞 Контакты ADC Group:\n\n"
-            "Мобильный: +7 939 111 30 42\n"
-            "Городской: 8 (495) 118-34-88\n"
-            "Email: info@arxproektstroy.ru\n"
-            "Сайт: arxproektstroy.ru\n\n"
-            "📝 Или оставьте заявку: /request"
-        )
+    region = context.user_data['leads_browser']['region']
+    header = f"📋 ЛИДЫ ({_HAS_PROJECT_TITLES[project]}{', ' + region if region else ''})"
+    cards = [format_lead_card(get_user_data(uid)) for _, uid in keys]
+    text = header + "\n\n" + ("\n\n".join(cards) if cards else "Нет лидов по этому фильтру")
+    return text, _leads_browser_keyboard(project, newer, older)
+
+
+async def leads_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /leads [регион] — последние лиды (только для администраторов)"""
+    if not is_admin(update):
+        return
+    context.user_data['leads_browser'] = {'project': "all", 'region': " ".join(context.args) or None}
+    text, keyboard = render_leads_page(context)
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+
+async def leads_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Листание и фильтры списка лидов"""
+    query = update.callback_query
+    if not is_admin(update):
+        await query.answer()
+        return
+    _, action, argument = query.data.split(":", 2)
+    if action == "f":
+        _browser_filter(context)
+        context.user_data['leads_browser']['project'] = argument if argument in _HAS_PROJECT_FILTERS else "all"
+        page = render_leads_page(context)
+    else:
+        try:
+            page = render_leads_page(context, action, argument)
+        except ValueError:
+            page = None
+    if page is None:
+        await query.answer("Дальше лидов нет")
+        return
+    await query.answer()
+    text, keyboard = page
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except BadRequest as e:
+        # Повторное нажатие на тот же фильтр — текст не изменился
+        if "not modified" not in str(e):
+            raise
+
+
+# ============== ПОИСК ПО ТЕКСТАМ (АДМИН) ==============
+FIND_RESULTS = 10
+FIND_SNIPPET = 300
+
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /find <слова> — поиск по комментариям, вопросам и своим ответам"""
+    if not is_admin(update):
+        return
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("Использование: /find <слова>\nНапример: /find склад казань")
+        return
     
-    elif any(word in text for word in ["bim", "бим"]):
-        await update.message.reply_text(
-            "💻 BIM-проектирование\n\n"
-            "ADC Group работает с BIM-технологиями с 2018 года.\n\n"
-            "Преимущества:\n"
-            "• 3D-модель объекта\n"
-            "• Автоматическая проверка коллизий\n"
-            "• Точные спецификации\n"
-            "• Удобство согласований\n\n"
-            "📝 Для расчёта: /request"
-        )
+    results = await search_index.search(query, FIND_RESULTS)
+    if not results:
+        await update.message.reply_text(f"🔎 По запросу «{query}» ничего не найдено")
+        return
     
-    elif any(word in text for word in ["экспертиза", "экспертизу"]):
-        await update.message.reply_text(
-            "🏛 Прохождение экспертизы\n\n"
-            "Сопровождаем проекты в государственной и негосударственной экспертизе.\n\n"
-            "• 87% экспертиз с первого раза\n"
-            "• Устраняем замечания за свой счёт\n"
-            "• Опыт работы со всеми регионами\n\n"
-            "📝 Подробнее: /request"
+    parts = [f"🔎 «{query}»: {len(results)} из {len(search_index)} текстов"]
+    for number, (score, doc) in enumerate(results, start=1):
+        text = doc['text'] if len(doc['text']) <= FIND_SNIPPET else doc['text'][:FIND_SNIPPET] + "…"
+        parts.append(
+            f"{number}. {TEXT_KIND_TITLES.get(doc['kind'], doc['kind'])} · {doc['at']} · "
+            f"ID {doc['user_id']} ({score:.1f})\n{text}"
         )
-    
+    for message in split_message(parts, separator="\n\n"):
+        await update.message.reply_text(message)
+
+
+# ============== ВОРОНКА (АДМИН) ==============
+def format_funnel(total: FunnelRollup, hours: int) -> list:
+    """Части отчёта: по блоку на анкету, заявку и технический вопрос"""
+    parts = [f"📉 ВОРОНКА за {hours} ч"]
+    for title, steps in FUNNEL_FLOWS:
+        first = total.states.get(steps[0][0], [0] * _FUNNEL_ROW_SIZE)[_FUNNEL_ENTERED]
+        lines = [f"{title} (начали: {first})"]
+        for state, label in steps:
+            row = total.states.get(state)
+            if row is None or not row[_FUNNEL_ENTERED]:
+                continue
+            entered = row[_FUNNEL_ENTERED]
+            median = dwell_median(row)
+            median_text = "—" if median is None else ("> 1 ч" if median == math.inf else f"≤ {median} с")
+            lines.append(
+                f"{label}: {entered}"
+                f" · завершили {row[_FUNNEL_ENDED]} · бросили {row[_FUNNEL_ABANDONED]}"
+                f" ({row[_FUNNEL_ABANDONED] / entered:.0%}) · медиана {median_text}"
+            )
+        if len(lines) > 1:
+            parts.append("\n".join(lines))
+    if len(parts) == 1:
+        parts.append("Переходов пока не было")
+    return parts
+
+
+async def funnel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /funnel [часов] — воронка анкеты и заявки (только для администраторов)"""
+    if not is_admin(update):
+        return
+    try:
+        hours = max(1, min(int(context.args[0]), FUNNEL_KEEP_HOURS)) if context.args else 24
+    except ValueError:
+        await update.message.reply_text("Использование: /funnel [часов]")
+        return
+    funnel.rollup()
+    for message in split_message(format_funnel(funnel.summary(hours), hours), separator="\n\n"):
+        await update.message.reply_text(message)
+
+
+# ============== ПУЛ МЕНЕДЖЕРОВ (АДМИН) ==============
+async def lead_ack_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Кнопка «Беру в работу» в уведомлении о лиде"""
+    query = update.callback_query
+    lead = query.data.split(":", 1)[1]
+    chat = str(query.message.chat.id) if query.message else ""
+    waited = manager_pool.ack(lead, chat)
+    if waited is None:
+        await query.answer("Лид уже взят в работу")
     else:
-        await update.message.reply_text(
-            "Я могу помочь с информацией о компании и услугах.\n\n"
-            "Нажмите /start для просмотра меню\n"
-            "или /request чтобы оставить заявку."
+        logger.info("Lead %s acknowledged in chat %s after %.0fs", lead, chat, waited)
+        await query.answer("✅ Лид закреплён за вами")
+    if not query.message:
+        # Сообщение слишком старое — клавиатуру уже не поменять
+        return
+    
+    # Убираем нажатую кнопку, остальные лиды этого сообщения остаются
+    keyboard = [
+        row for row in (query.message.reply_markup.inline_keyboard if query.message.reply_markup else ())
+        if row[0].callback_data != query.data
+    ]
+    try:
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard) if keyboard else None)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+
+def _format_wait(seconds) -> str:
+    if seconds is None:
+        return "—"
+    return f"{seconds:.0f} с" if seconds < 60 else f"{seconds / 60:.0f} мин"
+
+
+def format_manager_pool() -> str:
+    lines = [f"👥 ПУЛ МЕНЕДЖЕРОВ ({manager_pool.balance})"]
+    for chat in manager_pool.chats:
+        stats = manager_pool.stats[chat]
+        average = stats['ack_total'] / stats['acked'] if stats['acked'] else None
+        lines.append(
+            f"{chat}: назначено {stats['assigned']} · ждут подтверждения {manager_pool.outstanding(chat)}"
+            f" · среднее время до подтверждения {_format_wait(average)}"
         )
+    return "\n".join(lines)
+
+
+async def managers_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /managers — нагрузка менеджеров пула (только для администраторов)"""
+    if not is_admin(update):
+        return
+    if not manager_pool.enabled:
+        await update.message.reply_text("Пул менеджеров не настроен (MANAGER_POOL)")
+        return
+    for message in split_message([format_manager_pool()]):
+        await update.message.reply_text(message)
+
+
+# ============== КАТАЛОГ ТЕКСТОВ (АДМИН) ==============
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /reload — перечитать файл каталога текстов (только для администраторов)"""
+    if not is_admin(update):
+        return
+    try:
+        await reload_content(force=True)
+    except (OSError, ValueError) as e:
+        await update.message.reply_text(f"⚠️ Каталог не загружен, работает прежний:\n{e}")
+        return
+    await update.message.reply_text(
+        f"✅ Каталог перезагружен ({content.source}): "
+        f"{len(content.pages)} страниц, {len(content.answers)} ответов"
+    )
+
+
+# ============== ПРОФИЛИРОВАНИЕ (АДМИН) ==============
+# /profile <сек> включает на время окна cProfile в потоке цикла событий и два
+# сэмплера: поток, снимающий стек цикла событий (время на процессоре), и
+# корутину, обходящую цепочки await всех задач (время ожидания в обработчиках).
+# Стеки выдаются в свёрнутом формате flamegraph.pl/speedscope: «a;b;c N».
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP = 40
+PROFILE_CPU_INTERVAL = 0.005
+PROFILE_TASK_INTERVAL = 0.01
+
+_profile_running = False
+
+
+def _frame_label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_qualname}"
+
+
+def _thread_sampler(thread_id: int, stop: threading.Event, counts: Counter) -> None:
+    """Снимки стека потока thread_id, пока не выставлен stop"""
+    while not stop.wait(PROFILE_CPU_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame.f_code))
+            frame = frame.f_back
+        if stack:
+            counts["cpu;" + ";".join(reversed(stack))] += 1
+
+
+def _await_chain(coroutine) -> list:
+    """Кадры приостановленной корутины вглубь по цепочке await"""
+    labels = []
+    while coroutine is not None:
+        frame = getattr(coroutine, 'cr_frame', None) or getattr(coroutine, 'gi_frame', None)
+        if frame is None:
+            break
+        labels.append(_frame_label(frame.f_code))
+        coroutine = getattr(coroutine, 'cr_await', None) or getattr(coroutine, 'gi_yieldfrom', None)
+    return labels
+
+
+async def _task_sampler(deadline: float, counts: Counter) -> None:
+    """Снимки цепочек await всех задач до deadline (по часам цикла)"""
+    loop = asyncio.get_running_loop()
+    current = asyncio.current_task()
+    while loop.time() < deadline:
+        await asyncio.sleep(PROFILE_TASK_INTERVAL)
+        for task in asyncio.all_tasks():
+            if task is current or task.done():
+                continue
+            chain = _await_chain(task.get_coro())
+            if chain:
+                counts["await;" + ";".join(chain)] += 1
+
+
+def pstats_report(profiler: cProfile.Profile, top: int = PROFILE_TOP) -> str:
+    """Текстовый отчёт: top функций по суммарному и собственному времени"""
+    buffer = io.StringIO()
+    stats = pstats.Stats(profiler, stream=buffer).strip_dirs()
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+    return buffer.getvalue()
+
+
+async def run_profile(bot, chat_id, seconds: float) -> None:
+    """Профилирование окна seconds и отправка отчётов в chat_id"""
+    global _profile_running
+    cpu_counts = Counter()
+    task_counts = Counter()
+    stop = threading.Event()
+    sampler = threading.Thread(
+        target=_thread_sampler, args=(threading.get_ident(), stop, cpu_counts),
+        name="profile_sampler", daemon=True
+    )
+    profiler = cProfile.Profile()
+    started = datetime.now()
+    try:
+        sampler.start()
+        profiler.enable()
+        try:
+            await _task_sampler(asyncio.get_running_loop().time() + seconds, task_counts)
+        finally:
+            profiler.disable()
+            stop.set()
+            await asyncio.to_thread(sampler.join)
         
-        # Отправляем неотвеченный вопрос менеджеру
-        if MANAGER_CHAT_ID and len(text) > 3:
-            try:
-                await context.bot.send_message(
-                    chat_id=MANAGER_CHAT_ID,
-                    text=f"❓ ВОПРОС БЕЗ ОТВЕТА\n\n"
-                         f"👤 {user.full_name or 'Пользователь'} (@{user.username or user.id})\n"
-                         f"💬 {update.message.text}\n\n"
-                         f"_Бот не нашёл подходящий ответ_"
-                )
-            except Exception as e:
-                logger.error(f"Failed to send unanswered question: {e}")
+        report = await asyncio.to_thread(pstats_report, profiler)
+        collapsed = "".join(
+            f"{stack} {count}\n" for stack, count in (cpu_counts + task_counts).most_common()
+        )
+        stamp = started.strftime("%Y%m%d-%H%M%S")
+        caption = (f"⏱ Профиль {seconds:g} с: {sum(cpu_counts.values())} снимков стека, "
+                   f"{sum(task_counts.values())} снимков задач")
+        await ManagerQueue._send_with_retry(
+            bot.send_document, chat_id=chat_id, caption=caption,
+            document=report.encode('utf-8'), filename=f"profile-{stamp}.txt"
+        )
+        await ManagerQueue._send_with_retry(
+            bot.send_document, chat_id=chat_id,
+            document=collapsed.encode('utf-8'), filename=f"profile-{stamp}.collapsed"
+        )
+        logger.info("Profile of %ss sent to %s", seconds, chat_id)
+    except Exception as e:
+        logger.error("Profiling failed: %s", e)
+    finally:
+        _profile_running = False
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /profile [сек] — профиль работающего бота (только для администраторов)"""
+    global _profile_running
+    if not is_admin(update):
+        return
+    try:
+        seconds = float(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(f"Использование: /profile [секунд, до {PROFILE_MAX_SECONDS}]")
+        return
+    if _profile_running:
+        await update.message.reply_text("⏱ Профилирование уже идёт")
+        return
+    
+    _profile_running = True
+    # Окно профиля идёт фоном — обработка апдейтов не ждёт его конца
+    start_background_task(run_profile(context.bot, update.effective_chat.id, seconds), name="profile")
+    await update.message.reply_text(f"⏱ Профилирую {seconds:g} с, отчёт придёт файлами")
+
+
+# ============== ГОТОВНОСТЬ ==============
+# Сигналы копятся по ходу работы (getUpdates, запись базы, очередь, пульс цикла),
+# пробы /readyz и /livez только читают их — без обращений к Telegram и диску.
+class Readiness:
+    """Готовность инстанса принимать трафик"""
+
+    def __init__(self):
+        self.updates_at = None  # time.monotonic() последнего getUpdates или апдейта
+        self.storage_error = None
+        self.stopping = False
+
+    def updates_received(self) -> None:
+        self.updates_at = time.monotonic()
+
+    def storage_written(self) -> None:
+        self.storage_error = None
+
+    def storage_failed(self, error: Exception) -> None:
+        self.storage_error = str(error) or type(error).__name__
+
+    def checks(self) -> dict:
+        """Проверки готовности: имя -> {'ok': bool, ...значение}"""
+        age = None if self.updates_at is None else time.monotonic() - self.updates_at
+        depth = len(manager_queue)
+        lag = loop_monitor.current_lag()
+        return {
+            'running': {'ok': not self.stopping},
+            'updates': {'ok': age is not None and age <= READY_UPDATES_MAX_AGE,
+                        'age': None if age is None else round(age, 1)},
+            'storage': {'ok': self.storage_error is None, 'error': self.storage_error},
+            'queue': {'ok': depth <= READY_MAX_QUEUE, 'depth': depth},
+            'loop_lag': {'ok': lag <= READY_MAX_LOOP_LAG, 'lag': round(lag, 3)},
+            'crm_outbox': crm_outbox.health(),
+        }
+
+    @staticmethod
+    def alive() -> bool:
+        """Живость: цикл событий отвечает"""
+        return loop_monitor.current_lag() <= LIVE_MAX_STALL
+
+
+readiness = Readiness()
 
 
 # ============== HEALTH CHECK ==============
+# Цикл событий бота: HTTP-потоки читают кэш пользователей только через него
+_event_loop = None
+# Сколько поток /leads ждёт записи страницы от цикла событий (сек)
+LEADS_LOOP_TIMEOUT = 10.0
+
+
+async def _leads_page_records(keys: list) -> list:
+    """Копии записей страницы /leads (в потоке цикла событий, где кэш меняется)"""
+    records = []
+    for _, uid in keys:
+        value = _users_cache.get(uid)
+        if value is None:
+            continue
+        record = dict(upgrade_record(uid, _from_cached(value)))
+        attachments = attachment_archiver.attachments(record.get('user_id'))
+        if attachments:
+            record['attachments'] = attachments
+        records.append(record)
+    return records
+
+
+def _parse_lead_query(query: dict) -> tuple:
+    """Параметры /leads -> (фильтр, курсор, размер страницы); ValueError при ошибке"""
+    def single(name):
+        values = query.get(name)
+        return values[-1] if values else None
+    
+    for name in ('since', 'until'):
+        value = single(name)
+        if value is not None:
+            datetime.strptime(value, "%Y-%m-%d")
+    has_project = single('has_project')
+    if has_project is None:
+        has_project = _MISSING
+    elif has_project in ('true', 'false', 'null'):
+        has_project = {'true': True, 'false': False, 'null': None}[has_project]
+    else:
+        raise ValueError("has_project must be true, false or null")
+    limit = int(single('limit') or LEADS_PAGE_SIZE)
+    if not 1 <= limit <= LEADS_MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be 1..{LEADS_MAX_PAGE_SIZE}")
+    cursor = single('cursor')
+    lead_filter = LeadFilter(single('since'), single('until'), single('region'), has_project)
+    return lead_filter, decode_cursor(cursor) if cursor else None, limit
+
+
 class HealthHandler(BaseHTTPRequestHandler):
     def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/leads' and LEADS_API_TOKEN:
+            self._leads(url)
+            return
+        if url.path == '/readyz':
+            checks = readiness.checks()
+            ready = all(check['ok'] for check in checks.values())
+            self._send_json(200 if ready else 503, {'ready': ready, 'checks': checks})
+            return
+        if url.path == '/livez':
+            alive = readiness.alive()
+            self._send_json(200 if alive else 503, {'alive': alive})
+            return
+        if url.path == '/metrics':
+            body = ("\n".join(loop_monitor.prometheus()) + "\n").encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
         self.send_response(200)
         self.send_header('Content-type', 'text/plain')
         self.end_headers()
         self.wfile.write(b'OK')
     
+    def _send_error_json(self, status: int, message: str) -> None:
+        self._send_json(status, {'error': message})
+    
+    def _send_json(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _leads(self, url) -> None:
+        """Страница лидов: {"items": [...], "next_cursor": ...}"""
+        authorization = self.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {LEADS_API_TOKEN}".encode('utf-8')):
+            self._send_error_json(401, "unauthorized")
+            return
+        try:
+            lead_filter, after, limit = _parse_lead_query(parse_qs(url.query))
+        except ValueError as e:
+            self._send_error_json(400, str(e))
+            return
+        if not lead_index.ready or _event_loop is None:
+            self._send_error_json(503, "store is loading")
+            return
+        
+        # Версия хранилища меняется при каждой записи — страница с тем же запросом не изменилась
+        etag = f'"{store_version}-{hashlib.sha1(url.query.encode("utf-8")).hexdigest()[:12]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        
+        keys, next_cursor = lead_index.page(lead_filter, after, limit)
+        try:
+            records = asyncio.run_coroutine_threadsafe(
+                _leads_page_records(keys), _event_loop
+            ).result(LEADS_LOOP_TIMEOUT)
+        except (RuntimeError, FutureTimeoutError):
+            # Цикл событий остановлен или занят — страницу не собрать
+            self._send_error_json(503, "bot is busy")
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'private, no-cache')
+        self.end_headers()
+        
+        # Записи сериализуются по одной и уходят пачками, без сборки всего ответа
+        buffer = [b'{"items":[']
+        buffered = 0
+        separator = b''
+        for record in records:
+            item = json.dumps(record, ensure_ascii=False).encode('utf-8')
+            buffer.append(separator + item)
+            separator = b','
+            buffered += len(item)
+            if buffered >= 64 * 1024:
+                self.wfile.write(b''.join(buffer))
+                buffer, buffered = [], 0
+        buffer.append(b'],"next_cursor":' + json.dumps(next_cursor).encode('utf-8') + b'}')
+        self.wfile.write(b''.join(buffer))
+    
     def log_message(self, format, *args):
         pass
 
 
 def start_health_server():
     port = int(os.environ.get("PORT", 8080))
-    server = HTTPServer(('0.0.0.0', port), HealthHandler)
-    logger.info(f"Health server on port {port}")
+    # Потоковый сервер: долгий ответ /leads не задерживает проверки здоровья
+    server = ThreadingHTTPServer(('0.0.0.0', port), HealthHandler)
+    logger.info("Health server on port %s", port)
     server.serve_forever()
 
 
 # ============== MAIN ==============
-def main() -> None:
-    token = os.environ.get("TELEGRAM_TOKEN")
-    
-    if not token:
-        logger.error("TELEGRAM_TOKEN not found")
-        return
-    
-    # Health-check сервер
-    health_thread = threading.Thread(target=start_health_server, daemon=True)
-    health_thread.start()
-    
-    # Создаём приложение
-    application = Application.builder().token(token).build()
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_background_tasks = set()
+
+
+def start_background_task(coroutine, name: str = None) -> asyncio.Task:
+    """Запуск фоновой задачи вне учёта Application.create_task"""
+    task = asyncio.create_task(coroutine, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def post_init(application: Application) -> None:
+    """Запуск фоновых обработчиков"""
+    global _event_loop
+    _event_loop = asyncio.get_running_loop()
+    loop_monitor.start()
+    manager_queue.start(application.bot)
+    attachment_archiver.start(application.bot)
+    crm_outbox.start()
+    await resume_update_offset(application, application.bot_data.get('warm_state', {}))
+    # Кэш пользователей догружается фоном — первые ответы его не ждут
+    start_background_task(preload_users_cache(), name="preload_users")
+
+
+async def post_stop(application: Application) -> None:
+    """Досылка очередей, пока бот ещё может отправлять сообщения"""
+    # Апдейты больше не принимаются — оркестратор должен увести трафик
+    readiness.stopping = True
+    await manager_queue.stop(application.bot)
+    await flush_digest(application.bot)
+    await attachment_archiver.stop()
+    await crm_outbox.stop()
+    await loop_monitor.stop()
+
+
+async def post_shutdown(application: Application) -> None:
+    """Сохранение незаписанного состояния при остановке"""
+    flush_snapshot()
+    save_warm_state()
+    update_journal.close()
+    search_index.close()
+    reminders.save()
+    funnel.rollup()
+    funnel.close_hour()
+
+
+def build_application(token: str = None, bot=None) -> Application:
+    """Приложение со всеми обработчиками и фоновыми задачами"""
+    builder = Application.builder().application_class(BotApplication)
+    if bot is not None:
+        builder = builder.bot(bot)
+    else:
+        # getUpdates идёт через отдельный клиент — он тоже должен отмечать готовность
+        builder = (builder.token(token)
+                   .request(TracingRequest(connection_pool_size=256))
+                   .get_updates_request(TracingRequest()))
+    application = (
+        builder
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # ConversationHandler для приветственной анкеты
     survey_handler = ConversationHandler(
@@ -1318,6 +5730,7 @@ def main() -> None:
             CommandHandler("cancel", cancel),
             CallbackQueryHandler(button_handler, pattern="^menu$")
         ],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
     
     # ConversationHandler для формы заявки
@@ -1350,21 +5763,112 @@ def main() -> None:
             CommandHandler("cancel", cancel),
             CallbackQueryHandler(button_handler, pattern="^menu$")
         ],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
     
     # Регистрация обработчиков
+    # Группа -2: повторно доставленные апдейты отбрасываются до всех остальных
+    application.add_handler(TypeHandler(Update, drop_duplicate_update), group=-2)
+    # Группа -1: антифлуд
+    application.add_handler(TypeHandler(Update, flood_guard), group=-1)
+    # Список лидов — до анкеты, чтобы её состояния не перехватывали кнопки
+    application.add_handler(CommandHandler("leads", leads_command))
+    application.add_handler(CallbackQueryHandler(leads_callback, pattern="^leads:"))
+    application.add_handler(CommandHandler("find", find_command))
+    application.add_handler(CommandHandler("funnel", funnel_command))
+    application.add_handler(CommandHandler("reload", reload_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("managers", managers_command))
+    application.add_handler(CallbackQueryHandler(lead_ack_callback, pattern="^ack:"))
     application.add_handler(survey_handler)
     application.add_handler(request_handler)
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("giveaway", giveaway_command))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    instrument_handlers(application)
+    
+    # Фоновые задачи
+    application.job_queue.run_repeating(
+        reap_idle_sessions, interval=REAPER_INTERVAL, first=REAPER_INTERVAL,
+        name="session_reaper"
+    )
+    application.job_queue.run_repeating(
+        report_queue_stats, interval=QUEUE_REPORT_INTERVAL, first=QUEUE_REPORT_INTERVAL,
+        name="queue_report"
+    )
+    application.job_queue.run_repeating(
+        digest_job, interval=DIGEST_INTERVAL, first=DIGEST_INTERVAL, name="digest"
+    )
+    application.job_queue.run_repeating(
+        send_due_reminders, interval=REMINDER_TICK, first=REMINDER_TICK, name="reminders"
+    )
+    if CONTENT_FILE:
+        application.job_queue.run_repeating(
+            content_watch_job, interval=CONTENT_POLL_INTERVAL, first=CONTENT_POLL_INTERVAL, name="content"
+        )
+    application.job_queue.run_repeating(
+        funnel_rollup_job, interval=FUNNEL_ROLLUP_INTERVAL, first=FUNNEL_ROLLUP_INTERVAL, name="funnel"
+    )
+    if SNAPSHOT_DIR:
+        application.job_queue.run_repeating(
+            snapshot_job, interval=SNAPSHOT_INTERVAL, first=SNAPSHOT_INTERVAL, name="snapshots"
+        )
+    
+    return application
+
+
+def main() -> None:
+    setup_logging()
+    setup_tracing()
+    token = os.environ.get("TELEGRAM_TOKEN")
+    
+    if not token:
+        logger.error("TELEGRAM_TOKEN not found")
+        stop_tracing()
+        stop_logging()
+        return
+    
+    update_journal.open(JOURNAL_FILE)
+    search_index.open(TEXTS_FILE)
+    reminders.load()
+    funnel.load()
+    try:
+        install_content(*load_content())
+    except (OSError, ValueError) as e:
+        logger.error("Content file rejected, using built-in texts: %s", e)
+    if ARCHIVE_DIR:
+        attachment_archiver.open(ARCHIVE_DIR)
+    if CRM_URL:
+        crm_outbox.open(CRM_OUTBOX_FILE)
+    warm_state = load_warm_state()
+    
+    # Health-check сервер
+    health_thread = threading.Thread(target=start_health_server, daemon=True)
+    health_thread.start()
+    
+    # Создаём приложение
+    application = build_application(token)
+    application.bot_data['warm_state'] = warm_state
     
     logger.info("Bot ADC Navigator v3.0 started")
     logger.info("Features: survey, giveaway, request form")
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        stop_tracing()
+        stop_logging()
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["restore"]:
+        setup_logging()
+        restore_command()
+        stop_logging()
+    elif sys.argv[1:] == ["migrate"]:
+        setup_logging()
+        migrate_command()
+        stop_logging()
+    else:
+        main()